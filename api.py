@@ -22,6 +22,16 @@ logging.basicConfig(
 
 ALLOWED_USERS = {'aignos'}
 
+# Timeouts for streamed requests: connecting to the server, and waiting for
+# the next event (the server sends keep-alive comments in the meantime)
+STREAM_CONNECT_TIMEOUT = 10
+STREAM_READ_TIMEOUT = 60
+
+# Configs with the addresses of the servers, by the name the pages send as
+# 'server' in the requests (see cgi_common.print_html_head())
+SERVER_CONFIGS = {'dialogue': 'config.json', 'synopsis': 'syn_config.json'}
+DEFAULT_SERVER = 'dialogue'
+
 
 def valid_request(request):
     result = False
@@ -31,6 +41,18 @@ def valid_request(request):
     return result
 
 
+def route(request):
+    """The address of a server for the page which sent the request, and the
+    request to send there: a ticket goes to the server which has it (the
+    ticket starts with its number in the list, see
+    cgi_common.print_pending())."""
+    server_addrs = SERVER_ADDR[request.get('server', DEFAULT_SERVER)]
+    if 'ticket' in request:
+        server_no, ticket = request['ticket'].split('.', 1)
+        return server_addrs[int(server_no)], dict(request, ticket=ticket)
+    return random.choice(server_addrs), request
+
+
 def handle_server_request():
     """Main method to use for Flask requests."""
     logging.info('Got request {}'.format(flask.request.json))
@@ -38,7 +60,8 @@ def handle_server_request():
     try:
         req = None
         if valid_request(flask.request.json):
-            req = requests.post(random.choice(SERVER_ADDR), json=flask.request.json)
+            server_addr, request = route(flask.request.json)
+            req = requests.post(server_addr, json=request)
             if req.status_code == requests.codes.ok:
                 logging.info('Got answer {}'.format(req))
                 return req.text
@@ -50,6 +73,39 @@ def handle_server_request():
         flask.abort(500)
 
 
+def handle_stream_request():
+    """Forward a request for a streamed text (server-sent events), passing
+    the events on as soon as they come, without buffering."""
+    logging.info('Got stream request {}'.format(flask.request.json))
+
+    try:
+        req = None
+        if valid_request(flask.request.json):
+            server_addr, request = route(flask.request.json)
+            req = requests.post(server_addr.rstrip('/') + '/stream', json=request, stream=True,
+                                timeout=(STREAM_CONNECT_TIMEOUT, STREAM_READ_TIMEOUT))
+            if req.status_code == requests.codes.ok:
+                return flask.Response(flask.stream_with_context(forward_stream(req)),
+                                      mimetype='text/event-stream',
+                                      headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        logging.warning('Got error {}'.format(req or 'invalid request'))
+        flask.abort(500)
+    except Exception as e:
+        logging.warning(f'Got exception: {e}\n')
+        flask.abort(500)
+
+
+def forward_stream(req):
+    """Pass on the data of the streamed response as it comes."""
+    try:
+        for chunk in req.iter_content(chunk_size=None):
+            yield chunk
+    except Exception as e:
+        logging.warning(f'Got exception while streaming: {e}\n')
+    finally:
+        req.close()
+
+
 def handle_bad_request(e):
     return 'ERROR', 500
 
@@ -62,18 +118,21 @@ if __name__ == '__main__':
                     help='Host/interface on which this API runs (defaults to 0.0.0.0 which serves all IPs)')
     args = ap.parse_args()
 
-    try:
-        with open('config.json') as configfile:
-            config = json.load(configfile)
-            SERVER_ADDR = config['SERVER_ADDR']
-    except Exception:
-        SERVER_ADDR = 'http://localhost:8456'
-    if not isinstance(SERVER_ADDR, list):
-        SERVER_ADDR = [SERVER_ADDR]
+    SERVER_ADDR = {}
+    for server, filename in SERVER_CONFIGS.items():
+        try:
+            with open(filename) as configfile:
+                config = json.load(configfile)
+                SERVER_ADDR[server] = config['SERVER_ADDR']
+        except Exception:
+            SERVER_ADDR[server] = 'http://localhost:8456'
+        if not isinstance(SERVER_ADDR[server], list):
+            SERVER_ADDR[server] = [SERVER_ADDR[server]]
 
     app = flask.Flask(__name__)
     CORS(app)
     app.add_url_rule('/', 'handle_server_request', handle_server_request, methods=['POST'])
+    app.add_url_rule('/stream', 'handle_stream_request', handle_stream_request, methods=['POST'])
     app.register_error_handler(500, handle_bad_request)
     logging.info('Starting server')
     app.run(host=args.host, port=args.port, threaded=True)
@@ -1,28 +1,86 @@
 
 import json
+import requests
 import traceback
 import sys
 from api_token import get_token
 from keyops import compress_key
 import random
 
+# Timeout for requests to the server (seconds)
+REQUEST_TIMEOUT = 120
+
+# How long the server may take to generate the text before it returns the
+# lines known so far, and the page waits for the rest (see print_pending())
+NOWAIT_WAIT = 5
+
+# How long the page waits for news about the text in one request
+LONG_POLL_WAIT = 30
+
 
 def load_config(filename):
+    """The address of the server (one picked at random if there are more),
+    its number in the list (the API knows the servers by it), and the address
+    of the API."""
     SERVER_ADDR = 'http://localhost:8456'
+    SERVER_NO = 0
     API_ADDR = 'http://ufallab.ms.mff.cuni.cz:8457'
     try:
         with open(filename) as configfile:
             config = json.load(configfile)
             SERVER_ADDR = config['SERVER_ADDR']
             if isinstance(SERVER_ADDR, list):
-                SERVER_ADDR = random.choice(SERVER_ADDR)
+                SERVER_NO = random.randrange(len(SERVER_ADDR))
+                SERVER_ADDR = SERVER_ADDR[SERVER_NO]
             API_ADDR = config.get('API_ADDR', API_ADDR)
     except Exception:
         pass  # keep the default
-    return SERVER_ADDR, API_ADDR
-
-
-def print_html_head(page_title, username, data, api_addr):
+    return SERVER_ADDR, SERVER_NO, API_ADDR
+
+
+def wait_for_lines(server_addr, data):
+    """A text requested with 'nowait' comes without any lines if the server
+    did not know them in time; long-poll its ticket until they are known."""
+    while data.get('pending') and 'lines' not in data:
+        req = requests.post(server_addr, json={'ticket': data['ticket'], 'version': data['version'],
+                                               'wait': LONG_POLL_WAIT}, timeout=REQUEST_TIMEOUT)
+        if req.status_code != 200:
+            raise Exception(f'Could not get the text, code: {req.status_code}, text: {req.text}')
+        data = req.json()
+    return data
+
+
+def fill_translations(server_addr, data):
+    """Fill in the Czech translations that were not ready when the server
+    returned the text (listed in data['pending_translations']); those still
+    not ready are replaced by the English text."""
+    pending = data.get('pending_translations')
+    if not pending:
+        return data
+    translations = {}
+    try:
+        req = requests.post(server_addr, json={'translations': [compress_key(key) for key in pending]},
+                            timeout=REQUEST_TIMEOUT)
+        if req.status_code == 200:
+            translations = req.json().get('translations', {})
+    except (requests.RequestException, ValueError):
+        pass  # keep the English text
+    for key in pending:
+        translation = translations.get(key)
+        if key.endswith('-'):
+            # scene prompt and outline
+            translation = translation or {}
+            data['cs_prompt'] = translation.get('prompt') or data['prompt']
+            data['cs_outline'] = translation.get('outline') or data.get('outline') or ''
+        elif key in data.get('line_keys', []):
+            position = data['line_keys'].index(key)
+            data['cs_lines'][position] = translation or data['lines'][position]
+    return data
+
+
+def print_html_head(page_title, username, data, api_addr, server='dialogue'):
+    """Print the head of the page; the requests from the page go through
+    the API at api_addr to the servers it knows by the given name."""
     # print HTML header
     print('<!DOCTYPE html>\n<html lang="en">')
 
@@ -95,6 +153,11 @@ def print_html_head(page_title, username, data, api_addr):
     margin-top: 1em;
     }
 
+    .pending {
+    color: gray;
+    font-style: italic;
+    }
+
     #typingimg {
     width: 480px;
     height: 360px;
@@ -117,6 +180,14 @@ def print_html_head(page_title, username, data, api_addr):
     display: block;
     }
 
+    #streamdiv {
+    display: none;
+    max-width: 80%;
+    margin: 1em auto 0px auto;
+    text-align: left;
+    background-color: #fff;
+    }
+
     #graydiv {
     position: fixed;
     top: 0px;
@@ -221,6 +292,9 @@ def print_html_head(page_title, username, data, api_addr):
     print(f"var username = '{username}';\n")
     print(f"var token = '" + get_token(username) + "';\n")
     print(f"var ajaxURL = '{api_addr}';\n")
+    print(f"var apiServer = '{server}';\n")
+    print(f"var longPollWait = {LONG_POLL_WAIT};\n")
+    print(f"var nowaitWait = {NOWAIT_WAIT};\n")
     print("""
 
     var humanInputPos = -1;
@@ -240,20 +314,127 @@ def print_html_head(page_title, username, data, api_addr):
         };
         xhr.setRequestHeader('X-Requested-With', 'XMLHttpRequest');
         xhr.setRequestHeader('Content-Type', 'application/json; charset=utf-8');
+        data['server'] = apiServer;
         xhr.send(JSON.stringify(data));
         return xhr;
     }
 
-    function typing() {
+    // Show the robot while the next page is loading. If called with a link
+    // to a scene, the lines are shown as they are generated (streamed from
+    // the API), and the link is only followed once they are all done;
+    // returns false in that case, so that the link is not followed now.
+    function typing(link) {
         getEl('typingdiv').style.display = "flex"
         getEl('graydiv').style.display = "block"
         document.body.style.cursor = 'wait'
+
+        if (!link || !link.href || link.href.indexOf('?id=') < 0 || !window.fetch || !window.TextDecoder){
+            return true;
+        }
+        // text of the lines streamed so far, by key
+        var lines = {};
+        fetch(ajaxURL.replace(/\\/$/, '') + '/stream', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json; charset=utf-8'},
+            body: JSON.stringify({'key': new URL(link.href).searchParams.get('id'),
+                                  'username': username,
+                                  'token': token,
+                                  'server': apiServer})
+        }).then(function(response){
+            if (!response.ok || !response.body){
+                throw new Error('Streaming failed: ' + response.status);
+            }
+            var reader = response.body.getReader();
+            var decoder = new TextDecoder();
+            var buffer = '';
+            function read(){
+                return reader.read().then(function(result){
+                    if (result.done){
+                        return;
+                    }
+                    buffer += decoder.decode(result.value, {stream: true});
+                    var events = buffer.split('\\n\\n');
+                    buffer = events.pop();
+                    for (var i = 0; i < events.length; ++i){
+                        if (stream_event(events[i], lines)){
+                            return;
+                        }
+                    }
+                    return read();
+                });
+            }
+            return read();
+        }).catch(function(error){
+            console.log(error);
+        }).then(function(){
+            // the lines are generated now (or we just wait for the page)
+            window.location.href = link.href;
+        });
+        return false;
+    }
+
+    // Show one server-sent event from the stream; returns true at the end.
+    function stream_event(text, lines) {
+        var event = 'message';
+        var data = '';
+        text.split('\\n').forEach(function(line){
+            if (line.startsWith('event: ')){
+                event = line.substring(7);
+            }
+            else if (line.startsWith('data: ')){
+                data += line.substring(6);
+            }
+        });
+        if (event == 'token' || event == 'line'){
+            var item = JSON.parse(data);
+            lines[item.key] = item.text;
+            var div = getEl('streamdiv');
+            if (div){
+                div.textContent = Object.keys(lines).map(function(key){ return lines[key].trim(); }).join('\\n');
+                div.style.display = "block";
+            }
+        }
+        return event == 'done' || event == 'error';
+    }
+
+    // Long-poll the API for the rest of a text being generated (see
+    // print_pending()), show the new lines, and go to the whole text once
+    // it is done.
+    function poll_pending(ticket, version, shown, key) {
+        var xhr = post_ajax(
+            {'ticket': ticket,
+            'version': version,
+            'wait': longPollWait,
+            'username': username,
+            'token': token},
+            function(status){
+                var result = status == 200 ? JSON.parse(xhr.responseText) : null;
+                if (result && result.pending){
+                    var div = getEl('pendinglines');
+                    if (div && result.lines && result.lines.length > shown){
+                        div.textContent += result.lines.slice(shown).map(function(line){ return line.trim(); }).join('\\n') + '\\n';
+                        shown = result.lines.length;
+                    }
+                    poll_pending(ticket, result.version, shown, key);
+                }
+                else if (result){
+                    window.location.href = '?id=' + key;
+                }
+                else {
+                    // cannot poll, just try again later
+                    setTimeout(function(){ window.location.href = '?id=' + key; }, nowaitWait * 1000);
+                }
+            }
+        );
     }
 
     function notyping() {
         getEl('typingdiv').style.display = "none"
         getEl('graydiv').style.display = "none"
         document.body.style.cursor = 'default'
+        if (getEl('streamdiv')){
+            getEl('streamdiv').style.display = "none"
+        }
     }
 
     function toggle_human_input(key){
@@ -316,6 +497,19 @@ def print_html_head(page_title, username, data, api_addr):
     print("</head>\n")
 
 
+def print_pending(data, server_no):
+    """If the text is still being generated (requested with 'nowait'), say
+    so below the lines known so far, and wait for the rest; the page polls
+    through the API, which needs the number of the server with the ticket."""
+    if not data.get('pending'):
+        return
+    print('<pre id="pendinglines"></pre>')
+    print('<p class="clear pending">Generating more lines&hellip;</p>')
+    print('<script type="text/javascript">poll_pending({}, {}, {}, {});</script>'.format(
+        json.dumps(f"{server_no}.{data['ticket']}"), int(data['version']), len(data['lines']),
+        json.dumps(compress_key(data['pending']))))
+
+
 def print_rating_links(key, rating):
     rating = rating or 0
     html_class = 'rated' if rating else ''
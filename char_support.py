@@ -1,13 +1,22 @@
 #!/usr/bin/env python
+import math
 import re
 import torch
 from torch.nn import functional as F
+from transformers import LogitsProcessor
 
 
 class trie_node():
     def __init__(self, value = None):
         self.value = value
-        self.children = set()
+        # value -> child node
+        self.children = dict()
+        # indices of the characters whose names go through this node
+        self.characters = set()
+        # set by trie.finalize(): the values of the children as a tensor and,
+        # for each child, a row telling which characters it leads to
+        self.allowed = None
+        self.membership = None
 
     def add_child(self, value):
         child = self.get_child(value)
@@ -15,20 +24,23 @@ class trie_node():
             return child
         else:
             child = trie_node(value)
-            self.children.add(child)
+            self.children[value] = child
             return child
 
     def get_child(self, value):
-        for child in self.children:
-            if child.value == value:
-                return child
-        return None
+        return self.children.get(value)
 
     def get_children_values(self):
-        values = []
-        for child in self.children:
-            values.append(child.value)
-        return values
+        return list(self.children.keys())
+
+    def finalize(self, num_characters):
+        values = self.get_children_values()
+        self.allowed = torch.tensor(values, dtype=torch.long)
+        self.membership = torch.zeros((len(values), num_characters), dtype=torch.bool)
+        for i, value in enumerate(values):
+            child = self.children[value]
+            self.membership[i, list(child.characters)] = True
+            child.finalize(num_characters)
 
     def print_node(self, tokenizer, _prefix="", _last=True):
         print(_prefix, "`- " if _last else "|- ", tokenizer.decode([self.value]), sep="")
@@ -42,22 +54,30 @@ class trie_node():
 
 class trie():
     # List containing lists containing encoded characters
-    def __init__(self, char_list):
-        self.newline = 198  #198 is an encoded newline
-        self.colon = 25
+    # names = the names of the characters, for set_speakers()
+    def __init__(self, char_list, newline=198, colon=25, history_len=10, names=None):
+        self.newline = newline  #198 is an encoded newline
+        self.colon = colon
         self.root = trie_node(self.newline)
 
-        for character in char_list:
+        for i, character in enumerate(char_list):
             self.current = self.root
             for subword in character:
                 self.add_child_to_current(subword)
+                self.current.characters.add(i)
             self.add_child_to_current(self.colon)
+            self.current.characters.add(i)
+        self.root.finalize(len(char_list))
 
         self.current = self.root
         self.next_allowed = self.get_children_of_current()
+        # indices of the characters who spoke last, the most recent last
         self.character_history = []
         self.current_character = []
         self.char_list = char_list
+        self.names = names
+        self.history_len = history_len
+        self.set_history([])
 
     def reset_current(self):
         self.current = self.root
@@ -79,41 +99,53 @@ class trie():
     def print_trie(self, tokenizer):
         self.root.print_node(tokenizer)
 
+    def set_history(self, character_history):
+        """Set the characters who spoke last (indices into char_list, the
+        most recent last); characters who did not speak recently are
+        preferred."""
+        self.character_history = list(character_history)[-self.history_len:]
+        # position of the last occurrence of each character in the history, -1 if none
+        self.last_occurrence = torch.full((len(self.char_list),), -1.0)
+        for position, character in enumerate(self.character_history):
+            self.last_occurrence[character] = position
+        # log-bias of the children of each node, computed on demand
+        self.biases = dict()
+
+    def history_bias(self, node, history_coefficient=2):
+        """For each child of the node, the log of the factor by which its
+        probability is multiplied: history_coefficient ** (history_len -
+        last occurrence of the characters it leads to)."""
+        key = (id(node), history_coefficient)
+        if key not in self.biases:
+            if len(node.allowed) == 0:
+                self.biases[key] = torch.zeros(0)
+            else:
+                occurrences = torch.where(node.membership, self.last_occurrence, torch.tensor(-1.0))
+                last = occurrences.max(dim=1).values
+                self.biases[key] = (self.history_len - last) * math.log(history_coefficient)
+        return self.biases[key]
+
+    def set_speakers(self, speakers):
+        """Set the history by the names of the characters who spoke last."""
+        index = {name: i for i, name in enumerate(self.names or [])}
+        self.set_history([index[speaker] for speaker in speakers if speaker in index])
+
     def prefer_char_probs(self, probs, history_coefficient = 2):
         probs = probs[..., -1, :]
         if (torch.argmax(probs) == self.newline):
             self.next_allowed = self.get_children_of_current()
             return F.softmax(torch.unsqueeze(probs, 0))
 
-        # TODO: plug in history
-        # Either softmax everything twice, or use signum for multiplication/division?
         if self.next_allowed is not None:
-            # Mask out everything but possible character names
-            new_output = torch.zeros_like(probs)
+            # Mask out everything but possible character names, prefer
+            # characters according to their last occurrence
+            node = self.current
             probs = F.softmax(probs)
-            new_output = new_output.fill_(0)
-            # Pre kazdu z povolenych postav zvyhodnit jej pravdepodobnosť podľa jej posledného výskytu
-            for i in self.next_allowed:
-                last_occurrence = self.find_last_occurrence(i)
-                new_output[i] = probs[i] * history_coefficient ** (10 - last_occurrence)
+            new_output = torch.zeros_like(probs)
+            new_output[..., node.allowed] = probs[..., node.allowed] * torch.exp(self.history_bias(node, history_coefficient))
             probs = new_output
-        
-        return(torch.unsqueeze(probs, 0))
 
-    def find_last_occurrence(self, subword_id):
-        last_occurrence = -1
-        self.current_character.append(subword_id)
-        for c, character in enumerate(self.character_history):
-            inc = True
-            # Check the sublist to make sure it is the right character path in trie
-            for j in range(len(self.current_character)):
-                if character[j] != self.current_character[j]:
-                    inc = False
-                    break
-            if inc:
-                last_occurrence = c
-        self.current_character.pop()
-        return last_occurrence
+        return(torch.unsqueeze(probs, 0))
 
     # Returns true at a newline, signal to classify the
     def set_next_allowed(self, token):
@@ -124,17 +156,70 @@ class trie():
             return False
         else:
             child = self.get_successor(token)
-            self.current_character.extend(token)
             if child is not None and child.value != self.colon:
                 self.next_allowed = self.get_children_of_current()
             else:
+                if child is not None:
+                    self.set_history(self.character_history + [min(child.characters)])
                 self.reset_current()
                 self.next_allowed = None
-                self.character_history.append(self.current_character)
-                self.current_character = []
-                self.character_history = self.character_history[-10:]
         return False
 
+
+class CharacterConstraint(LogitsProcessor):
+    """Only allow the names in the trie, followed by a colon, at the start of
+    the line, preferring characters who did not speak recently (see
+    trie.set_history()). After the colon, the line is not constrained.
+
+    line_start = position of the start of the line in the input ids
+    free_ids = tensor of further tokens allowed at the start of the line,
+    which end the constraint (e.g. brackets starting a scenic remark)
+    A new instance is used for each call of generate()."""
+
+    def __init__(self, char_trie, line_start, free_ids=None, history_coefficient=2):
+        self.trie = char_trie
+        self.line_start = line_start
+        self.free_ids = free_ids
+        self.history_coefficient = history_coefficient
+        # the trie node for each of the sequences, None if unconstrained
+        self.nodes = None
+
+    def step(self, node, token_id):
+        if node is None:
+            return None
+        child = node.get_child(token_id)
+        if child is None or child.value == self.trie.colon:
+            return None
+        return child
+
+    def __call__(self, input_ids, scores):
+        if self.nodes is None:
+            self.nodes = []
+            for ids in input_ids:
+                node = self.trie.root
+                for token_id in ids[self.line_start:].tolist():
+                    node = self.step(node, token_id)
+                self.nodes.append(node)
+        else:
+            # one token added since the last call
+            self.nodes = [self.step(node, token_id)
+                          for node, token_id in zip(self.nodes, input_ids[:, -1].tolist())]
+        for row, node in enumerate(self.nodes):
+            if node is None:
+                continue
+            allowed = node.allowed.to(scores.device)
+            values = scores[row, allowed] + self.trie.history_bias(node, self.history_coefficient).to(scores.device)
+            if node is self.trie.root and self.free_ids is not None:
+                free_ids = self.free_ids.to(scores.device)
+                free_values = scores[row, free_ids]
+                scores[row, :] = -float('inf')
+                scores[row, free_ids] = free_values
+            else:
+                scores[row, :] = -float('inf')
+            scores[row, allowed] = values
+        return scores
+
+
 def extract_character_names(prompt):
     characters = set()
     for line in prompt.split('\n'):
@@ -150,10 +235,14 @@ def build_trie(tokenizer, characters):
     # Create a trie of characters
     encoded_characters = []
 
+    characters = sorted(set(c.strip() for c in characters if c.strip()))
     if len(characters) == 0:
         return None
 
     for character in characters:
         encoded_characters.append(tokenizer.encode(character))
 
-    return trie(encoded_characters)
+    # GPT2 tokenizer eats whitespace at the boundaries
+    newline = tokenizer.encode('x\nx')[1]
+    colon = tokenizer.encode(':')[0]
+    return trie(encoded_characters, newline, colon, names=characters)
@@ -16,7 +16,8 @@ i18n.set('filename_format', '{locale}.{format}')
 i18n.load_path.append('i18')
 
 from keyops import compress_key, expand_key
-from cgi_common import load_config
+from cgi_common import load_config, fill_translations, REQUEST_TIMEOUT
+from sentence_split import sentence_split
 
 import logging
 logging.basicConfig(
@@ -29,8 +30,8 @@ DOWN = False
 username_display = 'demo_inputs'
 username_insert = 'demo_user'
 
-SERVER_ADDR, _ = load_config('config.json')
-SERVER_ADDR_SYN, _ = load_config('syn_config.json')
+SERVER_ADDR, _, _ = load_config('config.json')
+SERVER_ADDR_SYN, _, _ = load_config('syn_config.json')
 
 EOT = '<|endoftext|>'
 
@@ -685,13 +686,15 @@ def query_list_scenes(server_addr=SERVER_ADDR):
             json={
                 'list_scenes': 1,
                 'username_limit': username_display
-                }
+                },
+            timeout=REQUEST_TIMEOUT
             )
     return json_or_error(req, 'Could not list the scenes')
 
 def query_display_scene(key, server_addr=SERVER_ADDR):
     if '-' not in key:
         key += '-'
+    # no timeout, the server returns the text once it is all generated
     req = requests.post(
             server_addr,
             json={
@@ -699,7 +702,7 @@ def query_display_scene(key, server_addr=SERVER_ADDR):
                 'username': username_display
                 }
             )
-    return json_or_error(req, f'Could not display scene {key}')
+    return fill_translations(server_addr, json_or_error(req, f'Could not display scene {key}'))
 
 def query_add_human_input(human_input, key, input_type='human', server_addr=SERVER_ADDR):
     if '-' not in key:
@@ -716,9 +719,10 @@ def query_add_human_input(human_input, key, input_type='human', server_addr=SERV
                 'human_input': human_input,
                 'key': key,
                 'username': username_display,
-                'input_type': input_type}
+                'input_type': input_type},
+            timeout=REQUEST_TIMEOUT
             )
-    return json_or_error(req, f'Could not display scene {key}')
+    return fill_translations(server_addr, json_or_error(req, f'Could not display scene {key}'))
 
 # clean string obtained from input
 def cl(s):
@@ -730,28 +734,13 @@ def cl(s):
 
 def fix_diacritics(text):
     data = {'data': text, 'model': 'czech-diacritics_generator', 'suggestions': 1}
-    req = requests.post('http://lindat.mff.cuni.cz/services/korektor/api/suggestions', data)
+    req = requests.post('http://lindat.mff.cuni.cz/services/korektor/api/suggestions', data, timeout=10)
     if req.ok:
         return ''.join([chunk[-1] for chunk in req.json()['result']])
     else:
         logging.error(r'Korektor error: {req.status_code} {req.reason}')
         return text
 
-def sentence_split(text):
-    """Split text into a list of sentences."""
-    url = 'http://lindat.mff.cuni.cz/services/udpipe/api/process'
-    params = { 'tokenizer': 1,
-            'output': 'plaintext=normalized_spaces',
-            'data': text}
-    response = requests.post(url, data = params)
-    if response.ok:
-        response.encoding='utf8'
-        return [s for s in response.json()['result'].split('\n') if s]
-    else:
-        # Simple backup in case it fails
-        logging.error(r'Sentence split error: {response.status_code} {response.reason}')
-        return [s.strip()+'.' for s in text.split('.') if s.strip()]
-
 def query_add_scene(prompt, char1=None, line1=None, char2=None, line2=None,
         outline=None, key=None, server_addr=SERVER_ADDR):
     """Insert into DB
@@ -809,7 +798,7 @@ def query_add_scene(prompt, char1=None, line1=None, char2=None, line2=None,
             'outline': outline,
             'char1': char1,
             'char2': char2,
-            })
+            }, timeout=REQUEST_TIMEOUT)
 
     return json_or_error(req, f'Could not save scene')
 
@@ -940,7 +929,7 @@ elif PAGE in ('welcome1', 'welcome2'):
     scene_keys = sorted(data['scenes'].keys())
     for index, scene_key in enumerate(scene_keys):
         print_index_block(
-                data['scenes'][scene_key][L_+'prompt'],
+                data['scenes'][scene_key][L_+'prompt'] or data['scenes'][scene_key]['prompt'],
                 scene_key,
                 scene_keys[index-1],
                 scene_keys[(index+1) % len(scene_keys)],
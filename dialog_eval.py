@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Offline evaluation of generated dialogues: NLI consistency of characters,
+perplexity and n-gram statistics.
+
+Dialogues are read from files in the format of the generation experiments
+(Seed: N / From X to Y: "utterance" / ## as dialogue separator) or directly
+from the lines table of the story_server.py database. They are evaluated in
+chunks over a process pool, each chunk with batched NLI and LM calls, and
+the results are written to a TSV or JSONL file as they come.
+"""
+
+import json
+import multiprocessing
+import os
+import re
+import sys
+from argparse import ArgumentParser
+from collections import Counter
+
+import torch
+from torch.nn import functional as F
+from transformers import AutoTokenizer, AutoModelForCausalLM
+
+from keyops import split_into_parts
+from nli import NLI, NLI_BACKENDS
+
+# key commands, as in story_server.py
+CUT = '_'
+ADD = '.'
+REG = '~'
+
+COLUMNS = ['Id', 'NLI-score', 'Perplexity', '1gramVocabSize', '2gramVocabSize', 'WordsTotal', 'NumReplies']
+
+
+def new_dialog(dialog_id):
+    return {'id': dialog_id, 'characters': {}, 'replies': []}
+
+
+def add_reply(dialog, char_name, utterance):
+    dialog['characters'].setdefault(char_name, []).append(utterance)
+    dialog['replies'].append(utterance)
+
+
+def read_dialog_file(infile):
+    """Stream dialogues from a file with generated dialogues."""
+    dialog = new_dialog(0)
+    for line in infile:
+        line = line.strip()
+        # Skip empty lines
+        if not line:
+            continue
+        # Read the seed
+        elif line.startswith('Seed:'):
+            dialog['id'] = int(line.replace('Seed:', '').strip())
+        # Scene separator
+        elif line.startswith('##'):
+            if dialog['replies']:
+                yield dialog
+            dialog = new_dialog(dialog['id'])
+        # Dialog line, extract the character and the utterance
+        elif line.startswith('From'):
+            char_name = re.sub(r'From ([^ ]+) to.*', r'\1', line).strip()
+            utterance = re.sub(r'From[^:]+:', '', line).replace('"', '').strip()
+            add_reply(dialog, char_name, utterance)
+    if dialog['replies']:
+        yield dialog
+
+
+def replay_key(key, texts):
+    """Reconstruct the lines of the scene continuation given by the key the
+    same way as story_server.Server.get_text() does. Returns None if some of
+    the lines is not in texts (key -> text)."""
+    parts = split_into_parts(key)
+    cur_key = parts[0] + '-'
+    lines = []
+    for part in parts[1:]:
+        cur_key += part
+        if len(part) == 1:
+            command = None
+            position = len(lines)
+        else:
+            command = part[-1]
+            position = int(part[:-1])
+        if command == CUT:
+            lines[position] = ''
+            continue
+        elif command == ADD:
+            lines.insert(position, None)
+        elif command != REG:
+            lines.append(None)
+        if cur_key not in texts:
+            return None
+        lines[position] = texts[cur_key]
+    return lines
+
+
+def read_dialog_db(db_file, scene_prefix=''):
+    """Stream dialogues from the lines table; each stored continuation which
+    has not been continued any further is one dialogue."""
+    import dataset
+    db = dataset.connect('sqlite:///' + db_file)
+    texts = {row['key']: row['text'] for row in db.query('SELECT key, text FROM lines')}
+    keys = sorted(k for k in texts if k.startswith(scene_prefix))
+    for i, key in enumerate(keys):
+        if i + 1 < len(keys) and keys[i + 1].startswith(key):
+            # not a leaf
+            continue
+        try:
+            lines = replay_key(key, texts)
+        except (IndexError, ValueError, AssertionError):
+            # malformed key
+            continue
+        if lines is None:
+            continue
+        dialog = new_dialog(key)
+        for line in '\n'.join(lines).split('\n'):
+            if ':' not in line:
+                # empty line or scenic remark
+                continue
+            char_name, utterance = line.split(':', 1)
+            utterance = utterance.strip()
+            if char_name.strip() and utterance and not utterance.startswith(('[', '(')):
+                add_reply(dialog, char_name.strip(), utterance)
+        if dialog['replies']:
+            yield dialog
+
+
+def ngram_stats(words):
+    unigram = Counter(words)
+    bigram = Counter(zip(words, words[1:]))
+    return unigram, bigram
+
+
+# Models loaded in each pool worker
+_nli = None
+_lm = None
+_lm_tokenizer = None
+
+
+def init_worker(backend, lm_name, batch_size, device, threads):
+    global _nli, _lm, _lm_tokenizer
+    if threads:
+        torch.set_num_threads(threads)
+    _nli = NLI_BACKENDS[backend](batch_size=batch_size)
+    _nli.model.to(device)
+    _lm_tokenizer = AutoTokenizer.from_pretrained(lm_name)
+    _lm = AutoModelForCausalLM.from_pretrained(lm_name)
+    _lm.eval()
+    _lm.to(device)
+
+
+def perplexities(texts, batch_size):
+    """Perplexity of each text under the LM, in padded batches; texts longer
+    than the LM window are cut at the window length."""
+    max_len = _lm.config.n_positions if hasattr(_lm.config, 'n_positions') else _lm_tokenizer.model_max_length
+    encoded = [_lm_tokenizer.encode(text)[:max_len] for text in texts]
+    device = next(_lm.parameters()).device
+    result = [float('nan')] * len(texts)
+    order = sorted(range(len(encoded)), key=lambda i: len(encoded[i]))
+    for start in range(0, len(order), batch_size):
+        batch = [i for i in order[start:start + batch_size] if len(encoded[i]) > 1]
+        if not batch:
+            continue
+        batch_len = max(len(encoded[i]) for i in batch)
+        input_ids = torch.full((len(batch), batch_len), _lm_tokenizer.eos_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(batch), batch_len), dtype=torch.long)
+        for row, i in enumerate(batch):
+            input_ids[row, :len(encoded[i])] = torch.tensor(encoded[i])
+            attention_mask[row, :len(encoded[i])] = 1
+        input_ids = input_ids.to(device)
+        attention_mask = attention_mask.to(device)
+        with torch.inference_mode():
+            logits = _lm(input_ids=input_ids, attention_mask=attention_mask).logits
+            losses = F.cross_entropy(logits[:, :-1].transpose(1, 2), input_ids[:, 1:], reduction='none')
+            mask = attention_mask[:, 1:].float()
+            losses = (losses * mask).sum(dim=1) / mask.sum(dim=1)
+        for row, i in enumerate(batch):
+            result[i] = torch.exp(losses[row]).item()
+    return result
+
+
+def evaluate_chunk(dialogs):
+    """Evaluate a list of dialogues, with all NLI pairs of all dialogues
+    scored in one call and perplexities computed in batches."""
+    pairs = []
+    spans = []  # for each dialogue, list of (character, start, end) in pairs
+    for dialog in dialogs:
+        dialog_spans = []
+        for char_name, utterances in dialog['characters'].items():
+            start = len(pairs)
+            if len(utterances) >= 2:
+                pairs.extend(NLI.utterance_pairs(utterances))
+            dialog_spans.append((char_name, start, len(pairs)))
+        spans.append(dialog_spans)
+    scores = _nli.get_nli_scores(pairs) if pairs else []
+    perplexs = perplexities(['\n'.join(d['replies']) for d in dialogs], _nli.batch_size)
+
+    results = []
+    for dialog, dialog_spans, perplex in zip(dialogs, spans, perplexs):
+        char_scores = {}
+        for char_name, start, end in dialog_spans:
+            # 0.3 for characters with just one utterance, as in NLI.get_nli_score
+            char_scores[char_name] = sum(scores[start:end]) / (end - start) if end > start else 0.3
+        words = [w for reply in dialog['replies'] for w in reply.split(' ')]
+        unigram, bigram = ngram_stats(words)
+        results.append({
+            'Id': dialog['id'],
+            'NLI-score': sum(char_scores.values()) / len(char_scores),
+            'Perplexity': perplex,
+            '1gramVocabSize': len(unigram),
+            '2gramVocabSize': len(bigram),
+            'WordsTotal': len(words),
+            'NumReplies': len(dialog['replies']),
+            'characters': char_scores,
+            })
+    return results
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def write_results(outfile, results, out_format):
+    for result in results:
+        if out_format == 'jsonl':
+            print(json.dumps(result, ensure_ascii=False), file=outfile)
+        else:
+            print('\t'.join(f'{result[c]:5f}' if isinstance(result[c], float) else str(result[c])
+                            for c in COLUMNS), file=outfile)
+    outfile.flush()
+
+
+def evaluate(dialogs, out_file, backend='large', lm_name='gpt2', workers=1,
+             chunk_size=64, batch_size=32, device='cpu', out_format=None):
+    """Evaluate the dialogues, writing the results to out_file as each chunk
+    is finished. out_format is 'tsv' or 'jsonl'; by default guessed from the
+    file name."""
+    if out_format is None:
+        out_format = 'jsonl' if out_file.endswith('.jsonl') else 'tsv'
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    init_args = (backend, lm_name, batch_size, device, threads)
+    with open(out_file, 'w') as outfile:
+        if out_format == 'tsv':
+            print('\t'.join(COLUMNS), file=outfile)
+        chunks = chunked(dialogs, chunk_size)
+        if workers <= 1:
+            init_worker(*init_args)
+            for chunk in chunks:
+                write_results(outfile, evaluate_chunk(chunk), out_format)
+        else:
+            ctx = multiprocessing.get_context('spawn')
+            with ctx.Pool(workers, initializer=init_worker, initargs=init_args) as pool:
+                for results in pool.imap(evaluate_chunk, chunks):
+                    write_results(outfile, results, out_format)
+
+
+if __name__ == '__main__':
+    ap = ArgumentParser(description='Offline evaluation of generated dialogues')
+    ap.add_argument('inputs', nargs='*',
+                    help='Files with generated dialogues; default: STDIN (unless --database is given)')
+    ap.add_argument('-d', '--database',
+                    help='Evaluate dialogues stored in the lines table of this database')
+    ap.add_argument('-s', '--scene-prefix', default='',
+                    help='With --database, only evaluate keys starting with this prefix')
+    ap.add_argument('-o', '--output', required=True,
+                    help='Output file (.tsv or .jsonl)')
+    ap.add_argument('-b', '--backend', choices=sorted(NLI_BACKENDS.keys()), default='large',
+                    help='NLI backend')
+    ap.add_argument('-m', '--lm', default='gpt2',
+                    help='HuggingFace model for perplexity')
+    ap.add_argument('-w', '--workers', type=int, default=1,
+                    help='Number of worker processes')
+    ap.add_argument('-c', '--chunk-size', type=int, default=64,
+                    help='Number of dialogues per worker task')
+    ap.add_argument('-B', '--batch-size', type=int, default=32,
+                    help='Batch size for model calls')
+    ap.add_argument('-D', '--device', default='cpu',
+                    help='Device for the models (cpu, cuda)')
+    args = ap.parse_args()
+
+    def all_dialogs():
+        if args.database:
+            yield from read_dialog_db(args.database, args.scene_prefix)
+        elif not args.inputs:
+            yield from read_dialog_file(sys.stdin)
+        for input_file in args.inputs:
+            with open(input_file) as infile:
+                yield from read_dialog_file(infile)
+
+    evaluate(all_dialogs(), args.output, args.backend, args.lm, args.workers,
+             args.chunk_size, args.batch_size, args.device)
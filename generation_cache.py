@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Persistent cache of generated lines, shared by all the backend instances
+using the same file (e.g. all the servers listed in config.json, which run
+from the same directory).
+
+Generation is deterministic given the model, the encoded context, the seed
+derived from the key, the generation parameters and the forbidden lines, so
+the results are addressed by a hash of all these inputs. The seed only
+depends on the continuation part of the key (see story_server.key_seed()),
+so the same work is not repeated when a line is missing from the database,
+or for the same continuation of another scene with the same text; other
+continuations get other seeds and do not share entries.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from hashlib import sha1
+
+# Persistent generation cache file, None = no cache
+CACHE_FILE = os.environ.get('GENERATION_CACHE', 'generations.db')
+
+# Maximum number of cached results; the least recently used ones are evicted
+MAX_ENTRIES = 100000
+
+# The cache is trimmed to its maximum size once per this many results stored
+# (by each process), as it takes counting the entries
+EVICT_INTERVAL = 100
+
+# The statistics of the whole file (which need counting the entries) are
+# logged once per this many lookups
+STATS_INTERVAL = 100
+
+
+class GenerationCache:
+    """Persistent cache of generation results in an SQLite file, keyed by
+    the hash of the generation inputs, with size-bounded LRU eviction and
+    hit statistics (counted over all processes using the file, and by this
+    process in hits and misses)."""
+
+    def __init__(self, filename, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.puts = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        with self.lock:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS generations ('
+                    'hash TEXT PRIMARY KEY, result TEXT, last_used REAL, hits INTEGER)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS generations_last_used ON generations (last_used)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)')
+            self.conn.execute("INSERT OR IGNORE INTO stats VALUES ('hits', 0), ('misses', 0)")
+            self.conn.commit()
+
+    @staticmethod
+    def key(**inputs):
+        """The hash of the given generation inputs (JSON-serializable)."""
+        return sha1(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """The cached result for the key, None if not cached."""
+        with self.lock:
+            row = self.conn.execute('SELECT result FROM generations WHERE hash=?', (key,)).fetchone()
+            if row:
+                self.conn.execute('UPDATE generations SET last_used=?, hits=hits+1 WHERE hash=?',
+                                  (time.time(), key))
+            self.conn.execute('UPDATE stats SET value=value+1 WHERE name=?', ('hits' if row else 'misses',))
+            self.conn.commit()
+            if row:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return json.loads(row[0]) if row else None
+
+    def put(self, key, result):
+        """Store the result (JSON-serializable); every EVICT_INTERVAL results,
+        the least recently used results over the maximum size are evicted
+        (so the cache may exceed it by up to EVICT_INTERVAL per process)."""
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO generations VALUES (?, ?, ?, 0)',
+                              (key, json.dumps(result), time.time()))
+            self.puts += 1
+            if self.puts % EVICT_INTERVAL == 0:
+                count = self.conn.execute('SELECT COUNT(*) FROM generations').fetchone()[0]
+                if count > self.max_entries:
+                    self.conn.execute('DELETE FROM generations WHERE hash IN '
+                                      '(SELECT hash FROM generations ORDER BY last_used LIMIT ?)',
+                                      (count - self.max_entries,))
+            self.conn.commit()
+
+    def stats(self):
+        """Number of entries, hits, misses and the hit rate."""
+        with self.lock:
+            stats = dict(self.conn.execute('SELECT name, value FROM stats').fetchall())
+            stats['entries'] = self.conn.execute('SELECT COUNT(*) FROM generations').fetchone()[0]
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
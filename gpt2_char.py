@@ -8,12 +8,21 @@ Kdybyste tohle chtěli pouštět:
  -  pro nastavení CUDAy na clusteru sórsujte: . gpt2/set_cuda_10_1
  -  pokud nechcete, aby se vám do houmu stahovalo 7 GB modelu, symlinkujte si z ~/.cache/torch složku /net/data
 ELITR/gpt/gpt-2/transformers
+
+Prompts are processed in padded batches (--batch_size), with the past of
+the model kept between steps; each output is written as soon as its batch
+is done. At the start of each line, only the character names found in the
+prompt (followed by a colon) are allowed. Greedy decoding by default,
+--sample for sampling with --temp and --topp.
 """
 
 import torch
+from torch.nn import functional as F
 from transformers import GPT2Tokenizer, GPT2LMHeadModel
+from transformers import LogitsProcessorList, RepetitionPenaltyLogitsProcessor, TemperatureLogitsWarper, TopPLogitsWarper
 import numpy as np
-import re
+
+from char_support import build_trie, extract_character_names
 
 import logging
 logging.basicConfig(level=logging.INFO)
@@ -23,7 +32,7 @@ def set_seed(seed):
     torch.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)
 
-def setup(model_name):
+def setup(model_name, device='cuda'):
     tokenizer = GPT2Tokenizer.from_pretrained(model_name)
 
     # Load pre-trained model (weights)
@@ -34,118 +43,114 @@ def setup(model_name):
     model.eval()
 
     # If you have a GPU, put everything on cuda
-    model.to('cuda')
+    model.to(device)
 
     return tokenizer, model
 
-def generate_limit_chars(prompt, length, char_trie):
-    generated = tokenizer.encode(prompt)
-    context = torch.tensor([generated])
-    context = context.to('cuda')
+def get_newline_ids(tokenizer):
+    """Ids of all tokens ending with a newline (GPT2 has e.g. '\\n\\n' as one token)."""
+    return {i for i in range(len(tokenizer)) if tokenizer.decode([i]).endswith('\n')}
+
+
+class CharacterMask():
+    """Allows only the character names from the trie, followed by a colon,
+    at the start of each line; each sequence in the batch has its own trie
+    (None = no limits)."""
+
+    def __init__(self, tries, newline_ids, last_ids):
+        self.tries = tries
+        self.newline_ids = newline_ids
+        # the current trie node for each sequence, None if not at the start
+        # of a line (the prompt may end with a newline)
+        self.nodes = [None] * len(tries)
+        self.update(last_ids)
+
+    def __call__(self, scores):
+        for row, node in enumerate(self.nodes):
+            if node is not None and len(node.allowed):
+                allowed = node.allowed.to(scores.device)
+                values = scores[row, allowed]
+                scores[row, :] = -float('inf')
+                scores[row, allowed] = values
+        return scores
+
+    def update(self, tokens):
+        """Move to the next state after the given token for each sequence."""
+        for row, token in enumerate(tokens):
+            node = self.nodes[row]
+            if node is not None:
+                node = node.get_child(token)
+                if node is not None and (node.value == self.tries[row].colon or not node.children):
+                    # the name is complete
+                    node = None
+            elif token in self.newline_ids and self.tries[row] is not None:
+                node = self.tries[row].root
+            self.nodes[row] = node
+
+
+def generate_limit_chars(model, tokenizer, prompts, length, tries, newline_ids,
+                         sample=False, temp=1.0, top_p=0.9, r_penalty=1.0):
+    """Generate up to length tokens for each of the prompts in one batch;
+    returns the lists of generated ids. The length must leave room for at
+    least one token of the prompt within the model's n_positions."""
+    device = next(model.parameters()).device
+    eos = tokenizer.eos_token_id
+    # leave room for the generated tokens
+    max_prompt = model.config.n_positions - length
+    if max_prompt < 1:
+        raise ValueError('Cannot generate {} tokens with {} positions'.format(length, model.config.n_positions))
+    encoded = [([eos] + tokenizer.encode(prompt))[-max_prompt:] for prompt in prompts]
+
+    # pad from the left so that all the prompts end at the same position
+    width = max(len(ids) for ids in encoded)
+    input_ids = torch.full((len(encoded), width), eos, dtype=torch.long)
+    attention_mask = torch.zeros((len(encoded), width), dtype=torch.long)
+    for row, ids in enumerate(encoded):
+        input_ids[row, width - len(ids):] = torch.tensor(ids)
+        attention_mask[row, width - len(ids):] = 1
+    input_ids = input_ids.to(device)
+    attention_mask = attention_mask.to(device)
+    position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+
+    processors = LogitsProcessorList()
+    if r_penalty != 1.0:
+        processors.append(RepetitionPenaltyLogitsProcessor(r_penalty))
+    warpers = LogitsProcessorList([TemperatureLogitsWarper(temp), TopPLogitsWarper(top_p)])
+    char_mask = CharacterMask(tries, newline_ids, [ids[-1] for ids in encoded])
+
+    generated = input_ids
+    outputs = [[] for _ in encoded]
+    finished = torch.zeros(len(encoded), dtype=torch.bool, device=device)
     past = None
-    next_allowed = None
-
-    for i in range(length):
-        output, past = model(context, past=past)
-        output = output[..., -1, :]
-
-        if next_allowed is not None:
-            # Mask out everything but possible character names
-            new_output = torch.zeros_like(output)
-            new_output = new_output.fill_(-float('inf'))
-            for i in next_allowed:
-                new_output[i] = output[i]
-            output = new_output
+    with torch.inference_mode():
+        for _ in range(length):
+            output = model(input_ids=input_ids, past_key_values=past, attention_mask=attention_mask,
+                           position_ids=position_ids, use_cache=True)
+            past = output.past_key_values
+            scores = processors(generated, output.logits[:, -1, :])
+            scores = char_mask(scores)
+            if sample:
+                scores = warpers(generated, scores)
+                tokens = torch.multinomial(F.softmax(scores, dim=-1), num_samples=1).squeeze(1)
+            else:
+                tokens = torch.argmax(scores, dim=-1)
+            tokens = tokens.masked_fill(finished, eos)
 
-            token = torch.argmax(output)
+            token_list = tokens.tolist()
+            char_mask.update(token_list)
+            for row, token in enumerate(token_list):
+                if not finished[row]:
+                    outputs[row].append(token)
+            finished |= tokens == eos
+            if finished.all():
+                break
 
-            child = char_trie.get_successor(token)
-            if child is not None and child.value != 25:
-                next_allowed = char_trie.get_children_of_current()
-            else:
-                char_trie.reset_current()
-                next_allowed = None
-        else:
-            token = torch.argmax(output)
-            if token == char_trie.newline:
-                next_allowed = char_trie.get_children_of_current()
-
-        generated += [token.tolist()]
-        context = token.unsqueeze(0)
-
-    sequence = tokenizer.decode(generated)
-
-    return(sequence)
-
-class trie_node():
-    def __init__(self, value = None):
-        self.value = value
-        self.children = set()
-
-    def add_child(self, value):
-        child = self.get_child(value)
-        if child is not None:
-            return child
-        else:
-            child = trie_node(value)
-            self.children.add(child)
-            return child
-
-    def get_child(self, value):
-        for child in self.children:
-            if child.value == value:
-                return child
-        return None
-
-    def get_children_values(self):
-        values = []
-        for child in self.children:
-            values.append(child.value)
-        return values
-
-    def print_node(self, _prefix="", _last=True):
-        print(_prefix, "`- " if _last else "|- ", self.value, sep="")
-        children = self.get_children_values()
-        _prefix += "   " if _last else "|  "
-        child_count = len(children)
-        for i, child in enumerate(children):
-            _last = i == (child_count - 1)
-            self.get_child(child).print_node(_prefix, _last)
-
-
-class trie():
-    # List containing lists containing encoded characters
-    def __init__(self, char_list):
-        self.newline = 198  #198 is an encoded newline
-        self.root = trie_node(self.newline)
-
-        for character in char_list:
-            self.current = self.root
-            for subword in character:
-                self.add_child_to_current(subword)
-
-        self.current = self.root
-
-    def reset_current(self):
-        self.current = self.root
-
-    def add_child_to_current(self, value):
-        self.current = self.current.add_child(value)
-
-    def get_successor(self, value):
-        child = self.current.get_child(value)
-        if child is not None:
-            self.current = child
-        else:
-            self.current = self.root
-        return child
-
-    def get_children_of_current(self):
-        return self.current.get_children_values()
-
-    def print_trie(self):
-        self.root.print_node()
+            generated = torch.cat((generated, tokens.unsqueeze(1)), dim=1)
+            input_ids = tokens.unsqueeze(1)
+            attention_mask = torch.cat((attention_mask, torch.ones_like(input_ids)), dim=1)
+            position_ids = position_ids[:, -1:] + 1
 
+    return outputs
 
 
 if __name__ == "__main__":
@@ -159,52 +164,46 @@ if __name__ == "__main__":
     parser.add_argument("--model", type=str, default='gpt2')
     parser.add_argument("--prompts_dir", type=str, default=None)
     parser.add_argument("--out_dir", type=str, default=None)
-    parser.add_argument("--sequences", type=int, default=1)
     parser.add_argument("--rpenalty", type=float, default=1.0)
     parser.add_argument("--topp", type=float, default=0.9)
     parser.add_argument("--temp", type=float, default=1.0)
+    parser.add_argument("--sample", action='store_true', help="Sample instead of greedy decoding")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
 
     args = parser.parse_args()
 
     if args.prompts_dir is None:
+        infiles = [None]
         prompts = [sys.stdin.read()]
-        files = [sys.stdout]
     else:
         import os
-        infiles = os.listdir(args.prompts_dir)
+        infiles = sorted(os.listdir(args.prompts_dir))
         prompts = [open(args.prompts_dir + '/' + f).read() for f in infiles]
-        if args.out_dir is None:
-            files = [sys.stdout] * len(prompts)
-        else:
-            files = [open(args.out_dir + '/' + f, 'w') for f in infiles]
 
-    tokenizer, model = setup(args.model)
+    tokenizer, model = setup(args.model, args.device)
+    if args.length >= model.config.n_positions:
+        parser.error("--length must be less than the model's n_positions ({})".format(model.config.n_positions))
+    newline_ids = get_newline_ids(tokenizer)
+    set_seed(args.seed)
 
-    for prompt, out in zip(prompts, files):
+    for start in range(0, len(prompts), args.batch_size):
+        batch = prompts[start:start + args.batch_size]
+        batch_files = infiles[start:start + args.batch_size]
 
-        # Create a trie of characters
-        characters = set()
-        encoded_characters = []
-        for line in prompt.split('\n'):
-            # filter out scenic remarks
-            if "[" in line or "]" in line or "/" in line:
-                continue
-            characters.add(re.sub(":.*", ":", line))  # Keeping the colon to make sure nothing will be appended to the character name
-
-        for character in characters:
-            encoded_characters.append(tokenizer.encode(character))
-
-        char_trie = trie(encoded_characters)
+        # Create a trie of characters for each prompt
+        tries = [build_trie(tokenizer, extract_character_names(prompt)) for prompt in batch]
 
         # Generate
-        context = tokenizer.encode(prompt)
-        context = [tokenizer.eos_token_id] + context
-        start_from = len(context)
-        context = torch.tensor([context])
-        context = context.to('cuda')
-
-        output_sequences = generate_limit_chars(prompt, args.length, char_trie)
-        print(output_sequences, file=out)
-
-        if len(files) > 1:
-            out.close()
+        outputs = generate_limit_chars(model, tokenizer, batch, args.length, tries, newline_ids,
+                                       sample=args.sample, temp=args.temp, top_p=args.topp,
+                                       r_penalty=args.rpenalty)
+
+        for prompt, infile, output in zip(batch, batch_files, outputs):
+            sequence = prompt + tokenizer.decode(output)
+            if args.out_dir is None or infile is None:
+                print(sequence, flush=True)
+            else:
+                with open(args.out_dir + '/' + infile, 'w') as out:
+                    print(sequence, file=out)
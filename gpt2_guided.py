@@ -3,29 +3,37 @@
 
 """
 Kdybyste tohle chtěli pouštět:
- - pre guided_generate zatial treba nainstalovat nltk
- - bolo to spúštané na CPU tak gpu-related kod je zakomentovaný
  - funguje len pre default argument sequences == 1
 
  -  -h vypisuje parametry
  -  virtuální environment s nainstalovaným torchem je gpt2/venv-gpt-2
  -  pro nastavení CUDAy na clusteru sórsujte: . gpt2/set_cuda_10_1
  -  pokud nechcete, aby se vám do houmu stahovalo 7 GB modelu, symlinkujte si z ~/.cache/torch složku /net/data/ELITR/gpt/gpt-2/transformers
+
+Prompts are processed in padded batches (--batch_size); see guided_generate()
+for how the replies are generated.
 """
 
+import random
+
 import torch
+from torch.nn import functional as F
 from transformers import GPT2Tokenizer, GPT2LMHeadModel
+from transformers import LogitsProcessorList, RepetitionPenaltyLogitsProcessor
+from transformers import TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
 import numpy as np
 
+from sentence_split import UNBREAKING
+
 import logging
 logging.basicConfig(level=logging.INFO)
 
 def set_seed(seed):
     np.random.seed(seed)
     torch.manual_seed(seed)
-    # torch.cuda.manual_seed_all(seed)
+    torch.cuda.manual_seed_all(seed)
 
-def setup(model_name):
+def setup(model_name, device='cpu'):
     tokenizer = GPT2Tokenizer.from_pretrained(model_name)
 
     # Load pre-trained model (weights)
@@ -36,7 +44,7 @@ def setup(model_name):
     model.eval()
 
     # If you have a GPU, put everything on cuda
-    # model.to('cuda')
+    model.to(device)
 
     return tokenizer, model
 
@@ -90,109 +98,140 @@ def generate(model, tokenizer, context, max_len, sequences, greedy=False, beam=1
 
 
 
-def guided_generate(model, tokenizer, context, max_len, sequences, greedy=False, beam=1, r_penalty=1.0, top_p=0.9, temp=1.0):
-    ############## Utilites
-
-    def show(tensor):
-        """ prints tensor to stdout in readable form """
-        print(tokenizer.decode(tensor.squeeze(), clean_up_tokenization_spaces=True))
-
-
-    # adds a character into context tensor to speak next
-    def add_random_character(con,char_set):
-        """ con is pytorch tensor of gpt-context """
-        con2 = con.squeeze()
-        con2 = con2.tolist() + tokenizer.encode('\n' + random.sample(char_set,1)[0]+': ')
-        return torch.tensor([con2])
-
-
-
-    # assumes prompts to be formated --> JOHN: Lorem ipsum\n
-    def extract_characters(id_seq):
-        """ Returns a set of string corresponding to characters from id_seq tensor """
-        string = tokenizer.decode(id_seq.squeeze()[1:], clean_up_tokenization_spaces=True)
-        characters = set([x.split(':')[0] for x in string.split('\n') if x.find(':')!=-1 ])
-        return characters
-
-
-    # TODO: check if the string is a reply or a scenic remark?
-    def ok(string):
-        return True
-
-    ##############
-
-    from nltk import tokenize
-    import random
-    import re
-
-
-
-
-    REPLY_MAX_LEN=50
-    NUM_REPLIES= max_len // REPLY_MAX_LEN
-    FIRST=True
-    random.seed(123)
+REPLY_MAX_LEN = 50
 
-    characters=extract_characters(context)
-    context2=context
 
-    for y in range(NUM_REPLIES):
-        i=0
-        FIRST=True
-        while FIRST or not ok(reply):
-            FIRST=False
-            i+=1
+def extract_characters(prompt):
+    """The names of the characters in the prompt; assumes lines formatted
+    as JOHN: Lorem ipsum"""
+    return sorted(set(line.split(':')[0] for line in prompt.split('\n') if ':' in line))
 
 
-            context2 = add_random_character(context2,characters)
+def guided_generate(model, tokenizer, prompts, length, greedy=False, r_penalty=1.0, top_p=0.9, temp=1.0, seed=123):
+    """Generate length // REPLY_MAX_LEN replies for each of the prompts in
+    one batch. Each reply is spoken by a random character of the prompt and
+    ends after its first sentence.
 
-            context_len = context2.shape[1]
+    The past of the model is kept between the replies: the tokens sampled
+    after the end of a reply stay in the past, but are masked out. When the
+    window is full, it is moved so that only the last tokens are kept and
+    the past is computed again for them. Returns the lists of generated ids."""
+    device = next(model.parameters()).device
+    eos = tokenizer.eos_token_id
+    n_positions = model.config.n_positions
+    # number of last tokens kept when moving the window
+    keep = max(n_positions - 4 * REPLY_MAX_LEN, n_positions // 2)
+    rng = random.Random(seed)
+    newline = tokenizer.encode('\n')
 
-            # crashes when context is too long
-            # should be remade so context starts shrinking from the start
-            if context_len + REPLY_MAX_LEN > 1023:
-                return [output_sequences]
+    characters = [extract_characters(prompt) for prompt in prompts]
+    contexts = [[eos] + tokenizer.encode(prompt) for prompt in prompts]
+    start_from = [len(context) for context in contexts]
 
-            output_sequences = model.generate(
-                   input_ids=context2,
-                   max_length=context_len + REPLY_MAX_LEN,
-                   temperature=temp,
-                   top_k=50,
-                   top_p=top_p,
-                   repetition_penalty=r_penalty,
-                   do_sample= (not greedy) or beam > 1,
-                   num_beams=beam,
-                   num_return_sequences=sequences)
-            if len(output_sequences.shape) > 2:
-                output_sequences.squeeze_()
+    processors = LogitsProcessorList()
+    if r_penalty != 1.0:
+        processors.append(RepetitionPenaltyLogitsProcessor(r_penalty))
+    warpers = LogitsProcessorList([TemperatureLogitsWarper(temp), TopKLogitsWarper(50), TopPLogitsWarper(top_p)])
 
-
-            # cut out sentence_reply from the generated sequence with nltk sentence tokenizer.
-            gen_seq = output_sequences.squeeze_().tolist()[context_len :]
-            gen_str = tokenizer.decode(gen_seq,clean_up_tokenization_spaces=True)
-
-
-            # remove nested scenic remarks
-            re.sub(r"[\(\[\{].*?[\)\]\}]", '', gen_str)
-            re.sub(r"[\(\[\{].*?[\)\]\}]", '', gen_str)
-            re.sub(r"[\(\[\{].*?[\)\]\}]", '', gen_str)
-
-            # first sentence is the reply
-            reply = tokenize.sent_tokenize(gen_str)[0]
-            if ok(reply):
-                encoded_reply = tokenizer.encode(reply)
-                context_tmp=torch.tensor([context2.squeeze().tolist() +encoded_reply])
-                context_len = context_tmp.shape[1]
-                context2=context_tmp
-            else:
-                pass
-                # change seed?
-
-
-
-    if len(output_sequences.shape) > 2:
-        output_sequences.squeeze_()
-    return [output_sequences]
+    # positions[row] = number of tokens of the row in the past (without the
+    # masked ones), pending[row] = tokens of the context not yet in the past
+    past = None
+    attention_mask = torch.zeros((len(prompts), 0), dtype=torch.long, device=device)
+    positions = [0] * len(prompts)
+    pending = [list(context) for context in contexts]
+
+    def left_pad(rows, width):
+        ids = torch.full((len(rows), width), eos, dtype=torch.long)
+        for row, tokens in enumerate(rows):
+            if tokens:
+                ids[row, width - len(tokens):] = torch.tensor(tokens)
+        return ids
+
+    def feed(pending):
+        """Add the pending tokens to the past, left-padded; returns the
+        logits for the next token."""
+        nonlocal past, attention_mask
+        width = max(len(tokens) for tokens in pending)
+        input_ids = left_pad(pending, width)
+        block_mask = torch.zeros_like(input_ids)
+        position_ids = torch.zeros_like(input_ids)
+        for row, tokens in enumerate(pending):
+            block_mask[row, width - len(tokens):] = 1
+            position_ids[row, width - len(tokens):] = torch.arange(positions[row], positions[row] + len(tokens))
+            positions[row] += len(tokens)
+        attention_mask = torch.cat((attention_mask, block_mask.to(device)), dim=1)
+        output = model(input_ids=input_ids.to(device), past_key_values=past, attention_mask=attention_mask,
+                       position_ids=position_ids.to(device), use_cache=True)
+        past = output.past_key_values
+        return output.logits[:, -1, :]
+
+    def add_token(reply, token):
+        """Add the token to the reply; returns True if the reply is finished."""
+        text = tokenizer.decode([token])
+        if '\n' in text:
+            # the next character is added by us
+            return True
+        reply.append(token)
+        if any(c in text for c in '.!?'):
+            return not UNBREAKING.match(tokenizer.decode(reply)[-9:])
+        return False
+
+    with torch.inference_mode():
+        for _ in range(length // REPLY_MAX_LEN):
+            # add a character to speak next
+            for row, names in enumerate(characters):
+                prefix = tokenizer.encode('\n' + rng.choice(names) + ': ') if names else newline
+                contexts[row] += prefix
+                pending[row] += prefix
+
+            # the past also holds the left padding and the masked tokens, so
+            # its width counts, not the positions
+            if attention_mask.shape[1] + max(len(tokens) for tokens in pending) + REPLY_MAX_LEN > n_positions:
+                # move the window, compute the past again
+                past = None
+                attention_mask = attention_mask[:, :0]
+                positions = [0] * len(prompts)
+                pending = [context[-keep:] for context in contexts]
+
+            logits = feed(pending)
+            pending = [[] for _ in prompts]
+            history = left_pad([context[-positions[row]:] for row, context in enumerate(contexts)],
+                               max(positions)).to(device)
+            step_positions = torch.tensor(positions, device=device).unsqueeze(1)
+
+            replies = [[] for _ in prompts]
+            finished = [False] * len(prompts)
+            for step in range(REPLY_MAX_LEN):
+                scores = processors(history, logits)
+                if greedy:
+                    tokens = torch.argmax(scores, dim=-1)
+                else:
+                    scores = warpers(history, scores)
+                    tokens = torch.multinomial(F.softmax(scores, dim=-1), num_samples=1).squeeze(1)
+                for row, token in enumerate(tokens.tolist()):
+                    if not finished[row]:
+                        finished[row] = add_token(replies[row], token)
+                if all(finished) or step == REPLY_MAX_LEN - 1:
+                    break
+
+                history = torch.cat((history, tokens.unsqueeze(1)), dim=1)
+                attention_mask = torch.cat((attention_mask, attention_mask.new_ones((len(prompts), 1))), dim=1)
+                output = model(input_ids=tokens.unsqueeze(1), past_key_values=past, attention_mask=attention_mask,
+                               position_ids=step_positions + step, use_cache=True)
+                past = output.past_key_values
+                logits = output.logits[:, -1, :]
+
+            # the first `step` sampled tokens are in the past; mask out those
+            # after the end of the reply, keep the rest of the reply pending
+            width = attention_mask.shape[1]
+            for row, reply in enumerate(replies):
+                if len(reply) < step:
+                    attention_mask[row, width - step + len(reply):] = 0
+                positions[row] += min(len(reply), step)
+                pending[row] = reply[step:]
+                contexts[row] += reply
+
+    return [context[start:] for context, start in zip(contexts, start_from)]
 
 
 if __name__ == "__main__":
@@ -210,43 +249,35 @@ if __name__ == "__main__":
     parser.add_argument("--rpenalty", type=float, default=1.0)
     parser.add_argument("--topp", type=float, default=0.9)
     parser.add_argument("--temp", type=float, default=1.0)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=123)
+    parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
 
     args = parser.parse_args()
 
     if args.prompts_dir is None:
+        infiles = [None]
         prompts = [sys.stdin.read()]
-        files = [sys.stdout]
     else:
         import os
-        infiles = os.listdir(args.prompts_dir)
+        infiles = sorted(os.listdir(args.prompts_dir))
         prompts = [open(args.prompts_dir + '/' + f).read() for f in infiles]
-        if args.out_dir is None:
-            files = [sys.stdout] * len(prompts)
-        else:
-            files = [open(args.out_dir + '/' + f, 'w') for f in infiles]
-
-    tokenizer, model = setup(args.model)
-
-    for prompt, out in zip(prompts, files):
-        context = tokenizer.encode(prompt)
-        context = [tokenizer.eos_token_id] + context
-        start_from = len(context)
-        context = torch.tensor([context])
-
-        # context = context.to('cuda')
-
-        output_sequences = guided_generate(model, tokenizer, context, \
-                start_from + args.length, 1, \
-                r_penalty=args.rpenalty, top_p=args.topp, \
-                )
-        generated_sequences = []
-
-        for generated_sequence_idx, generated_sequence in enumerate(output_sequences):
-            print("=== GENERATED SEQUENCE {} ===".format(generated_sequence_idx + 1), file=out)
-            generated_sequence = generated_sequence.tolist()[start_from :]
-
-            # Decode text
-            text = tokenizer.decode(generated_sequence, clean_up_tokenization_spaces=True)
-            print(text, file=out)
-        if len(files) > 1:
-            out.close()
+
+    tokenizer, model = setup(args.model, args.device)
+    set_seed(args.seed)
+
+    for start in range(0, len(prompts), args.batch_size):
+        batch = prompts[start:start + args.batch_size]
+        batch_files = infiles[start:start + args.batch_size]
+
+        outputs = guided_generate(model, tokenizer, batch, args.length,
+                                  r_penalty=args.rpenalty, top_p=args.topp, temp=args.temp,
+                                  seed=args.seed + start)
+
+        for infile, output in zip(batch_files, outputs):
+            text = "=== GENERATED SEQUENCE 1 ===\n" + tokenizer.decode(output, clean_up_tokenization_spaces=True)
+            if args.out_dir is None or infile is None:
+                print(text, flush=True)
+            else:
+                with open(args.out_dir + '/' + infile, 'w') as out:
+                    print(text, file=out)
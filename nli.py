@@ -1,106 +1,265 @@
 #!/usr/bin/env python
+import logging
+import multiprocessing
 import re
 import sys
+from collections import OrderedDict
+from hashlib import sha1
 
-from transformers import RobertaTokenizer, RobertaForSequenceClassification, AutoModelForSequenceClassification
+from logzero import logger, loglevel
+
+from transformers import AutoTokenizer, AutoModelForSequenceClassification
 import torch.nn.functional as F
 import torch
 #from metrics import metrics
 
 
 class NLI:
-    def __init__(self):
-        self.tokenizer = RobertaTokenizer.from_pretrained('roberta-large-mnli')
-        self.model = AutoModelForSequenceClassification.from_pretrained('roberta-large-mnli')
-        self.label_map = {'contradiction': 0, 'neutral': 1, 'entailment': 2}
-        self.max_len = 512
+    """NLI backend: a cross-encoder MNLI model scoring (previous, utterance)
+    pairs by the probability of neutrality.
+
+    Subclasses select the model; threshold is the score under which an
+    utterance is rejected, calibrated for the given model (see
+    nli_benchmark.py), None if not calibrated yet (it must then be given
+    explicitly, see backend_threshold())."""
+
+    model_name = 'roberta-large-mnli'
+    threshold = 0.40
+    quantize = False
+
+    def __init__(self, batch_size=16, cache_size=4096):
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        self.model = AutoModelForSequenceClassification.from_pretrained(self.model_name)
+        self.model.eval()
+        if self.quantize:
+            # int8 weights for the linear layers, activations quantized on
+            # the fly (CPU only)
+            self.model = torch.quantization.quantize_dynamic(
+                    self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        # label order differs between models
+        self.label_map = {label.lower(): idx for label, idx in self.model.config.label2id.items()}
+        self.max_len = min(self.tokenizer.model_max_length, 512)
         self.replace_rule = re.compile(r' ?[^ ]+ ')
+        # number of pairs run through the model at once (bounds peak memory)
+        self.batch_size = batch_size
+        # LRU cache of computed scores, keyed by the hash of the pair
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
         seed = 42
         torch.manual_seed(seed)
 
-    def get_single_nli_score(self, previous, utterance):
-        prompt = previous + '</s></s>' + utterance
-        previous += ' ' + utterance
-        ids = self.tokenizer(prompt, return_tensors="pt")#[-self.max_len:]
-        if len(ids['input_ids'][0] > self.max_len):
-            input_ids = ids['input_ids'][0][-self.max_len:]
-            input_ids = torch.unsqueeze(input_ids, 0)
-            attention_mask = ids['attention_mask'][0][-self.max_len:]
-            attention_mask = torch.unsqueeze(attention_mask, 0)
-        output = self.model(input_ids=input_ids, attention_mask=attention_mask, return_dict=True)
-        #output = self.model(**ids, return_dict=True)
-        output = F.softmax(output.logits, dim=1)
+    @staticmethod
+    def pair_hash(previous, utterance):
+        return sha1((previous + '\0' + utterance).encode('utf-8')).digest()
+
+    def cache_get(self, key):
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        return None
+
+    def cache_put(self, key, value):
+        self.cache[key] = value
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def encode_pair(self, previous, utterance):
+        """Encode the pair; if the input is too long, the beginning of
+        previous is cut off (the utterance is never cut off)."""
+        previous_ids = self.tokenizer.encode(previous, add_special_tokens=False)
+        utterance_ids = self.tokenizer.encode(utterance, add_special_tokens=False)
+        available = self.max_len - self.tokenizer.num_special_tokens_to_add(pair=True) - len(utterance_ids)
+        previous_ids = previous_ids[-available:] if available > 0 else []
+        utterance_ids = utterance_ids[:self.max_len - self.tokenizer.num_special_tokens_to_add(pair=True)]
+        return self.tokenizer.build_inputs_with_special_tokens(previous_ids, utterance_ids)
+
+    def run_batch(self, encoded):
+        """Run the model on a list of encoded pairs in one padded batch,
+        return the neutral probabilities as a list of floats."""
+        batch_len = max(len(ids) for ids in encoded)
+        input_ids = torch.full((len(encoded), batch_len), self.tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(encoded), batch_len), dtype=torch.long)
+        for i, ids in enumerate(encoded):
+            input_ids[i, :len(ids)] = torch.tensor(ids)
+            attention_mask[i, :len(ids)] = 1
+        device = next(self.model.parameters()).device
+        with torch.inference_mode():
+            output = self.model(input_ids=input_ids.to(device), attention_mask=attention_mask.to(device), return_dict=True)
+            output = F.softmax(output.logits, dim=1)
         # We want to encourage neutrality
-        result = output[0][self.label_map['neutral']]
-        return result
+        return output[:, self.label_map['neutral']].tolist()
+
+    def get_nli_scores(self, pairs):
+        """Score a list of (previous, utterance) pairs, return a list of
+        scores in the same order. Cached pairs are not recomputed, the rest is
+        scored in padded batches of self.batch_size pairs."""
+        scores = [None] * len(pairs)
+        todo = {}  # pair hash -> (encoded pair, positions in the output)
+        for i, (previous, utterance) in enumerate(pairs):
+            key = self.pair_hash(previous, utterance)
+            cached = self.cache_get(key)
+            if cached is not None:
+                scores[i] = cached
+            elif key in todo:
+                todo[key][1].append(i)
+            else:
+                todo[key] = (self.encode_pair(previous, utterance), [i])
+
+        # Sort by length so that the pairs in one batch need little padding
+        keys = sorted(todo.keys(), key=lambda k: len(todo[k][0]))
+        for start in range(0, len(keys), self.batch_size):
+            batch_keys = keys[start:start + self.batch_size]
+            results = self.run_batch([todo[k][0] for k in batch_keys])
+            for key, result in zip(batch_keys, results):
+                self.cache_put(key, result)
+                for i in todo[key][1]:
+                    scores[i] = result
+        return scores
+
+    def get_single_nli_score(self, previous, utterance):
+        return self.get_nli_scores([(previous, utterance)])[0]
+
+    @staticmethod
+    def utterance_pairs(utterances):
+        """Pairs comparing each utterance with the first one (as the
+        original sequential scoring did)."""
+        return [(utterances[0], utterance) for utterance in utterances[1:]]
 
-    
     def get_nli_score(self, utterances):
         if len(utterances) < 2:
             print('Only one utterance!')
             print(utterances)
             return 0.3 # Hopefully this doesn't happen too often
-        previous = ''
-        score = 0.0
-        for utterance in utterances:
-            if previous == '':
-                previous = utterance
-            else:
-                result = self.get_single_nli_score(previous, utterance) 
-                score += result
-                #print(f'{prompt}\t{result}')
+        # All the comparisons are scored in one go
+        score = sum(self.get_nli_scores(self.utterance_pairs(utterances)))
         return score/(len(utterances) - 1) # We want to average by the number of comparisons made, not the number of utterances
 
+class LargeNLI(NLI):
+    """The original roberta-large-mnli model (355M parameters)."""
+    model_name = 'roberta-large-mnli'
+    threshold = 0.40
+
+
+class DistilledNLI(NLI):
+    """Distilled RoBERTa cross-encoder trained on SNLI+MNLI (82M parameters),
+    several times faster than the large model on CPU."""
+    model_name = 'cross-encoder/nli-distilroberta-base'
+    threshold = None
+
+
+class QuantizedNLI(NLI):
+    """The large model with int8 dynamically quantized linear layers; for
+    CPU-only nodes."""
+    model_name = 'roberta-large-mnli'
+    threshold = None
+    quantize = True
+
+
+NLI_BACKENDS = {
+        'large': LargeNLI,
+        'distilled': DistilledNLI,
+        'quantized': QuantizedNLI,
+        }
+
+
+def backend_threshold(backend, threshold=None):
+    """The rejection threshold to use with the backend (key into
+    NLI_BACKENDS): the given one, or the one calibrated for the backend.
+    Raises ValueError if the backend is not calibrated and no threshold is
+    given."""
+    if threshold is None:
+        threshold = NLI_BACKENDS[backend].threshold
+    if threshold is None:
+        raise ValueError('No calibrated threshold for the {} NLI backend, '
+                         'calibrate it with nli_benchmark.py and set it explicitly'.format(backend))
+    return threshold
+
+
+class NLIWorker(multiprocessing.Process):
+    """Process running the NLI model, so that NLI scoring runs in parallel
+    with generation.
+
+    Receives (job_id, pairs) tuples, sends back (job_id, scores). All the
+    requests waiting in the pipe are scored together in one batch.
+
+    backend = key into NLI_BACKENDS"""
+
+    def __init__(self, conn, backend='large', log_level=logging.DEBUG):
+        super(NLIWorker, self).__init__()
+        self.conn = conn
+        self.backend = backend
+        self.log_level = log_level
+
+    def run(self):
+        loglevel(self.log_level)
+        logger.info('NLI WORKER: Loading {} model'.format(self.backend))
+        nli = NLI_BACKENDS[self.backend]()
+        logger.info('NLI WORKER: Model loaded.')
+        while True:
+            jobs = [self.conn.recv()]
+            while self.conn.poll():
+                jobs.append(self.conn.recv())
+            pairs = [pair for _, job_pairs in jobs for pair in job_pairs]
+            try:
+                scores = nli.get_nli_scores(pairs)
+            except Exception as e:
+                logger.exception('NLI WORKER ERROR: {}'.format(e))
+                # do not block the generation, let everything pass
+                scores = [1.0] * len(pairs)
+            for job_id, job_pairs in jobs:
+                self.conn.send((job_id, scores[:len(job_pairs)]))
+                scores = scores[len(job_pairs):]
+
+
+class NLIClient:
+    """Generator-side handle to the NLIWorker: submit() returns immediately
+    with a job id, collect() waits for the scores.
+
+    threshold = rejection threshold of the worker's backend"""
+
+    def __init__(self, conn, threshold=NLI.threshold):
+        self.conn = conn
+        self.threshold = threshold
+        self.next_job_id = 0
+        self.results = dict()
+        self.discarded = set()
+
+    def submit(self, pairs):
+        job_id = self.next_job_id
+        self.next_job_id += 1
+        self.conn.send((job_id, pairs))
+        return job_id
+
+    def collect(self, job_id):
+        while job_id not in self.results:
+            result_id, scores = self.conn.recv()
+            if result_id in self.discarded:
+                self.discarded.remove(result_id)
+            else:
+                self.results[result_id] = scores
+        return self.results.pop(job_id)
+
+    def discard(self, job_id):
+        """We are not interested in the result of the job anymore."""
+        if self.results.pop(job_id, None) is None:
+            self.discarded.add(job_id)
+
+    def get_nli_scores(self, pairs):
+        return self.collect(self.submit(pairs))
+
+    def get_single_nli_score(self, previous, utterance):
+        return self.get_nli_scores([(previous, utterance)])[0]
+
+
 def process_dialog_data():
+    """Evaluate the dialogues in the file given as the first argument, write
+    the results to out_nli_<file>. See dialog_eval.py for more options."""
+    import dialog_eval
     input_file = sys.argv[1]
-    nli = NLI()
-    outfile = open('out_nli_' + input_file, 'w')
-    outfile.write('Seed\tNLI-score\tPerplexity\t1gramVocabSize\t2gramVocabSize\tWordsTotal\tNumReplies\n')
-    outfile.close()
-    with open (input_file, 'r') as infile:
-        curr_seed = 0
-        curr_dialog = dict()
-        all_utterances = []
-        num_replies = 0
-        for line in infile:
-            # Skip empty lines
-            if len(line) < 1:
-                continue
-            # Read the seed
-            elif line.startswith('Seed:'):
-                curr_seed = int(line.replace('Seed: ', '').strip())
-            # Scene separator, evaluate
-            elif line.startswith('##'):
-                print(f'Evaluating dialog with seed {curr_seed}.')
-                sum_per_dialog = 0.0
-                # Compute consistency per character
-                for char in curr_dialog.keys():
-                    score = nli.get_nli_score(curr_dialog[char])
-                    sum_per_dialog += score
-                    #print(f'Consistency of character {char}: {score:5f}')
-                # Compute dialog average
-                avg = sum_per_dialog / len(curr_dialog.keys())
-                """perplex, unigram, bigram = metrics(all_utterances)
-                print(f'Average consistency per dialog: {avg:5f}')
-                outfile = open('out_nli' + input_file, 'a')
-                outfile.write(f'{curr_seed}\t{avg:5f}\t{perplex:5f}\t{len(unigram.keys())}\t{len(bigram.keys())}\t{len(all_utterances)}\t{num_replies}\n')
-                outfile.close() """
-
-                # Clear the current dialog
-                curr_dialog = dict()
-                all_utterances = []
-                num_replies = 0
-            # Dialog line, extract the character and the utterance
-            elif line.startswith('From'):
-                char_name = re.sub(r'From ([^ ]+) to.*',r'\1', line).strip()
-                utterance = re.sub(r'From[^:]+:', '', line).replace('"', '')
-                if char_name not in curr_dialog:
-                    curr_dialog[char_name] = []
-                curr_dialog[char_name].append(utterance)
-                all_utterances.extend(utterance.split(' '))
-                num_replies += 1
-
-    outfile.close()
+    with open(input_file) as infile:
+        dialogs = dialog_eval.read_dialog_file(infile)
+        dialog_eval.evaluate(dialogs, 'out_nli_' + input_file)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Benchmark of the NLI backends: latency per pair and agreement with the large
+model, plus the threshold for each backend that best reproduces the
+accept/reject decisions of the large model.
+
+Input: TSV file (or STDIN) with previous<TAB>utterance on each line.
+"""
+
+import sys
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+from nli import NLI_BACKENDS
+
+
+def read_pairs(infile):
+    pairs = []
+    for line in infile:
+        line = line.rstrip('\n')
+        if '\t' not in line:
+            continue
+        previous, utterance = line.split('\t', 1)
+        pairs.append((previous, utterance))
+    return pairs
+
+
+def score_pairs(nli, pairs, batch_size):
+    """Score the pairs (the cache is off), return scores and seconds per pair."""
+    start = time.perf_counter()
+    scores = []
+    for i in range(0, len(pairs), batch_size):
+        scores.extend(nli.get_nli_scores(pairs[i:i + batch_size]))
+    elapsed = time.perf_counter() - start
+    return np.array(scores), elapsed / len(pairs)
+
+
+def calibrate(scores, reference_decisions):
+    """Find the threshold for which (scores >= threshold) agrees most with
+    the reference decisions; return threshold, agreement."""
+    best_threshold, best_agreement = 0.0, -1.0
+    for threshold in np.unique(np.concatenate([scores, [0.0, 1.0]])):
+        agreement = np.mean((scores >= threshold) == reference_decisions)
+        if agreement > best_agreement:
+            best_threshold, best_agreement = float(threshold), agreement
+    return best_threshold, best_agreement
+
+
+if __name__ == '__main__':
+    ap = ArgumentParser(description='Benchmark NLI backends against the large model')
+    ap.add_argument('pairs', nargs='?', default=None,
+                    help='TSV file with previous<TAB>utterance pairs; default: STDIN')
+    ap.add_argument('-b', '--backends', nargs='+', default=sorted(NLI_BACKENDS.keys()),
+                    choices=sorted(NLI_BACKENDS.keys()),
+                    help='Backends to benchmark (large is always run as the reference)')
+    ap.add_argument('-B', '--batch-size', type=int, default=16,
+                    help='Number of pairs per model call')
+    args = ap.parse_args()
+
+    if args.pairs:
+        with open(args.pairs) as infile:
+            pairs = read_pairs(infile)
+    else:
+        pairs = read_pairs(sys.stdin)
+    if not pairs:
+        sys.exit('No pairs to score!')
+
+    backends = ['large'] + [b for b in args.backends if b != 'large']
+    reference = None
+    print('Backend\tThreshold\tms/pair\tAgreement\tCorrelation\tCalibratedThreshold\tCalibratedAgreement')
+    for name in backends:
+        backend = NLI_BACKENDS[name]
+        nli = backend(batch_size=args.batch_size, cache_size=0)
+        # warm-up so that lazy initialization is not measured
+        nli.get_nli_scores(pairs[:1])
+        scores, latency = score_pairs(nli, pairs, args.batch_size)
+        if reference is None:
+            reference = scores >= backend.threshold, scores
+        if backend.threshold is not None:
+            threshold = f'{backend.threshold:.3f}'
+            agreement = f'{np.mean((scores >= backend.threshold) == reference[0]):.3f}'
+        else:
+            # not calibrated yet
+            threshold = agreement = '-'
+        correlation = np.corrcoef(scores, reference[1])[0, 1] if len(pairs) > 1 else 1.0
+        calibrated, calibrated_agreement = calibrate(scores, reference[0])
+        print(f'{name}\t{threshold}\t{latency * 1000:.1f}\t{agreement}\t{correlation:.3f}\t{calibrated:.3f}\t{calibrated_agreement:.3f}')
+        del nli
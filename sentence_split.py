@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Rule-based sentence splitting, used instead of a remote UDPipe call by the
+frontends, and the list of abbreviations after which a period does not end
+a sentence, also used by the backend when generating by sentences.
+"""
+
+import re
+from functools import lru_cache
+
+# Abbreviations after which a period does not end a sentence
+ABBREVIATIONS = ['v', 'vs', r'i\.e', 'rev', r'e\.g', 'Adj', 'Adm', 'Adv', 'Asst', 'Bart', 'Bldg', 'Brig', 'Bros',
+                 'Capt', 'Cmdr', 'Col', 'Comdr', 'Con', 'Corp', 'Cpl', 'DR', 'Dr', 'Drs', 'Ens', 'Gen', 'Gov',
+                 'Hon', 'Hr', 'Hosp', 'Insp', 'Lt', 'MM', 'MR', 'MRS', 'MS', 'Maj', 'Messrs', 'Mlle', 'Mme',
+                 'Mr', 'Mrs', 'Ms', 'Msgr', 'Op', 'Ord', 'Pfc', 'Ph', 'Prof', 'Pvt', 'Rep', 'Reps', 'Res', 'Rev',
+                 'Rt', 'Sen', 'Sens', 'Sfc', 'Sgt', 'Sr', 'St', 'Supt', 'Surg']
+
+# Czech abbreviations, only used for splitting (outlines may be in Czech)
+ABBREVIATIONS_CS = ['např', 'tj', 'tzv', 'resp', 'popř', 'mj', 'cca', 'č', 'str', 'sv', 'pí', 'Ing', 'Mgr',
+                    'MUDr', 'JUDr', 'PhDr', 'RNDr', 'Bc', 'doc', 'prof']
+
+# Does the (end of the) text contain an abbreviation with a period?
+# (used by story_server.py on the last few characters of generated text)
+UNBREAKING = re.compile(r".*(\s[A-Z]|" + '|'.join(ABBREVIATIONS) + r")\.\s*")
+
+# Abbreviations for splitting, also capitalized (at the start of a sentence)
+_SPLIT_ABBREVIATIONS = ABBREVIATIONS + ABBREVIATIONS_CS
+_SPLIT_ABBREVIATIONS += [abbreviation[0].upper() + abbreviation[1:]
+                         for abbreviation in _SPLIT_ABBREVIATIONS if abbreviation[0].islower()]
+
+# The text ends with an abbreviation or an initial and a period
+_ENDS_WITH_ABBREVIATION = re.compile(
+        r"(?:^|[\s(\[\"'])(?:[A-ZÁČĎÉĚÍŇÓŘŠŤÚŮÝŽ]|" + '|'.join(_SPLIT_ABBREVIATIONS) + r")\.$")
+
+# Sentence-final punctuation, possibly followed by closing quotes/brackets,
+# followed by whitespace
+_BOUNDARY = re.compile(r"[.!?…]+[\"'”“»)\]]*\s+")
+
+
+def _starts_sentence(text):
+    """Can a sentence start at the beginning of the text?"""
+    text = text.lstrip("\"'„“«([")
+    return bool(text) and (text[0].isupper() or text[0].isdigit())
+
+
+def _split_line(line):
+    sentences = []
+    start = 0
+    for match in _BOUNDARY.finditer(line):
+        end = match.end()
+        candidate = line[start:end].strip()
+        if not _starts_sentence(line[end:]):
+            continue
+        if candidate.endswith('.') and _ENDS_WITH_ABBREVIATION.search(candidate):
+            continue
+        sentences.append(candidate)
+        start = end
+    if line[start:].strip():
+        sentences.append(line[start:].strip())
+    return sentences
+
+
+@lru_cache(maxsize=1024)
+def _sentence_split(text):
+    sentences = []
+    # line breaks always end a sentence
+    for line in text.split('\n'):
+        line = re.sub(r'\s+', ' ', line).strip()
+        if line:
+            sentences.extend(_split_line(line))
+    return tuple(sentences)
+
+
+def sentence_split(text):
+    """Split text into a list of sentences."""
+    return list(_sentence_split(text))
+
+
+if __name__ == '__main__':
+    import sys
+    for sentence in sentence_split(sys.stdin.read()):
+        print(sentence)
@@ -6,6 +6,7 @@ import html
 import requests
 import traceback
 import json
+from cgi_common import REQUEST_TIMEOUT
 
 try:
     with open('config.json') as configfile:
@@ -33,11 +34,11 @@ def process_query(args):
         # processing a fully completed form (user added a new scene)
         if 'prompt' in args and 'id' in args:
             # add the scene into DB
-            req = requests.post(SERVER_ADDR, json={'key': args['id'], 'scene': args['prompt']})
+            req = requests.post(SERVER_ADDR, json={'key': args['id'], 'scene': args['prompt']}, timeout=REQUEST_TIMEOUT)
             if req.status_code != 200:
                 raise Exception('Could not save scene, code: {req.status_code}, text: {req.text}')
             # get a listing of scenes
-            req = requests.post(SERVER_ADDR, json={'list_scenes': 1})
+            req = requests.post(SERVER_ADDR, json={'list_scenes': 1}, timeout=REQUEST_TIMEOUT)
         # user just wants to add a new scene, nothing filled-in yet -> display the form
         else:
             return {'add': True}
@@ -45,10 +46,11 @@ def process_query(args):
     elif 'id' in args or 'key' in args:
         key = args.get('id', args.get('key'))
         key = key + ('-' if '-' not in key else '')
+        # no timeout, the server returns the text once it is all generated
         req = requests.post(SERVER_ADDR, json={'key': key})
     # get a listing of scenes
     else:
-        req = requests.post(SERVER_ADDR, json={'list_scenes': 1})
+        req = requests.post(SERVER_ADDR, json={'list_scenes': 1}, timeout=REQUEST_TIMEOUT)
     if not req.json():
         return {'error': 'Request error -- code: {req.status_code}, text: {req.text}'}
     return req.json()
@@ -12,7 +12,7 @@ import string
 from keyops import compress_key, expand_key
 from cgi_common import *
 
-SERVER_ADDR, API_ADDR = load_config('config.json')
+SERVER_ADDR, SERVER_NO, API_ADDR = load_config('config.json')
 DOWN = False
 
 
@@ -31,7 +31,7 @@ def batch_backlink(key):
         css_class = "backlink human"
     if new in string.ascii_letters:
         newkey = compress_key(prefix + new + batch_start)
-        return f'<a href="?id={newkey}" class="{css_class}" onclick="typing();">&lt; </a>'
+        return f'<a href="?id={newkey}" class="{css_class}" onclick="return typing(this);">&lt; </a>'
     else:
         # already at first option
         return '<span class="backlink"></span>'
@@ -44,7 +44,7 @@ def batch_newlink(key):
     new = chr(ord(current) + 1)
     if new in string.ascii_lowercase:
         newkey = compress_key(prefix + new + batch_start)
-        return '<a href="?id=' + newkey + '" class="newlink" onclick="typing();">X </a>'
+        return '<a href="?id=' + newkey + '" class="newlink" onclick="return typing(this);">X </a>'
     else:
         # already at 26th option or at human input (use backlink only)
         return '<span class="newlink"></span>'
@@ -182,12 +182,12 @@ def process_query(args):
         req = requests.post(SERVER_ADDR, json={
             'key': args['id'], 'scene': args['prompt'],
             'char1': args['char1'], 'char2': args['char2'],
-            'username': username, 'outline': args['outline']})
+            'username': username, 'outline': args['outline']}, timeout=REQUEST_TIMEOUT)
         if req.status_code != 200 or not req.json():
             raise Exception(f'Could not save scene, code: {req.status_code}, text: {req.text}')
         key = req.json()['key']  # get the key under which it was saved
         key = key + ('-' if '-' not in key else '')
-        req = requests.post(SERVER_ADDR, json={'key': key + batch_start, 'username': username})  # try to display the scene
+        req = requests.post(SERVER_ADDR, json={'key': key + batch_start, 'username': username, 'nowait': 1, 'wait': NOWAIT_WAIT}, timeout=REQUEST_TIMEOUT)  # try to display the scene
 
 
     # adding a human input at the given point in the play
@@ -199,18 +199,18 @@ def process_query(args):
         if args.get('use_pre_space'):
             human_input = args.get('pre_space', '') + human_input
         # store the input
-        req = requests.post(SERVER_ADDR, json={'human_input': human_input, 'key': key, 'username': username})
+        req = requests.post(SERVER_ADDR, json={'human_input': human_input, 'key': key, 'username': username}, timeout=REQUEST_TIMEOUT)
         if req.status_code != 200 or not req.json():
             raise Exception(f'Could not add human input, code: {req.status_code}, text: {req.text}')
         key = req.json()['key']  # get the key under which the input was stored
-        req = requests.post(SERVER_ADDR, json={'key': key + batch_start, 'username': username})  # generate continuation
-        requests.post(SERVER_ADDR, json={'pregenerate': key + 2 * batch_start})  # and pregenerate even more
+        req = requests.post(SERVER_ADDR, json={'key': key + batch_start, 'username': username, 'nowait': 1, 'wait': NOWAIT_WAIT}, timeout=REQUEST_TIMEOUT)  # generate continuation
+        requests.post(SERVER_ADDR, json={'pregenerate': key + 2 * batch_start}, timeout=REQUEST_TIMEOUT)  # and pregenerate even more
 
     # DB search
     elif 'search' in args:
         # we have the search query
         if 'query' in args:
-            req = requests.post(SERVER_ADDR, json={'search': args['search'], 'query': args['query']})
+            req = requests.post(SERVER_ADDR, json={'search': args['search'], 'query': args['query']}, timeout=REQUEST_TIMEOUT)
         # user just want to search, display the search form
         else:
             return {'search': True}, username
@@ -219,24 +219,24 @@ def process_query(args):
     elif 'id' in args or 'key' in args:
         key = args.get('id', args.get('key'))
         key = key + ('-' if '-' not in key else '')
-        req = requests.post(SERVER_ADDR, json={'key': key, 'username': username})
-        requests.post(SERVER_ADDR, json={'pregenerate': key + batch_start})
+        req = requests.post(SERVER_ADDR, json={'key': key, 'username': username, 'nowait': 1, 'wait': NOWAIT_WAIT}, timeout=REQUEST_TIMEOUT)
+        requests.post(SERVER_ADDR, json={'pregenerate': key + batch_start}, timeout=REQUEST_TIMEOUT)
 
     # get a listing of recently generated IDs by the current user
     elif 'my_recent' in args:
-        req = requests.post(SERVER_ADDR, json={'recent': int(args['my_recent']), 'username_limit': username})
+        req = requests.post(SERVER_ADDR, json={'recent': int(args['my_recent']), 'username_limit': username}, timeout=REQUEST_TIMEOUT)
 
     # get a listing of all recently generated IDs
     elif 'recent' in args:
-        req = requests.post(SERVER_ADDR, json={'recent': int(args['recent'])})
+        req = requests.post(SERVER_ADDR, json={'recent': int(args['recent'])}, timeout=REQUEST_TIMEOUT)
 
     # get a listing of scenes by the current user
     elif 'my_scenes' in args:
-        req = requests.post(SERVER_ADDR, json={'list_scenes': 1, 'username_limit': username})
+        req = requests.post(SERVER_ADDR, json={'list_scenes': 1, 'username_limit': username}, timeout=REQUEST_TIMEOUT)
 
     # get a listing of all scenes
     else:
-        req = requests.post(SERVER_ADDR, json={'list_scenes': 1})
+        req = requests.post(SERVER_ADDR, json={'list_scenes': 1}, timeout=REQUEST_TIMEOUT)
 
     # try to return the result, fail gracefully
     try:
@@ -244,9 +244,13 @@ def process_query(args):
         ret = req.json()
     except:
         return {'error': f'Request error -- code: {req.status_code}, text: {req.text}'}, username
+    # the server did not know any lines of the text in time
+    ret = wait_for_lines(SERVER_ADDR, ret)
     # user requested plaintext download instead of normal listing -- just add this info to the results
     if 'key' in ret and 'download' in args:
         ret['download'] = 1
+    # translations not ready when the text was generated
+    fill_translations(SERVER_ADDR, ret)
     return ret, username
 
 
@@ -338,6 +342,7 @@ print('''
 <div id="typingdiv">
 <div id="horizontaldiv">
 <img id="typingimg" src="robot.gif">
+<pre id="streamdiv"></pre>
 </div>
 </div>
 ''')
@@ -392,9 +397,10 @@ if 'key' in data:
         if is_eot:
             break
 
+    print_pending(data, SERVER_NO)
     print_rating_links(data['key'], data['rating'])
     if not is_eot:
-        print('<p class="clear"><a href="?id=' + compress_key(data['key'] + batch_start) + '" onclick="typing();">Continue this dialogue</a>\n</p>')
+        print('<p class="clear"><a href="?id=' + compress_key(data['key'] + batch_start) + '" onclick="return typing(this);">Continue this dialogue</a>\n</p>')
 
     print(f"<hr>\n<a href=\"?\">Back to main</a>&nbsp; <a href=\"?id={compress_key(data['key'])}&amp;download=1\">Plaintext</a>")
 
@@ -427,7 +433,7 @@ elif 'scenes' in data:
             print(" (added by " + data['scenes'][scene_key]['username'] + ")")
         print("\n<br>\n")
         print("<pre id='prompt'>" + html.escape(data['scenes'][scene_key]['prompt']) + "</pre>")
-        print('<a href="?id=' + scene_key + '-' + compress_key(batch_start) + '"  onclick="typing();">Explore this scene</a>')
+        print('<a href="?id=' + scene_key + '-' + compress_key(batch_start) + '"  onclick="return typing(this);">Explore this scene</a>')
 
 # showing errors
 elif 'error' in data:
@@ -6,17 +6,25 @@ Backend for interactive GPT2 story generation.
 """
 
 from   argparse import ArgumentParser
+from   array import array
+import copy
 import datetime
+import itertools
 import multiprocessing
+from   multiprocessing import resource_tracker, shared_memory
 import os
 import queue
 import re
+import signal
 import string
 import sys
 import threading
 import time
 import traceback
 import json
+import uuid
+from   collections import OrderedDict
+from   functools import lru_cache
 from   typing import Iterable, Optional, Tuple
 
 import dataset
@@ -24,20 +32,28 @@ import flask
 from   keyops import compress_key, expand_key, validate_key, split_into_parts
 import logging
 from   logzero import logger, loglevel
-import numpy as np
 import random
 import torch
 from   torch import Tensor
 from   torch.nn import functional as F
-from   transformers import AutoTokenizer, AutoModelForCausalLM
+from   transformers import AutoTokenizer, AutoModelForCausalLM, StoppingCriteria, StoppingCriteriaList
+from   transformers import LogitsProcessor, LogitsProcessorList
+from   transformers import TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+from   transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+try:
+    from transformers import TypicalLogitsWarper
+except ImportError:  # not exported at the top level in older versions
+    from transformers.generation_logits_process import TypicalLogitsWarper
 import unidecode  # noqa: E402
 
-from   char_support import trie, build_trie, extract_character_names
+from   char_support import build_trie, extract_character_names, CharacterConstraint
+import generation_cache
 import git_util
 from   keyops import compress_key
+from   sentence_split import UNBREAKING
 import summarize
 import urutranslate  # noqa: E402
-from nli import NLI
+from nli import NLIWorker, NLIClient, NLI_BACKENDS, backend_threshold
 
 import langid
 langid.set_languages(['en', 'cs'])
@@ -60,8 +76,11 @@ LOGO='''
 
 FORBIDDEN_LINES_MAX_RETRIES = 10
 
-NLI_THRESHOLD = 0.40
-UNBREAKING = re.compile(r".*(\s[A-Z]|v|vs|i\.e|rev|e\.g|Adj|Adm|Adv|Asst|Bart|Bldg|Brig|Bros|Capt|Cmdr|Col|Comdr|Con|Corp|Cpl|DR|Dr|Drs|Ens|Gen|Gov|Hon|Hr|Hosp|Insp|Lt|MM|MR|MRS|MS|Maj|Messrs|Mlle|Mme|Mr|Mrs|Ms|Msgr|Op|Ord|Pfc|Ph|Prof|Pvt|Rep|Reps|Res|Rev|Rt|Sen|Sens|Sfc|Sgt|Sr|St|Supt|Surg)\.\s*")
+# Number of candidate lines sampled in one batch once an attempt at a line
+# is rejected, until FORBIDDEN_LINES_MAX_RETRIES candidates are used up
+# (1 = retry sequentially)
+RETRY_CANDIDATES = 8
+
 
 GEN_PARAMS = {
         'temperature': 1.0,
@@ -73,6 +92,47 @@ GEN_PARAMS = {
         }
 
 FORBIDDEN_LINES_WINDOW = 4
+
+# A line with no colon within this many words is taken for a scenic remark
+# while it is generated, and ended early (see SteerFromScenicRemarks)
+SCENIC_NAME_MAX_WORDS = 5
+
+# Max number of consecutive lines generated in one decode session (chain mode)
+CHAIN_MAX_LINES = 10
+
+# Sliding context window (see ContextWindow): number of scene headers whose
+# past is kept, number of encoded lines kept, and the max part of the window
+# taken by the header (longer headers are summarized or cut)
+HEADER_CACHE_SIZE = 4
+LINE_CACHE_SIZE = 4096
+HEADER_MAX_FRACTION = 0.5
+
+# Number of SceneStates kept by the server, and the number of last lines
+# whose token ids are kept in each of them
+STATE_CACHE_SIZE = 1000
+STATE_TAIL_LINES = 128
+
+# Requests sent to the Generator before their results are received (the
+# Generator works on one, the next ones wait in the pipe), and the space for
+# the token ids of each of them in the shared buffer (bytes)
+GENERATOR_MAX_IN_FLIGHT = 2
+TOKEN_SLOT_SIZE = 1 << 18
+
+# Seconds between keep-alive comments sent to streaming clients when there
+# is nothing new
+STREAM_KEEPALIVE = 15
+
+# Text requests in the non-blocking mode (see Server.get_text_nowait()):
+# number of tickets kept, and the max number of seconds a long-poll request
+# for a ticket waits for news
+TICKET_CACHE_SIZE = 1000
+LONG_POLL_TIMEOUT = 30
+
+# Background translation: max number of texts translated together, number of
+# attempts and delay before the first retry (doubled for each further retry)
+TRANSLATION_BATCH = 20
+TRANSLATION_MAX_RETRIES = 5
+TRANSLATION_RETRY_DELAY = 5
 EOT = '<|endoftext|>'
 
 # This char means cutting:
@@ -86,20 +146,50 @@ ADD = '.'
 # Regenerate the given line
 REG = '~'
 
-def set_seed(scene_key):
+def key_seed(scene_key):
+    """The random seed for the given key, given by its continuation part.
+    Each request gets its own random generators seeded by it, so the global
+    random state is never touched."""
     if '-' in scene_key:
         _, scene_key = scene_key.split('-', 1)
-    random.seed(scene_key)
-    seed = random.getrandbits(32)
-    np.random.seed(seed)
-    torch.manual_seed(seed)
-    if torch.cuda.device_count() >=1:
-        torch.cuda.manual_seed_all(seed)
+    return random.Random(scene_key).getrandbits(32)
 
+def key_generator(scene_key, device='cpu'):
+    """A torch.Generator for sampling the line with the given key."""
+    seed = key_seed(scene_key)
     logger.info('GPT2: Set random seed for {}: {}'.format(compress_key(scene_key), seed))
+    generator = torch.Generator(device=device)
+    generator.manual_seed(seed)
+    return generator
+
+def decode_vocabulary(tokenizer):
+    """The text of each token of the vocabulary, as tokenizer.decode([id])
+    gives it. Byte-level BPE tokens (GPT2) are decoded directly by the byte
+    decoder instead of calling the tokenizer for each of them."""
+    byte_decoder = {char: byte for byte, char in bytes_to_unicode().items()}
+    added = tokenizer.get_added_vocab()
+    texts = []
+    for token_id, token in enumerate(tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))):
+        if token in added or any(char not in byte_decoder for char in token):
+            texts.append(tokenizer.decode([token_id]))
+        else:
+            text = bytes(byte_decoder[char] for char in token).decode('utf-8', errors='replace')
+            texts.append(tokenizer.clean_up_tokenization(text))
+    return texts
+
+def is_end_of_sentence(decoded_ids):
+    decoded_id = decoded_ids[-1]
+    relevant_to_regex_check = decoded_ids[-9:] #9 because 6 is the highest len, and space before and dot after are mandatory
+    if '.' in decoded_id:
+        logger.info(f"Found ., checking for unbreaking in the relevant substring '{relevant_to_regex_check}' of the string '{decoded_ids}'")
+        if UNBREAKING.match(relevant_to_regex_check):
+            return False
+        else:
+            logger.info("Unbreaking not found")
+    return '.' in decoded_id or '?' in decoded_id or '!' in decoded_id or ';' in decoded_id
 
-def smart_random(x):
-    num = random.random() * (2**x - 1) / 10.0
+def smart_random(x, rng=random):
+    num = rng.random() * (2**x - 1) / 10.0
     logger.info('Generating smart random with result {}'.format(num))
     return num
 
@@ -150,13 +240,652 @@ def shorten_string(text, maxlen=50):
 #predicted_text = tokenizer.decode(indexed_tokens + [predicted_index])
 #assert predicted_text == 'Who was Jim Henson? Jim Henson was a man'
 
+class SpeakerIndex:
+    """Utterances of each speaker in the prompt, used to build NLI contexts
+    for generated sentences without decoding and rescanning the whole
+    context for each sentence. Built once per generation request.
+
+    is_continuation: the prompt ends with a character name (e.g. 'Peter:'),
+    which is then the speaker of the line being generated."""
+
+    def __init__(self, prompt, is_continuation=False):
+        self.utterances = dict()
+        self.joined = dict()
+        self.current_speaker = None
+        self.prose_context = ''
+        lines = [line for line in prompt.split('\n') if line.strip()]
+        if is_continuation and lines:
+            self.current_speaker = self.get_speaker(lines.pop())
+        for line in lines:
+            speaker = self.get_speaker(line)
+            if speaker:
+                self.utterances.setdefault(speaker, []).append(
+                        self.normalize(re.sub(r'[^:]+:\s*', '', line)))
+
+    @staticmethod
+    def get_speaker(line):
+        """Character name of a 'Name: utterance' line, None for other lines."""
+        if ':' not in line:
+            return None
+        speaker = line.split(':', 1)[0].strip()
+        return speaker if len(speaker) > 1 else None
+
+    @staticmethod
+    def normalize(utterance):
+        utterance = utterance.strip()
+        if not utterance.endswith('.') and not utterance.endswith('?') and not utterance.endswith('!'):
+            utterance += '.'
+        return utterance
+
+    def get_context(self, speaker, current_line=''):
+        """The utterances of the speaker in the prompt, followed by the part
+        of the current line that has already been generated."""
+        if speaker not in self.joined:
+            self.joined[speaker] = ' '.join(self.utterances.get(speaker, []))
+        current_line = current_line.strip()
+        if current_line:
+            return (self.joined[speaker] + ' ' + self.normalize(current_line)).strip()
+        return self.joined[speaker]
+
+
+# Separates the ids of lines in the compact form stored in the DB; a part
+# whose ids are not known (None) is stored as ID_UNKNOWN
+ID_SEPARATOR = 0xFFFFFFFF
+ID_UNKNOWN = 0xFFFFFFFE
+
+def pack_ids(parts):
+    """Token ids of the parts of a text split by newlines (list of lists),
+    as compact bytes to be stored in the DB."""
+    ids = array('I')
+    for part_no, part in enumerate(parts):
+        if part_no:
+            ids.append(ID_SEPARATOR)
+        ids.extend(part if part is not None else [ID_UNKNOWN])
+    return ids.tobytes()
+
+def unpack_ids(data):
+    """Inverse of pack_ids()."""
+    ids = array('I')
+    ids.frombytes(data)
+    parts = [[]]
+    for token_id in ids.tolist():
+        if token_id == ID_SEPARATOR:
+            parts.append([])
+        else:
+            parts[-1].append(token_id)
+    return [part if part != [ID_UNKNOWN] else None for part in parts]
+
+
+def attach_shared_memory(name):
+    """Attach to the shared memory created (and unlinked) by another
+    process, without tracking it: the resource tracker would unlink the
+    memory when this process exits, while its creator still uses it."""
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    # before Python 3.13, attaching always registers the memory
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+class TokenBuffer:
+    """Shared memory through which the Server passes token ids (see
+    pack_ids()) to the Generator, instead of pickling them. It has a slot
+    for each of the requests in flight; write() returns a reference to the
+    data, to be sent to the Generator, which reads it with read().
+
+    name = the name of the existing buffer to attach to, None = create it"""
+
+    def __init__(self, slots=GENERATOR_MAX_IN_FLIGHT, slot_size=TOKEN_SLOT_SIZE, name=None):
+        self.slot_size = slot_size
+        if name is None:
+            # the creator (the Server) unlinks the memory in close()
+            self.memory = shared_memory.SharedMemory(create=True, size=slots * slot_size)
+        else:
+            # the Generator only attaches to it and closes it
+            self.memory = attach_shared_memory(name)
+
+    def write(self, slot, items):
+        """Store the items (lists of parts, or None) into the slot; returns
+        None if they do not fit. Empty lists are read as None."""
+        data = [pack_ids(parts) if parts else None for parts in items]
+        if sum(len(item) for item in data if item is not None) > self.slot_size:
+            return None
+        offset = slot * self.slot_size
+        lengths = []
+        for item in data:
+            if item is not None:
+                self.memory.buf[offset:offset + len(item)] = item
+                offset += len(item)
+            lengths.append(len(item) if item is not None else None)
+        return self.memory.name, slot * self.slot_size, lengths
+
+    def read(self, ref):
+        """The items stored by write() with the reference ref."""
+        _, offset, lengths = ref
+        items = []
+        for length in lengths:
+            if length is None:
+                items.append(None)
+            else:
+                items.append(unpack_ids(bytes(self.memory.buf[offset:offset + length])))
+                offset += length
+        return items
+
+    def close(self, unlink=False):
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+
+class LRUCache:
+    """A thread-safe dictionary keeping at most max_size of the last used
+    items."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            if len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+
+class Ticket:
+    """The progress of a text got in the background (see
+    Server.get_text_nowait()): the result of get_text() for the lines known
+    so far, until the whole result (or an error) is there. The version is
+    increased with each change."""
+
+    def __init__(self, scene_key):
+        self.scene_key = scene_key
+        self.condition = threading.Condition()
+        self.version = 0
+        self.value = None
+        self.error = None
+        self.done = False
+
+    def update(self, value, done=False):
+        with self.condition:
+            if not self.done:
+                self.value = value
+                self.done = done
+                self.version += 1
+                self.condition.notify_all()
+
+    def fail(self, error):
+        with self.condition:
+            self.error = error
+            self.done = True
+            self.version += 1
+            self.condition.notify_all()
+
+    def line_stored(self, event, line_key, text):
+        """Add a line stored after the lines known so far (called by
+        Server.publish())."""
+        with self.condition:
+            if event != 'line' or self.done or self.value is None or len(line_key) <= len(self.value['key']):
+                return
+            value = copy.deepcopy(self.value)
+            value['key'] = line_key
+            value['lines'].append(text)
+            if 'cs_lines' in value:
+                value['cs_lines'].append('' if text.strip() else text)
+                value['line_keys'].append(line_key)
+                if text.strip():
+                    value['pending_translations'].append(line_key)
+            self.value = value
+            self.version += 1
+            self.condition.notify_all()
+
+    def wait(self, predicate, timeout):
+        """Wait until the predicate holds (or the timeout); returns the value,
+        the version and whether the value is final."""
+        with self.condition:
+            self.condition.wait_for(lambda: predicate(self), timeout)
+            if self.done and self.error is not None:
+                raise Exception(self.error)
+            return self.value, self.version, self.done
+
+
+class SceneState:
+    """What the server needs for generating the line following a given key:
+    the scene prompt joined with the lines, the token ids of the last lines, the position in the outline and the
+    last lines (forbidden for the next line).
+
+    The state is immutable; add() returns the state with one more line in
+    O(length of the line), so the state for key+'a' is derived from the
+    state for key.
+
+    The text is processed by lines split by newlines, as the generator sees
+    them; the last one is open, i.e. it may still be continued by the next
+    line (after 'Name:'). The outline position counts only the lines before
+    the open one."""
+
+    def __init__(self, prompt, outline=()):
+        self.outline = tuple(outline)
+        self.text = ''
+        self.has_eot = False
+        self.outline_pos = 0
+        self.lines_since_remark = 0
+        # stripped non-empty lines before the open line, the last few only
+        self.last_lines = ()
+        self.open_line = ''
+        # token ids of the lines after the prompt, the open line last; None
+        # if not known
+        self.tail_ids = ()
+        self.open_ids = []
+        for part in prompt.split('\n'):
+            self.close_line(part)
+        self.text = prompt
+        self.has_eot = EOT in prompt
+        # the ids are kept for the lines after the prompt only
+        self.tail_ids = ()
+
+    def close_line(self, line):
+        """Count the open line as finished, replace it by line."""
+        stripped = self.open_line.strip()
+        if stripped:
+            self.last_lines = (self.last_lines + (stripped,))[-FORBIDDEN_LINES_WINDOW:]
+            if self.outline_pos < len(self.outline):
+                self.outline_pos, self.lines_since_remark = self.advance_outline(stripped)
+        self.tail_ids = (self.tail_ids + (self.open_ids,))[-STATE_TAIL_LINES:]
+        self.open_line = line
+
+    def advance_outline(self, line):
+        """The outline position and the number of lines since the last
+        remark after the given (stripped, non-empty) line."""
+        if self.outline[self.outline_pos] == line:
+            # The line from outline was inserted here
+            return self.outline_pos + 1, 0
+        elif looks_scenic(line):
+            # A scenic remark was generated here by GPT2
+            return self.outline_pos, 0
+        else:
+            # A standard line was generated here by GPT2
+            return self.outline_pos, self.lines_since_remark + 1
+
+    def add(self, line, line_ids=None):
+        """The state with the line added; line_ids = token ids of the parts
+        of the line split by newlines, None if not known.
+
+        Lines are joined by newlines, except for empty lines (which are cut
+        lines and are skipped) and partial lines containing only character
+        name and colon (e.g. 'Man:'), which are joined with the subsequent
+        line directly so as to form one input line instead of two; because
+        the input for generation ends with the colon, the expectation is
+        that the next line starts with a space, so no space is explicitly
+        added here. There is no newline at the end because the GPT2
+        tokenizer would eat it; it is added in gen_lines() if needed."""
+        if not line:
+            # cut lines are skipped
+            return self
+        state = copy.copy(self)
+        parts = line.split('\n')
+        if line_ids is None or len(line_ids) != len(parts):
+            line_ids = [None] * len(parts)
+        if self.text and not self.text.endswith(':'):
+            state.text = self.text + '\n' + line
+            state.close_line(parts[0])
+            state.open_ids = line_ids[0]
+        else:
+            # continuing the line after a character name
+            state.text = self.text + line
+            state.open_line = self.open_line + parts[0]
+            state.open_ids = (self.open_ids + line_ids[0]
+                              if self.open_ids is not None and line_ids[0] is not None else None)
+        for part, part_ids in zip(parts[1:], line_ids[1:]):
+            state.close_line(part)
+            state.open_ids = part_ids
+        state.has_eot = self.has_eot or EOT in line
+        return state
+
+    def recent_lines(self):
+        """The last FORBIDDEN_LINES_WINDOW stripped non-empty lines."""
+        stripped = self.open_line.strip()
+        return list((self.last_lines + ((stripped,) if stripped else ()))[-FORBIDDEN_LINES_WINDOW:])
+
+    def next_remark(self):
+        """The next remark of the outline to be inserted (None if all of
+        them have been), and the number of lines since the last remark."""
+        if self.outline_pos >= len(self.outline):
+            return None, self.lines_since_remark
+        pos, lines_since_remark = self.outline_pos, self.lines_since_remark
+        stripped = self.open_line.strip()
+        if stripped:
+            pos, lines_since_remark = self.advance_outline(stripped)
+        return (self.outline[pos] if pos < len(self.outline) else None), lines_since_remark
+
+    def line_ids(self):
+        """Token ids of the last lines after the prompt (aligned to the end)."""
+        return list(self.tail_ids) + [self.open_ids]
+
+
 class GenerateEOL(Exception):
-    def __init__(self, ids):
+    def __init__(self, ids, past=None):
         self.ids = ids
+        # cached keys and values for all but the last of the ids
+        self.past = past
 
 class GenerateEOSentence(Exception):
-    def __init__(self, ids):
+    def __init__(self, ids, past=None):
         self.ids = ids
+        self.past = past
+
+class LinesEnded(StoppingCriteria):
+    """Stop batched generation once each of the sequences contains a whole
+    line (some non-white-space followed by a newline) or the end of text
+    after start_from; the same rule as for stopping by GenerateEOL. With
+    sentences, a sequence also ends with a sentence, as for stopping by
+    GenerateEOSentence."""
+
+    def __init__(self, tokenizer, start_from, newline_ids, allow_empty=False, sentences=False):
+        self.tokenizer = tokenizer
+        self.start_from = start_from
+        self.newline_ids = newline_ids
+        # a newline alone ends the line (the line has been started already)
+        self.allow_empty = allow_empty
+        self.sentences = sentences
+        # for each sequence, where it ends, and whether it ends the line
+        self.ends = None
+        self.eols = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.ends is None:
+            self.ends = [None] * len(input_ids)
+            self.eols = [False] * len(input_ids)
+        for row, ids in enumerate(input_ids):
+            if self.ends[row] is not None:
+                continue
+            last_id = ids[-1].item()
+            if last_id == self.tokenizer.eos_token_id:
+                self.ends[row] = len(ids)
+                self.eols[row] = True
+                continue
+            if not self.sentences and last_id not in self.newline_ids:
+                continue
+            text = self.tokenizer.decode(ids[self.start_from:])
+            if not text:
+                continue
+            if self.sentences and is_end_of_sentence(text):
+                self.ends[row] = len(ids)
+            elif last_id in self.newline_ids and (self.allow_empty or text.strip()):
+                self.ends[row] = len(ids)
+                self.eols[row] = True
+        return all(end is not None for end in self.ends)
+
+
+class ForbiddenLinesTrie:
+    """Token trie of the lines that must not be generated. For each node
+    (i.e. a prefix of a forbidden line), the ids of the tokens that would
+    complete the line: a newline, possibly preceded by the rest of the line
+    (as in '.\n').
+
+    Nodes are numbered, 0 is the root."""
+
+    def __init__(self, lines, tokenizer, newline_prefixes):
+        self.children = [dict()]
+        self.blocked = [set()]
+        for line in set(line.strip() for line in lines):
+            if line:
+                # the line may or may not follow a space (after 'Name:')
+                self.add(line, tokenizer, newline_prefixes)
+                self.add(' ' + line, tokenizer, newline_prefixes)
+        self.blocked = [torch.tensor(sorted(ids), dtype=torch.long) for ids in self.blocked]
+
+    def add(self, text, tokenizer, newline_prefixes):
+        ids = tokenizer.encode(text)
+        node = 0
+        for k in range(len(ids) + 1):
+            prefix = tokenizer.decode(ids[:k])
+            if text.startswith(prefix):
+                self.blocked[node].update(newline_prefixes.get(text[len(prefix):], []))
+            if k == len(ids):
+                break
+            if ids[k] not in self.children[node]:
+                self.children[node][ids[k]] = len(self.children)
+                self.children.append(dict())
+                self.blocked.append(set())
+            node = self.children[node][ids[k]]
+
+    def step(self, node, token_id):
+        """The node reached from the node by the token; None if not in the trie."""
+        if node is None:
+            return None
+        return self.children[node].get(token_id)
+
+
+class BlockForbiddenLines(LogitsProcessor):
+    """Mask the tokens which would complete a forbidden line, so that
+    forbidden lines are not generated in the first place.
+
+    line_start = position of the start of the line in the input ids; white
+    space at the start of the line is skipped, as forbidden lines are
+    compared stripped.
+    A new instance is used for each call of generate()."""
+
+    def __init__(self, trie, line_start, blank_ids):
+        self.trie = trie
+        self.line_start = line_start
+        self.blank_ids = blank_ids
+        # the trie node for each of the sequences
+        self.nodes = None
+
+    def step(self, node, token_id):
+        if node == 0 and token_id in self.blank_ids:
+            return 0
+        return self.trie.step(node, token_id)
+
+    def __call__(self, input_ids, scores):
+        if self.nodes is None:
+            self.nodes = []
+            for ids in input_ids:
+                node = 0
+                for token_id in ids[self.line_start:].tolist():
+                    node = self.step(node, token_id)
+                self.nodes.append(node)
+        else:
+            # one token added since the last call
+            self.nodes = [self.step(node, token_id)
+                          for node, token_id in zip(self.nodes, input_ids[:, -1].tolist())]
+        for row, node in enumerate(self.nodes):
+            if node is not None and len(self.trie.blocked[node]):
+                scores[row, self.trie.blocked[node].to(scores.device)] = -float('inf')
+        return scores
+
+
+class SteerFromScenicRemarks(LogitsProcessor):
+    """Keep the line from becoming a banned scenic remark (see
+    looks_scenic()) instead of rejecting it once it is generated: the line
+    may not end while looks_scenic() would reject it, as in 'Peter: [laughs]'
+    or ' [laughs]' after a line with a name.
+
+    A line which needs a character name but has no colon within
+    SCENIC_NAME_MAX_WORDS words is ended right away instead (unless another
+    processor blocks the end of the line): names are shorter than that, so
+    the line is most likely a scenic remark, and as it may not end, it would
+    only go on until the length limit to be rejected anyway.
+
+    A new instance is used for each call of generate()."""
+
+    def __init__(self, tokenizer, line_start, is_continuation, newline_ids, nl):
+        self.tokenizer = tokenizer
+        self.line_start = line_start
+        self.is_continuation = is_continuation
+        self.newline_ids = newline_ids
+        self.nl = nl
+        # the text of the line so far for each of the sequences
+        self.texts = None
+
+    def __call__(self, input_ids, scores):
+        if self.texts is None:
+            self.texts = [self.tokenizer.decode(ids[self.line_start:]) for ids in input_ids]
+        else:
+            # one token added since the last call
+            self.texts = [text + self.tokenizer.decode(token_id)
+                          for text, token_id in zip(self.texts, input_ids[:, -1].tolist())]
+        for row, text in enumerate(self.texts):
+            line = text.strip()
+            if not line or not looks_scenic(line, self.is_continuation):
+                continue
+            if (not self.is_continuation and ':' not in line and len(line.split()) > SCENIC_NAME_MAX_WORDS
+                    and scores[row, self.nl] > -float('inf')):
+                scores[row, :] = -float('inf')
+                scores[row, self.nl] = 0.0
+            else:
+                scores[row, self.newline_ids.to(scores.device)] = -float('inf')
+        return scores
+
+
+class SampleWithGenerator(LogitsProcessor):
+    """Sample the next token using the given torch.Generator instead of the
+    global random state. The scores are warped as generate() would do for
+    sampling with the given parameters, and the token is drawn by the
+    Gumbel-max trick; all other tokens get -inf, so generate() has to be run
+    greedily. Must be the last of the processors."""
+
+    def __init__(self, generator, params):
+        self.generator = generator
+        # the same warpers, in the same order, as in generate()
+        self.warpers = LogitsProcessorList()
+        if params.get('temperature', 1.0) != 1.0:
+            self.warpers.append(TemperatureLogitsWarper(params['temperature']))
+        if params.get('top_k'):
+            self.warpers.append(TopKLogitsWarper(params['top_k']))
+        if params.get('top_p', 1.0) < 1.0:
+            self.warpers.append(TopPLogitsWarper(params['top_p']))
+        if params.get('typical_p', 1.0) < 1.0:
+            self.warpers.append(TypicalLogitsWarper(params['typical_p']))
+
+    def __call__(self, input_ids, scores):
+        scores = self.warpers(input_ids, scores)
+        uniform = torch.rand(scores.shape, generator=self.generator, device=scores.device)
+        token_ids = torch.argmax(scores - torch.log(-torch.log(uniform)), dim=-1, keepdim=True)
+        return torch.full_like(scores, -float('inf')).scatter(1, token_ids, 0.0)
+
+
+class ContextWindow:
+    """Builds the context for generation as a fixed scene header (the scene
+    prompt, or its summary if it is too long) followed by as many of the
+    most recent lines as fit into the window.
+
+    The header is encoded once and the past of the model for it is cached,
+    so only the lines after it are run through the model again. The lines
+    are encoded one by one from the end until the window is full, each line
+    only once, so the scene is never re-tokenized as a whole. The ids are
+    the same as those of the whole text: lines are only encoded separately
+    where the tokenizer would not merge the newline between them with other
+    white space (see chunks())."""
+
+    def __init__(self, tokenizer, model, nl, summarize=False):
+        self.tokenizer = tokenizer
+        self.model = model
+        self.nl = nl
+        self.summarize = summarize
+        # header text -> (header text used, token ids, past)
+        self.headers = OrderedDict()
+        # encodes a line, or several lines which cannot be encoded separately
+        self.encode_line = lru_cache(maxsize=LINE_CACHE_SIZE)(tokenizer.encode)
+
+    @staticmethod
+    def chunks(lines):
+        """Split the lines of a text into chunks of consecutive lines, as
+        (start, end) line indices, which can be encoded separately and joined
+        by the newline token. Lines are only split where the newline is
+        between non-white-space characters: the tokenizer merges a newline
+        with the white space around it (e.g. a blank line may be one token)."""
+        chunks = []
+        start = 0
+        for line_no in range(1, len(lines)):
+            previous, line = lines[line_no - 1], lines[line_no]
+            if previous and not previous[-1].isspace() and line and not line[0].isspace():
+                chunks.append((start, line_no))
+                start = line_no
+        chunks.append((start, len(lines)))
+        return chunks
+
+    def encode_chunk(self, lines, start, end, known_ids):
+        """The ids of lines[start:end] (a chunk, see chunks()); known_ids =
+        the ids of each of the lines, None if not known."""
+        if end - start == 1 and known_ids[start] is not None:
+            return known_ids[start]
+        return self.encode_line('\n'.join(lines[start:end]))
+
+    def encode_parts(self, text, known_ids=None):
+        """The ids of the text, encoded by chunks of lines (as in encode_tail).
+        known_ids = ids of the lines of the text, if already known."""
+        lines = text.split('\n')
+        if known_ids is None or len(known_ids) != len(lines):
+            known_ids = [None] * len(lines)
+        ids = []
+        for start, end in self.chunks(lines):
+            ids.extend(([self.nl] if start > 0 else []) + self.encode_chunk(lines, start, end, known_ids))
+        return ids
+
+    def header(self, text, max_tokens, known_ids=None):
+        """The text, ids and past for the header, which may take at most
+        max_tokens. known_ids = ids of the lines of the header, if known."""
+        if text in self.headers:
+            self.headers.move_to_end(text)
+            return self.headers[text]
+        used_text = text
+        ids = self.encode_parts(text, known_ids)
+        if len(ids) > max_tokens and self.summarize:
+            used_text = summarize.summarize_dialogue(text, n_lines=10)
+            if used_text.endswith(': '):
+                used_text = used_text[:-1]
+            ids = self.tokenizer.encode(used_text)
+            logger.info(f"SUMMARIZER: summarized  {repr(text)} tokens into => \n {repr(used_text)}.")
+        if len(ids) > max_tokens:
+            # keep the end of the scene, which the generation continues
+            ids = ids[len(ids) - max_tokens:]
+            used_text = self.tokenizer.decode(ids)
+        past = self.extend_past(None, ids) if ids else None
+        self.headers[text] = (used_text, ids, past)
+        if len(self.headers) > HEADER_CACHE_SIZE:
+            self.headers.popitem(last=False)
+        return self.headers[text]
+
+    def encode_tail(self, text, max_tokens, known_ids=None):
+        """The ids of the last lines of the text which fit into max_tokens
+        (just the end of the last chunk of lines if it does not fit by itself).
+        known_ids = ids of the last lines (None for those not known)."""
+        lines = text.split('\n')
+        known_ids = (known_ids or [])[-len(lines):]
+        # the known ids belong to the last lines
+        known_ids = [None] * (len(lines) - len(known_ids)) + list(known_ids)
+        ids = []
+        for start, end in reversed(self.chunks(lines)):
+            line_ids = ([self.nl] if start > 0 else []) + self.encode_chunk(lines, start, end, known_ids)
+            if len(ids) + len(line_ids) > max_tokens:
+                if not ids:
+                    ids = line_ids[len(line_ids) - max_tokens:] if max_tokens > 0 else []
+                break
+            ids = line_ids + ids
+        return ids
+
+    def extend_past(self, past, ids):
+        """Run the model over the ids following the past."""
+        if not ids:
+            return past
+        input_ids = torch.tensor([ids], device=self.model.device)
+        with torch.no_grad():
+            return self.model(input_ids=input_ids, past_key_values=past, use_cache=True).past_key_values
+
 
 class Generator(multiprocessing.Process):
     """Slave process, handles GPT2, generates stuff on demand.
@@ -165,7 +894,9 @@ class Generator(multiprocessing.Process):
 
     """
 
-    def __init__(self, conn, model, gen_num, summarize=False, log_level=logging.DEBUG, ban_remarks=True, prose=False, use_nli=False):
+    def __init__(self, conn, model, gen_num, summarize=False, log_level=logging.DEBUG, ban_remarks=True, prose=False, nli_conn=None, nli_backend='large',
+            nli_threshold=None, retry_candidates=RETRY_CANDIDATES, limit_characters=False,
+            cache_file=None, cache_size=generation_cache.MAX_ENTRIES):
         super(Generator, self).__init__()
         self.conn = conn
         self.model_name = model
@@ -177,12 +908,51 @@ class Generator(multiprocessing.Process):
         self.ban_remarks = ban_remarks
         self.prose = False
         self.nli = None
+        self.nli_index = None
         self.sentences = []
-
-        if use_nli:
-            self.nli = NLI()
-
-    def generate(self, context, params):
+        self.retry_candidates = retry_candidates
+        # only let the characters of the prompt speak
+        self.limit_characters = limit_characters
+        self.char_trie = None
+        # generating a batch of candidates, not stopped by GenerateEOL
+        self.batched = False
+        self.batch_past = None
+        # the line being generated: its start in the context, and the trie
+        # of the lines it must not be
+        self.line_start = 0
+        self.forbidden_trie = None
+        # scenic remarks are banned for the line; it follows a character name
+        self.ban_scenic = False
+        self.is_continuation = False
+        # random generator for sampling the line, seeded by its key
+        self.rng = None
+        # persistent cache of results, opened in run()
+        self.cache_file = cache_file
+        self.cache_size = cache_size
+        self.cache = None
+        # TokenBuffers shared by the Server, by name
+        self.token_buffers = dict()
+        # called with the text of the line being generated after each token;
+        # the start and end of the ids decoded so far and their text
+        self.on_partial = None
+        self.partial = None
+        self.nli_backend = nli_backend if nli_conn is not None else None
+
+        if nli_conn is not None:
+            # NLI is scored by a separate NLIWorker process
+            self.nli = NLIClient(nli_conn, backend_threshold(nli_backend, nli_threshold))
+
+    def generate(self, context, params, past=None):
+        if past is not None:
+            # continue from the cached keys and values of the context
+            # instead of running the model over all of it again
+            params = dict(params, past=past)
+        processors = self.logits_processors()
+        if params.get('do_sample'):
+            # sample by the generator of the line, see SampleWithGenerator
+            processors.append(SampleWithGenerator(self.rng, params))
+            params = dict(params, do_sample=False)
+        params = dict(params, logits_processor=processors)
         return self.model.generate(
                     tokenizer=self.tokenizer,
                     input_ids=context,
@@ -190,6 +960,21 @@ class Generator(multiprocessing.Process):
                     **params
                     )
 
+    def logits_processors(self):
+        """Constraints on the line being generated, for one call of generate()."""
+        processors = LogitsProcessorList()
+        if self.char_trie is not None and not self.is_continuation and not self.sentences:
+            # scenic remarks are allowed instead of a name unless banned
+            free_ids = None if self.ban_scenic else self.bracket_ids
+            processors.append(CharacterConstraint(self.char_trie, self.line_start, free_ids))
+        if self.forbidden_trie is not None:
+            processors.append(BlockForbiddenLines(self.forbidden_trie, self.line_start, self.blank_ids))
+        if self.ban_scenic and not self.sentences:
+            # after the first sentence, the line is not checked anymore
+            processors.append(SteerFromScenicRemarks(self.tokenizer, self.line_start, self.is_continuation,
+                                                     self.newline_tensor, self.NL))
+        return processors
+
     def postprocess(self, line):
         line = line.rstrip()
         if self.prose:
@@ -201,45 +986,66 @@ class Generator(multiprocessing.Process):
             line = line.replace(':', ';')
         return line
 
-    def get_nli_score(self, ids):
+    def send_partial(self, ids):
+        """Call on_partial with the text of the line so far (from
+        self.line_start in the ids), decoding only the new tokens."""
+        start, end, text = self.partial or (None, None, '')
+        if start != self.line_start or end > len(ids):
+            # a new line, or a retry
+            start, end, text = self.partial = (self.line_start, self.line_start, '')
+        if end == len(ids):
+            return
+        new_text = self.tokenizer.decode(ids[end:])
+        if new_text.endswith('\ufffd'):
+            # a character split between tokens, wait for the rest of it
+            return
+        self.partial = (start, len(ids), text + new_text)
+        self.on_partial(text + new_text)
+
+    def get_nli_pair(self, output_sequence):
+        """Get the (context, sentence) pair to be checked by NLI for the
+        newly generated sentence; None if the sentence is not to be checked.
+
+        Only the new tokens are decoded; the context is taken from
+        self.nli_index, built once per request, and the sentences already
+        accepted for the current line."""
+        if not self.nli:
+            return None
+        decoded_output = self.tokenizer.decode(output_sequence)
+        current_line = "".join(self.sentences)
         if self.prose:
-            output_sequence = ids[self.start_from:]
-            input_sequence = ids[:self.start_from]
-            decoded_output = self.tokenizer.decode(output_sequence)
-            decoded_input = self.tokenizer.decode(input_sequence)
-            return self.nli.get_single_nli_score(decoded_input, decoded_output)
+            premise = ' '.join(part for part in (self.nli_index.prose_context, current_line) if part)
+            return premise, decoded_output
         else:
-            # We work with decoded_all, because this might not be the first sentence in a speaker's utterance
-            # Therefore, in order to get the speaker information, we need to be sure to access the last generated line
-            decoded_all = self.tokenizer.decode(ids)
-            split_lines = re.split('\n+', decoded_all)
-            speaker = re.sub(r':.*', '', split_lines[-1])
+            # This might not be the first sentence in a speaker's utterance,
+            # so the speaker is found at the start of the current line
+            speaker = self.nli_index.current_speaker
+            if speaker is None:
+                speaker = SpeakerIndex.get_speaker(current_line or decoded_output)
             # If there is no speaker, it is probably a scenic remark which should not be NLI'd
-            if len(speaker) > 1:
-                decoded_output = self.tokenizer.decode(ids[self.start_from:])
+            if speaker:
                 decoded_output = re.sub(r'[^:]+:\s*', '', decoded_output)
-                filtered_lines = []
-                for line in split_lines:
-                    if line.strip().startswith(speaker):
-                        # Only add the utterances of the current speaker
-                        utterance = re.sub(r'[^:]+:\s*', '', line).strip()
-                        if not utterance.endswith('.') and not utterance.endswith('?') and not utterance.endswith('!'):
-                            utterance += '.'
-                        filtered_lines.append(utterance)
-                nli_context = " ".join(filtered_lines)
-                if nli_context.endswith(decoded_output):
-                    nli_context = nli_context[:-len(decoded_output)].strip()
-                #nli_context = nli_context.removesuffix(decoded_output)
-                return self.nli.get_single_nli_score(nli_context, decoded_output)
+                if self.nli_index.current_speaker is None:
+                    current_line = re.sub(r'[^:]+:\s*', '', current_line)
+                nli_context = self.nli_index.get_context(speaker, current_line)
+                return nli_context, decoded_output
         # This will happen for scenic remarks, for the time being let them be
-        return 1
+        return None
+
+    def nli_rejected(self, checkpoint):
+        """Wait for the NLI verdict on a sentence submitted to the NLI worker."""
+        job = checkpoint[0]
+        if job is None:
+            return False
+        return self.nli.collect(job)[0] < self.nli.threshold
 
     # TODO: reintroduce character manipulation; maybe list allowed characters,
     # maybe list forbidden characters (but do something like that);
     # maybe let the model generate and then decide if the character is OK, or
     # maybe predecide which character should speak (and add it to input)
     def gen_lines(self, prompt, scene_key, characters=None,
-            limit_characters=True, forbidden_lines=[], outline_kit=(None, 0)):
+            limit_characters=True, forbidden_lines=[], outline_kit=(None, 0), num_lines=1, header='',
+            line_ids=None, header_line_ids=None, on_line=None, on_partial=None):
         """This is where the generation occurs -- generate self.gen_num continuation
         alternatives for the given prompt.
         prompt = input text
@@ -249,24 +1055,43 @@ class Generator(multiprocessing.Process):
         characters = list of character names allowed in generation; empty =
         generate any character names
         outline_kit = the data necessary for (potentially) adding a scenic remark, tuple (string, int)
+        num_lines = number of consecutive lines to generate in one decode
+        session (chain mode): the line for scene_key, then the lines for
+        scene_key+'a', scene_key+'aa' etc.; the chain may end earlier, e.g.
+        if the context is full or end of text is generated
         returns a list of generated lines; the first line corresponds to the
         input scene_key, the further lines corrspond to "...a" continuations
         in case a remark is inserted, it is present in the list
+        header = the scene prompt at the start of the prompt, always kept in
+        the context (see ContextWindow)
+        line_ids = token ids of the last lines of the prompt split by
+        newlines (None for lines not known), to be used instead of encoding
+        them again
+        header_line_ids = token ids of the lines of the header, if known
+        on_line = called with the number and the text of each line of the
+        result as soon as it is generated
+        on_partial = called with the number and the text so far of the line
+        being generated after each token (the text may also get shorter when
+        a sentence is rejected)
+        returns also the token ids of the generated lines (for each line, of
+        its parts split by newlines)
         """
+        if on_line is None:
+            on_line = lambda line_no, line: None
 
         # based on stuff from interactive.py
         logger.info('GENERATOR: starting {}'.format(
             repr(shorten_string(prompt))))
         gen_len = 100
-        context = self.tokenizer.encode(prompt)
-
-        if self.summarize and len(context) >= ( self.max_len - gen_len):
-            before_summ_length = len(context)
-            summarized = summarize.summarize_dialogue(prompt,n_lines=10)
-            if summarized.endswith(': '):
-                summarized = summarized[:-1]
-            context    = self.tokenizer.encode(summarized)
-            logger.info(f"SUMMARIZER: summarized  {repr(prompt)} tokens into => \n {repr(summarized)}.")
+        # the scene prompt is kept at the start of the context, followed by
+        # the last lines that fit
+        if not prompt.startswith(header):
+            header, header_line_ids = '', None
+        header_text, header_ids, header_past = self.window.header(
+                header, int((self.max_len - gen_len) * HEADER_MAX_FRACTION), header_line_ids)
+        lines_text = prompt[len(header):]
+        # added at the end of the context after the lines
+        context = []
 
         if prompt.endswith(':'):
             # This looks like a character name, let's keep it on one line
@@ -277,11 +1102,12 @@ class Generator(multiprocessing.Process):
             is_continuation = False
 
 
-        prompt_lines = [x for x in prompt.split('\n') if x]
-        last_prompt_line = prompt_lines[-1] if prompt_lines else ''
+        # stripped lines of the prompt and of the lines generated so far
+        previous_lines = [x.strip() for x in prompt.split('\n') if x.strip()]
+        last_prompt_line = previous_lines[-1] if previous_lines else ''
 
         next_remark_string, lines_since_remark = outline_kit
-        if next_remark_string and next_remark_string not in forbidden_lines and smart_random(lines_since_remark) > 0.6:
+        if next_remark_string and next_remark_string not in forbidden_lines and smart_random(lines_since_remark, random.Random(key_seed(scene_key))) > 0.6:
             # The remark should start with an empty line, but we need to add
             # it manually so that the encoder does not eat it up.
             # It should also end with a newline but this is not stored in
@@ -289,52 +1115,191 @@ class Generator(multiprocessing.Process):
             logger.info('GENERATOR: adding scenic remark {}'.format(
                 repr(next_remark_string)))
             context += [self.NL] + self.tokenizer.encode(next_remark_string) + [self.NL]
+            previous_lines.append(next_remark_string)
             next_remark_string = '\n' + next_remark_string
         else:
             next_remark_string = None # If we don't use it, we don't want to save it into db
 
-        context = context[- self.max_len + gen_len:]
+        context = header_ids + self.window.encode_tail(
+                lines_text, self.max_len - gen_len - len(header_ids) - len(context), line_ids) + context
+
+        # the result is given by the context and the settings, try the cache
+        cache_key = None
+        if self.cache:
+            cache_key = self.cache.key(
+                    model=self.model_name, context=context, seed=key_seed(scene_key), params=GEN_PARAMS,
+                    forbidden_lines=sorted(set(forbidden_lines)), num_lines=num_lines,
+                    characters=sorted(characters) if characters is not None else None,
+                    limit_characters=limit_characters, ban_remarks=self.ban_remarks, prose=self.prose,
+                    nli=self.nli_backend, nli_threshold=self.nli.threshold if self.nli else None,
+                    retry_candidates=self.retry_candidates)
+            lines = self.cache.get(cache_key)
+            logger.info('GENERATOR: cache {} for {} ({} hits, {} misses)'.format(
+                'hit' if lines is not None else 'miss', compress_key(scene_key), self.cache.hits, self.cache.misses))
+            if (self.cache.hits + self.cache.misses) % generation_cache.STATS_INTERVAL == 0:
+                logger.info('GENERATOR: cache stats: {}'.format(self.cache.stats()))
+            if lines is not None:
+                for line_no, line in enumerate(lines):
+                    on_line(line_no, line)
+                return self.make_result(lines)
 
-        self.start_from = len(context)
         context = torch.tensor([context])
         if torch.cuda.device_count() >= 1:
             context = context.to('cuda')
 
-        # NOTE: currently not used!
-        if limit_characters:
+        self.char_trie = None
+        if limit_characters and not self.prose:
             if characters is None:
                 characters = extract_character_names(prompt)
+            self.char_trie = build_trie(self.tokenizer, characters)
 
         # returns a list of lines starting with line scene_key
 
-        set_seed(scene_key)
+        # text of the scene for NLI contexts
+        nli_text = header_text + lines_text
+        # cached keys and values of the model for all but the last token of
+        # the context, kept from line to line in chain mode; the past of the
+        # header is reused
+        past = None
+        if header_past is not None and len(context[0]) > len(header_ids):
+            past = self.window.extend_past(header_past, context[0][len(header_ids):-1].tolist())
+        # the remark goes first in the result
+        if next_remark_string:
+            on_line(0, next_remark_string)
+        output_lines = []
+        for line_no in range(num_lines):
+            if line_no > 0:
+                if len(context[0]) > self.max_len - gen_len:
+                    logger.info('GENERATOR: context full, ending chain after {} lines'.format(line_no))
+                    break
+                # the next line is a plain continuation ('a'), which only
+                # must not repeat the last few lines
+                forbidden_lines = previous_lines[-FORBIDDEN_LINES_WINDOW:]
+                last_prompt_line = previous_lines[-1]
+                is_continuation = False
+            if self.char_trie is not None:
+                self.char_trie.set_speakers([SpeakerIndex.get_speaker(line) for line in previous_lines])
+
+            if on_partial is not None:
+                self.on_partial = lambda text, result_no=line_no + (1 if next_remark_string else 0): \
+                        on_partial(result_no, text)
+            try:
+                output_line, line_ok, context, past = self.gen_line(
+                        context, past, scene_key + 'a' * line_no, forbidden_lines,
+                        is_continuation, last_prompt_line, nli_text)
+            finally:
+                self.on_partial = None
+            output_lines.append(output_line)
+            on_line(line_no + (1 if next_remark_string else 0), output_line)
+
+            logger.info('GENERATOR truncated {}: {}'.format(
+                compress_key(scene_key + 'a' * line_no), repr(shorten_string(output_line))))
+
+            if not line_ok or EOT in output_line:
+                # the line is not a part of the context, or there is nothing
+                # more to generate
+                break
+            if is_continuation and previous_lines:
+                previous_lines[-1] = (previous_lines[-1] + output_line).strip()
+                nli_text += output_line
+            else:
+                previous_lines.append(output_line.strip())
+                nli_text += '\n' + output_line
+            if '\n' not in self.tokenizer.decode(context[0][-1:]):
+                # the line was ended by the sentence limit
+                nl = torch.tensor([self.NL], device=context.device)
+                context = torch.cat((context[0], nl)).unsqueeze(0)
+                past = None
+
+        # TODO the outer method should accept the list of lines and store them all in DB
+        if next_remark_string:
+            lines = [next_remark_string] + output_lines
+        else:
+            lines = output_lines
+
+        if cache_key:
+            self.cache.put(cache_key, lines)
+
+        return self.make_result(lines)
+
+    def encode_parts(self, line):
+        """Token ids of the parts of the line split by newlines."""
+        return [self.tokenizer.encode(part) for part in line.split('\n')]
+
+    def make_result(self, lines):
+        return {'lines': lines,
+                'ids': [self.encode_parts(line) for line in lines],
+                'model': self.model_name}
+
+    def gen_line(self, context, past, scene_key, forbidden_lines, is_continuation,
+            last_prompt_line, nli_text):
+        """Generate one line continuing the context (a tensor of token ids).
+        past = cached keys and values for all but the last token of the
+        context, or None
+        scene_key = key of the line, determines the random seed
+        nli_text = the text of the scene so far, for NLI contexts
+        returns the line, whether it was accepted, and the context and past
+        extended by the line"""
+        self.start_from = len(context[0])
+        self.line_start = self.start_from
+        self.forbidden_trie = ForbiddenLinesTrie(forbidden_lines, self.tokenizer, self.newline_prefixes)
+        self.ban_scenic = self.ban_remarks and looks_scenic(last_prompt_line)
+        self.is_continuation = is_continuation
+        if self.nli:
+            self.nli_index = SpeakerIndex(nli_text, is_continuation)
+            if self.prose:
+                self.nli_index.prose_context = self.tokenizer.decode(context[0])
+
+        self.rng = key_generator(scene_key, self.model.device)
 
+        gen_len = 100
+        output_line = ''
         line_ok = False
         retries = 0
         self.sentences = []
+        # NLI is checked speculatively: a sentence is accepted and its NLI
+        # score is computed by the NLI worker while the next sentence is
+        # generated. The verdict is collected once the next sentence is
+        # ready; on rejection, we roll back to before the rejected sentence.
+        # pending = (NLI job, number of sentences, context, start_from, past)
+        # before the last accepted sentence
+        pending = None
         while not line_ok and retries < FORBIDDEN_LINES_MAX_RETRIES and self.start_from <= self.max_len - gen_len:
-            nli_ok = True
+            if retries and self.retry_candidates > 1:
+                # An attempt was rejected: instead of retrying one by one,
+                # sample the next sentence (or the rest of the line) in a
+                # batch of candidates; each of them counts as a retry
+                if pending and self.nli_rejected(pending):
+                    logger.info("Line has a too low NLI score on retry {}".format(retries))
+                    _, num_sentences, context, self.start_from, past = pending
+                    self.sentences = self.sentences[:num_sentences]
+                pending = None
+                output_line, accepted, is_eol, context, past = self.gen_candidates(
+                        context, past, forbidden_lines, is_continuation, last_prompt_line)
+                if not accepted:
+                    retries += self.retry_candidates
+                elif len(self.sentences) >= 5 or is_eol:
+                    line_ok = True
+                continue
             is_eol = False
+            nli_pair = None
+            next_past = None
             try:
-                output_sequence = self.generate(context, GEN_PARAMS)[0][self.start_from:]
+                output_sequence = self.generate(context, GEN_PARAMS, past)[0][self.start_from:]
                 # If we want NLI to check the last sentence even before the generator stops without an exception, uncomment this
-                #nli_score = self.get_nli_score(output_sequences[0])
-                #if nli_score < NLI_THRESHOLD:
-                    #nli_ok = False
+                #nli_pair = self.get_nli_pair(output_sequences[0])
 
             # When a line is generated, GenerateEOL is raised, terminating
             # model.generate(), containing the IDs of the generated tokens.
             except GenerateEOL as g:
                 is_eol = True
                 output_sequence = g.ids[0][self.start_from:]
-                nli_score = self.get_nli_score(g.ids[0])
-                if nli_score < NLI_THRESHOLD:
-                    nli_ok = False
+                next_past = g.past
+                nli_pair = self.get_nli_pair(output_sequence)
             except GenerateEOSentence as g:
                 output_sequence = g.ids[0][self.start_from:]
-                nli_score = self.get_nli_score(g.ids[0])
-                if nli_score < NLI_THRESHOLD:
-                    nli_ok = False
+                next_past = g.past
+                nli_pair = self.get_nli_pair(output_sequence)
 
             #TODO what if no exception is raised?
 
@@ -348,37 +1313,108 @@ class Generator(multiprocessing.Process):
             is_forbidden = output_line.strip() in forbidden_lines
             is_banned_scenic_remark = len(self.sentences) == 0 and self.ban_remarks and looks_scenic(output_line, is_continuation) and looks_scenic(last_prompt_line)
 
-            if not is_forbidden and not is_banned_scenic_remark and nli_ok:
+            if not is_forbidden and not is_banned_scenic_remark:
+                job = self.nli.submit([nli_pair]) if nli_pair else None
+                checkpoint = (job, len(self.sentences), context, self.start_from, past)
                 self.sentences.append(output_line)
-                if len(self.sentences) >= 5 or is_eol:
+                context = torch.cat((context[0], output_sequence)).unsqueeze(0)
+                past = next_past
+                self.start_from = len(context[0])
+                line_done = len(self.sentences) >= 5 or is_eol
+                # Check the previous sentence (scored while this one was
+                # generated); if the line is complete, check this one as well
+                to_check = [pending, checkpoint] if line_done else [pending]
+                pending = checkpoint
+                rejected = next((c for c in to_check if c and self.nli_rejected(c)), None)
+                if rejected:
+                    logger.info("Line has a too low NLI score on retry {}".format(retries))
+                    if rejected is not checkpoint and job is not None:
+                        self.nli.discard(job)
+                    _, num_sentences, context, self.start_from, past = rejected
+                    self.sentences = self.sentences[:num_sentences]
+                    pending = None
+                    retries += 1
+                elif line_done:
+                    pending = None
                     line_ok = True
-                else:
-                    context = torch.cat((context[0], output_sequence)).unsqueeze(0)
-                    self.start_from = len(context[0])
             elif is_banned_scenic_remark:
                 logger.info("Line contains a banned scenic remark on retry {}".format(retries))
                 retries += 1
-            elif not nli_ok:
-                logger.info("Line has a too low NLI score on retry {}".format(retries))
-                retries += 1
             else:
                 logger.info("Line is forbidden on retry {}".format(retries))
                 retries += 1
 
+        # Out of retries or context: the last sentence may still be unchecked
+        if pending and self.nli_rejected(pending):
+            logger.info("Dropping last sentence with a too low NLI score")
+            _, num_sentences, context, self.start_from, past = pending
+            self.sentences = self.sentences[:num_sentences]
+
         if self.sentences:
             output_line = "".join(self.sentences)
 
-        logger.info('GENERATOR truncated {}: {}'.format(
-            compress_key(scene_key), repr(shorten_string(output_line))))
-
-        # TODO the outer method should accept the list of lines and store them all in DB
-        if next_remark_string:
-            lines = [next_remark_string, output_line]
+        return output_line, line_ok, context, past
+
+    def gen_candidates(self, context, past, forbidden_lines, is_continuation, last_prompt_line):
+        """Sample self.retry_candidates completions of the current line (of
+        its next sentence with NLI) in one batch and take the first one (in a
+        fixed order) which passes the same checks as in gen_line(); NLI is
+        scored for all of them at once. Returns the text (or the last
+        candidate if none passes), whether it was accepted, whether it ends
+        the line, and the context and past extended by it."""
+        num = self.retry_candidates
+        stopping = LinesEnded(self.tokenizer, self.start_from, self.newline_ids, bool(self.sentences),
+                              sentences=bool(self.nli))
+        params = dict(GEN_PARAMS, stopping_criteria=StoppingCriteriaList([stopping]))
+        batch_past = None
+        if past is not None:
+            batch_past = tuple(tuple(t.expand(num, -1, -1, -1) for t in layer) for layer in past)
+        self.batched = True
+        try:
+            output_sequences = self.generate(context.expand(num, -1), params, batch_past)
+        finally:
+            self.batched = False
+        # keys and values for all but the last two tokens
+        batch_past, self.batch_past = self.batch_past, None
+
+        candidates = []
+        for row, ids in enumerate(output_sequences):
+            end = stopping.ends[row] if stopping.ends and stopping.ends[row] else len(ids)
+            output_sequence = ids[self.start_from:end]
+            output_line = self.postprocess(self.tokenizer.decode(output_sequence))
+            logger.debug("CANDIDATE {}: {}".format(row, repr(output_line)))
+            if output_line.strip() in forbidden_lines:
+                logger.info("Candidate {} is forbidden".format(row))
+            elif len(self.sentences) == 0 and self.ban_remarks and looks_scenic(output_line, is_continuation) and looks_scenic(last_prompt_line):
+                logger.info("Candidate {} contains a banned scenic remark".format(row))
+            else:
+                candidates.append((row, end, output_sequence, output_line))
+
+        # NLI for all the remaining candidates in one job
+        nli_pairs = [self.get_nli_pair(c[2]) for c in candidates]
+        scores = iter(self.nli.collect(self.nli.submit([p for p in nli_pairs if p]))
+                      if any(nli_pairs) else [])
+        accepted = None
+        for candidate, nli_pair in zip(candidates, nli_pairs):
+            score = next(scores) if nli_pair else None
+            if score is not None and score < self.nli.threshold:
+                logger.info("Candidate {} has a too low NLI score".format(candidate[0]))
+            elif accepted is None:
+                accepted = candidate
+
+        if accepted is None:
+            logger.info("None of the {} candidates passed".format(num))
+            return output_line, False, False, context, past
+        row, end, output_sequence, output_line = accepted
+        logger.info("Taking candidate {}".format(row))
+        self.sentences.append(output_line)
+        context = torch.cat((context[0], output_sequence)).unsqueeze(0)
+        self.start_from = len(context[0])
+        if batch_past is not None and batch_past[0][0].shape[2] >= end - 1:
+            past = tuple(tuple(t[row:row + 1, :, :end - 1] for t in layer) for layer in batch_past)
         else:
-            lines = [output_line]
-
-        return {'lines': lines,
-                'model': self.model_name}
+            past = None
+        return output_line, True, stopping.eols[row], context, past
 
 
     def run(self):
@@ -422,20 +1458,18 @@ class Generator(multiprocessing.Process):
         def is_newline(decoded_id):
             return '\n' in decoded_id
 
-        def is_end_of_sentence(decoded_ids):
-            decoded_id = decoded_ids[-1]
-            relevant_to_regex_check = decoded_ids[-9:] #9 because 6 is the highest len, and space before and dot after are mandatory
-            if '.' in decoded_id:
-                logger.info(f"Found ., checking for unbreaking in the relevant substring '{relevant_to_regex_check}' of the string '{decoded_ids}'")
-                if UNBREAKING.match(relevant_to_regex_check):
-                    return False
-                else:
-                    logger.info("Unbreaking not found")
-            return '.' in decoded_id or '?' in decoded_id or '!' in decoded_id or ';' in decoded_id
-
         # 2. Create our wrapper for prepare_inputs_for_generation()
         def new_prep(input_ids, **model_kwargs):
 
+            if self.batched:
+                # Generating a batch of candidates, stopped by LinesEnded;
+                # keep the cache to continue from the accepted candidate
+                self.batch_past = model_kwargs.get('past')
+                return old_prep(input_ids, **model_kwargs)
+
+            if self.on_partial is not None and len(input_ids[0]) > self.line_start:
+                self.send_partial(input_ids[0])
+
             # Terminate by raising GenerateEOL if a line has been generated,
             # i.e. some non-white-space tokens have been generated and the
             # last token is a newline.
@@ -443,12 +1477,12 @@ class Generator(multiprocessing.Process):
                 decoded_ids = self.tokenizer.decode(input_ids[0][self.start_from:])
                 # We only want to analyze sentences in summaries
                 if self.nli and is_end_of_sentence(decoded_ids):
-                    raise GenerateEOSentence(input_ids)
+                    raise GenerateEOSentence(input_ids, model_kwargs.get('past'))
                 if len(decoded_ids.strip()) > 0 or self.sentences:
                     if is_newline(decoded_ids[-1]):
                         # Terminates model.generate() and contains the generated
                         # tokens IDs
-                        raise GenerateEOL(input_ids)
+                        raise GenerateEOL(input_ids, model_kwargs.get('past'))
 
             # Otherwise, invoke the original prepare_inputs_for_generation()
             return old_prep(input_ids, **model_kwargs)
@@ -460,28 +1494,92 @@ class Generator(multiprocessing.Process):
         # GPT2 tokenizer eats whitespace at the boundaries, so we need to put
         # the newline between some other text to get its token code
         self.NL = self.tokenizer.encode('x\nx')[1]
+        # Tokens ending a line (see is_newline() above), also listed by the
+        # text they contain before the newline (e.g. '.' for '.\n'), tokens
+        # consisting of white space only, and tokens starting with a bracket
+        self.newline_ids = set()
+        self.newline_prefixes = dict()
+        self.blank_ids = set()
+        bracket_ids = []
+        for token_id, token in enumerate(decode_vocabulary(self.tokenizer)):
+            if token.endswith('\n'):
+                self.newline_ids.add(token_id)
+                self.newline_prefixes.setdefault(token.rstrip(), []).append(token_id)
+            if not token.strip():
+                self.blank_ids.add(token_id)
+            elif token.lstrip()[0] in '[(':
+                bracket_ids.append(token_id)
+        self.newline_tensor = torch.tensor(sorted(self.newline_ids), dtype=torch.long)
+        self.bracket_ids = torch.tensor(bracket_ids, dtype=torch.long)
+
+        if self.cache_file:
+            self.cache = generation_cache.GenerationCache(self.cache_file, self.cache_size)
+        self.window = ContextWindow(self.tokenizer, self.model, self.NL, self.summarize)
 
         logger.info("GENERATOR: Model loaded.")
 
-        # handle requests for generation
-        while True:  # TODO do we need to end gracefully?
-            prompt, scene_key, forbidden_lines, outline_kit = self.conn.recv()
-            try:
-                result = self.gen_lines(prompt, scene_key, forbidden_lines=forbidden_lines, outline_kit=outline_kit)
-            except Exception as e:
-                logger.exception('GENERATOR ERROR: {}'.format(e))
-                result = {'error': str(e)}
-            self.conn.send(result)
+        # handle requests for generation: receives (request_id, request)
+        # tuples, sends back (request_id, 'partial', (line_no, text)) after
+        # each token if the request is streamed, (request_id, 'line', (line_no, line, ids, model)) for
+        # each line as soon as it is generated, then (request_id, 'done',
+        # None) or (request_id, 'error', message); the next requests may
+        # already wait in the pipe; the Server terminates the Generator on
+        # exit, which ends the loop like the end of the pipe does (signal
+        # handlers can only be set when running as the process itself)
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            while True:
+                try:
+                    request_id, request = self.conn.recv()
+                except EOFError:
+                    # the Server has exited
+                    break
+                def send_line(line_no, line):
+                    self.conn.send((request_id, 'line', (line_no, line, self.encode_parts(line), self.model_name)))
+                def send_partial(line_no, text):
+                    self.conn.send((request_id, 'partial', (line_no, text)))
+                try:
+                    header_line_ids, line_ids = self.read_token_ids(request)
+                    self.gen_lines(request['prompt'], request['scene_key'], limit_characters=self.limit_characters,
+                                   forbidden_lines=request['forbidden_lines'], outline_kit=request['outline_kit'],
+                                   num_lines=request['num_lines'], header=request['header'], line_ids=line_ids,
+                                   header_line_ids=header_line_ids, on_line=send_line,
+                                   on_partial=send_partial if request.get('stream') else None)
+                except Exception as e:
+                    logger.exception('GENERATOR ERROR: {}'.format(e))
+                    self.conn.send((request_id, 'error', str(e)))
+                else:
+                    self.conn.send((request_id, 'done', None))
+        finally:
+            for token_buffer in self.token_buffers.values():
+                token_buffer.close()
+
+    def read_token_ids(self, request):
+        """The token ids of the header lines and of the last lines for the
+        request, passed in the shared TokenBuffer if they fit there."""
+        if request.get('token_ids') is None:
+            return request.get('header_line_ids'), request.get('line_ids')
+        name = request['token_ids'][0]
+        if name not in self.token_buffers:
+            self.token_buffers[name] = TokenBuffer(name=name)
+        return self.token_buffers[name].read(request['token_ids'])
 
 
 class Server:
     """Flask-based HTTP server, handling requests, getting stuff from DB & passing requests
     to the Generator."""
 
-    def __init__(self, conn, db_file, gen_num, translate, as_console, outlines):
+    def __init__(self, conn, db_file, gen_num, translate, as_console, outlines, model=None):
         self.lock = threading.Lock()
         self.conn = conn
 
+        # Token ids of the stored texts are stored along with them, so that
+        # they do not need to be encoded again; they are only used with the
+        # same tokenizer (given by the model name)
+        self.tokenizer_name = model
+        self.tokenizer = AutoTokenizer.from_pretrained(model) if model else None
+
         # remember if we're running as a real server, or from the console (i.e. no flask)
         self.as_console = as_console
 
@@ -494,6 +1592,25 @@ class Server:
         self.generate_queue = queue.Queue()
         self.pregenerate_queue = queue.LifoQueue()
         self.results = dict()
+        # SceneStates by key, token ids of generated lines by key
+        self.states = LRUCache(STATE_CACHE_SIZE)
+        self.line_ids = LRUCache(STATE_CACHE_SIZE)
+        # requests sent to the Generator and not finished yet, by request id
+        # and by key; each of them takes a slot of the token buffer
+        self.request_ids = itertools.count()
+        self.requests = dict()
+        self.request_keys = dict()
+        self.requests_lock = threading.Lock()
+        self.free_slots = queue.Queue()
+        for slot in range(GENERATOR_MAX_IN_FLIGHT):
+            self.free_slots.put(slot)
+        self.token_buffer = TokenBuffer()
+        # clients streaming the progress of generation (see stream_text()),
+        # as (scene key, function called with the event, line key and text)
+        self.streams = []
+        self.streams_lock = threading.Lock()
+        # texts got in the background, by ticket (see get_text_nowait())
+        self.tickets = LRUCache(TICKET_CACHE_SIZE)
 
         self.gen_num = gen_num
         self.db = dataset.connect('sqlite:///' + db_file, engine_kwargs={'connect_args': {'timeout': 60}})
@@ -524,58 +1641,350 @@ class Server:
         self.queue_thread_should_run = True
         self.queue_thread = threading.Thread(target=self.process_queues)
         self.queue_thread.start()
+        self.results_thread = threading.Thread(target=self.process_results)
+        self.results_thread.start()
+
+        # Translations are done in the background, not to delay generation;
+        # lines are stored with an empty cs_text until translated
+        self.translation_queue = queue.Queue()
+        self.translation_pending = set()
+        self.translation_lock = threading.Lock()
+        self.translation_thread = None
+        if self.translate:
+            self.translation_thread = threading.Thread(target=self.process_translations)
+            self.translation_thread.start()
 
     def process_queues(self):
+        """Send the queued requests to the Generator, without waiting for
+        the results (see process_results()); up to GENERATOR_MAX_IN_FLIGHT
+        requests are in flight."""
         while self.queue_thread_should_run:
+            # block for 5 secs at most, then check whether we haven't been killed
+            try:
+                slot = self.free_slots.get(True, 5)
+            except queue.Empty:
+                continue
             scene_key = None
             event = None
             pre = ''
 
-            # block for 5 secs at most, then check whether we haven't been killed
-            try:
-                if not self.generate_queue.empty():
-                    scene_key, prompt, prepend, event, forbidden_lines, outline_kit = self.generate_queue.get(True, 5)
-                    pre = ''
-                elif not self.pregenerate_queue.empty():
-                    scene_key, prompt, prepend, event, forbidden_lines, outline_kit = self.pregenerate_queue.get(True, 5)
-                    pre = 'pre'
-            except queue.Empty:
+            if not self.generate_queue.empty():
+                item = self.generate_queue.get()
+                pre = ''
+            elif not self.pregenerate_queue.empty():
+                item = self.pregenerate_queue.get()
+                pre = 'pre'
+            else:
+                self.free_slots.put(slot)
                 time.sleep(1)
+                # TODO wait somehow in a clever way -- wait on some object for
+                # max 10s, and whoever adds something to the queues notifies
+                # this object
                 continue
+            scene_key, prompt, prepend, event, forbidden_lines, outline_kit, num_lines, header, line_ids, header_line_ids = item
 
-            if scene_key:
+            with self.requests_lock:
                 # recheck if key still not generated
                 if scene_key in self.results:
                     # already generated
                     logger.info(f'SERVER: not {pre}generating {compress_key(scene_key)}, already generated')
+                    self.free_slots.put(slot)
                     if event:
                         event.set()
+                    continue
+                if scene_key in self.request_keys:
+                    # may be generated by a request in flight, wait for it
+                    logger.info(f'SERVER: not {pre}generating {compress_key(scene_key)}, already in progress')
+                    self.free_slots.put(slot)
+                    self.requests[self.request_keys[scene_key]]['waiting'].append((item, pre))
+                    continue
+                request_id = next(self.request_ids)
+                # the keys of all the lines the request may produce (the
+                # remark from the outline takes one of them)
+                keys = [scene_key + 'a' * line_no for line_no in range(num_lines + (1 if outline_kit[0] else 0))]
+                self.requests[request_id] = {'scene_key': scene_key, 'prepend': prepend, 'pre': pre,
+                                             'event': event, 'slot': slot, 'keys': keys, 'waiting': []}
+                for key in keys:
+                    self.request_keys.setdefault(key, request_id)
+
+            logger.info(f'SERVER: {pre}generating {compress_key(scene_key)}')
+            request = {'prompt': prompt + prepend, 'scene_key': scene_key, 'forbidden_lines': forbidden_lines,
+                       'outline_kit': outline_kit, 'num_lines': num_lines, 'header': header,
+                       'token_ids': self.token_buffer.write(slot, [header_line_ids, line_ids])}
+            if request['token_ids'] is None:
+                # too long for the buffer
+                request.update(header_line_ids=header_line_ids, line_ids=line_ids)
+            with self.streams_lock:
+                # the text of the lines so far is only sent for the lines
+                # which some client streams
+                if any(key.startswith(scene_key) for key, _ in self.streams):
+                    request['stream'] = True
+            self.conn.send((request_id, request))
+
+            logger.info('generate_queue: {} items; pregenerate_queue: {} items'.format(
+                self.generate_queue.qsize(), self.pregenerate_queue.qsize()))
+
+    def process_results(self):
+        """Receive the results of the requests from the Generator: each line
+        is stored as soon as it is generated, the waiting threads are
+        notified when the whole request is done. Requests waiting for a line
+        which was not generated in the end are queued again."""
+        while self.queue_thread_should_run:
+            if not self.conn.poll(5):
+                continue
+            request_id, status, data = self.conn.recv()
+            request = self.requests[request_id]
+            scene_key, pre = request['scene_key'], request['pre']
+
+            if status == 'partial':
+                line_no, text = data
+                self.publish('token', scene_key + 'a' * line_no, (request['prepend'] if line_no == 0 else '') + text)
+                continue
+            if status == 'line':
+                line_no, line, ids, model = data
+                line_key = scene_key + 'a' * line_no
+                self.results[line_key] = None
+                self.store_result(line_key, {'lines': [line], 'ids': [ids], 'model': model},
+                                  request['prepend'] if line_no == 0 else '')
+                continue
 
+            if status == 'done':
+                logger.info(f'SERVER: {pre}generated {compress_key(scene_key)}')
+            else:
+                logger.error(f'SERVER: failed to {pre}generate {compress_key(scene_key)}: {data}')
+            with self.requests_lock:
+                del self.requests[request_id]
+                for key in request['keys']:
+                    if self.request_keys.get(key) == request_id:
+                        del self.request_keys[key]
+            self.free_slots.put(request['slot'])
+            if request['event']:
+                request['event'].set()
+            for item, pre in request['waiting']:
+                waiting_key, event = item[0], item[3]
+                if waiting_key in self.results or waiting_key == scene_key:
+                    if event:
+                        event.set()
                 else:
-                    logger.info(f'SERVER: {pre}generating {compress_key(scene_key)}')
-
-                    self.conn.send((prompt + prepend, scene_key, forbidden_lines, outline_kit))
-                    result = self.conn.recv()
-                    result_ok = 'lines' in result
-
-                    if result_ok:
-                        logger.info(f'SERVER: {pre}generated {compress_key(scene_key)}')
-                        self.results[scene_key] = None
-                        x = threading.Thread(target=self.store_result,
-                                             args=(scene_key, result, prepend, event))
-                        x.start()
-                    else:
-                        errormsg = str(result.get('error'))
-                        logger.error(f'SERVER: failed to {pre}generate {compress_key(scene_key)}: {errormsg}')
+                    (self.pregenerate_queue if pre else self.generate_queue).put(item)
+
+    def publish(self, event, line_key, text):
+        """Send the event about the line (its text so far for 'token', the
+        whole text for 'line') to the clients streaming the scenes which
+        the line is a part of."""
+        with self.streams_lock:
+            streams = [notify for key, notify in self.streams if key.startswith(line_key)]
+        for notify in streams:
+            notify(event, line_key, text)
+
+    def stream_text(self, scene_key, username=''):
+        """Get the scene text like get_text(), as server-sent events: 'token'
+        with the text so far of each line being generated, 'line' with each
+        line stored, and finally 'done' with the result of get_text() (or
+        'error')."""
+        events = queue.Queue()
+        stream = (scene_key, lambda event, line_key, text: events.put(
+                (event, {'key': compress_key(line_key), 'text': text})))
+        with self.streams_lock:
+            self.streams.append(stream)
+
+        def get_text():
+            try:
+                events.put(('done', self.get_text(scene_key, username=username)))
+            except Exception as e:
+                logger.exception(str(e))
+                events.put(('error', str(e)))
+        threading.Thread(target=get_text).start()
 
-                    logger.info('generate_queue: {} items; pregenerate_queue: {} items'.format(
-                        self.generate_queue.qsize(), self.pregenerate_queue.qsize()))
+        try:
+            while True:
+                try:
+                    event, data = events.get(True, STREAM_KEEPALIVE)
+                except queue.Empty:
+                    # keep the connection open
+                    yield ': keepalive\n\n'
+                    continue
+                yield f'event: {event}\ndata: {json.dumps(data)}\n\n'
+                if event in ('done', 'error'):
+                    break
+        finally:
+            # the client may have disconnected, the text is still generated
+            with self.streams_lock:
+                self.streams.remove(stream)
+
+    def get_text_nowait(self, scene_key, username='', wait=0):
+        """Get the scene text like get_text(), without blocking for more
+        than wait seconds: if the text is not complete by then, return the
+        lines known so far, with 'pending' set to the scene key and a
+        'ticket' for further news (see poll_ticket()); only these if not
+        even the lines before the first one to be generated are known."""
+        # the lines are published under their expanded keys
+        scene_key = expand_key(scene_key)
+        ticket_id = uuid.uuid4().hex
+        ticket = Ticket(scene_key)
+        self.tickets.put(ticket_id, ticket)
+        stream = (scene_key, ticket.line_stored)
+        with self.streams_lock:
+            self.streams.append(stream)
+
+        def get_text():
+            try:
+                ticket.update(self.get_text(scene_key, username=username, progress=ticket.update), done=True)
+            except Exception as e:
+                logger.exception(str(e))
+                ticket.fail(str(e))
+            finally:
+                with self.streams_lock:
+                    self.streams.remove(stream)
+        threading.Thread(target=get_text).start()
+
+        start = time.time()
+        ticket.wait(lambda t: t.done, wait)
+        # the lines before the first one to be generated are known quickly
+        return self.poll_ticket(ticket_id, 0, max(0, wait - (time.time() - start)))
+
+    def poll_ticket(self, ticket_id, version=0, wait=LONG_POLL_TIMEOUT):
+        """The text for the ticket from get_text_nowait(), as soon as it is
+        newer than the given version (or after wait seconds, at most
+        LONG_POLL_TIMEOUT); it is 'pending' until complete."""
+        ticket = self.tickets.get(ticket_id)
+        if ticket is None:
+            raise Exception('Unknown ticket')
+        if wait is not None:
+            wait = min(wait, LONG_POLL_TIMEOUT)
+        value, version, done = ticket.wait(lambda t: t.done or (t.version > version and t.value is not None), wait)
+        if done:
+            return value
+        return dict(value or {}, pending=ticket.scene_key, ticket=ticket_id, version=version)
+
+    def queue_translation(self, kind, key, attempt=0):
+        """Schedule background translation of a line (kind='line') or of a
+        scene prompt and outline (kind='scene')."""
+        if not self.translate:
+            return
+        with self.translation_lock:
+            if attempt == 0 and (kind, key) in self.translation_pending:
+                # already scheduled
+                return
+            self.translation_pending.add((kind, key))
+        self.translation_queue.put((kind, key, attempt))
+
+    def translation_failed(self, items, error):
+        """Schedule a retry of failed translations, or give up."""
+        for kind, key, attempt in items:
+            if attempt + 1 < TRANSLATION_MAX_RETRIES:
+                logger.warning(f'SERVER: translation of {kind} {compress_key(key)} failed, will retry: {error}')
+                retry = threading.Timer(TRANSLATION_RETRY_DELAY * 2 ** attempt,
+                                        self.translation_queue.put, args=((kind, key, attempt + 1),))
+                retry.daemon = True
+                retry.start()
+            else:
+                logger.error(f'SERVER: translation of {kind} {compress_key(key)} failed, giving up: {error}')
+                with self.translation_lock:
+                    self.translation_pending.discard((kind, key))
+
+    def translation_done(self, items):
+        with self.translation_lock:
+            for kind, key, _ in items:
+                self.translation_pending.discard((kind, key))
+
+    def translate_lines(self, items):
+        """Translate the given lines in one batch and store the translations."""
+        db_lines = []
+        self.lock.acquire()
+        for _, key, _ in items:
+            db_lines.append(self.db['lines'].find_one(key=key))
+        self.lock.release()
+        todo = [(item, db_line) for item, db_line in zip(items, db_lines)
+                if db_line is not None and not db_line.get('cs_text')]
+        if todo:
+            try:
+                translations = urutranslate.translate_many_with_roles_separately(
+                        [db_line['text'] for _, db_line in todo])
+            except urutranslate.TranslationError as e:
+                self.translation_failed([item for item, _ in todo], e)
+                return
+            self.lock.acquire()
+            for (_, db_line), cs_text in zip(todo, translations):
+                db_line['cs_text'] = cs_text
+                self.db['lines'].update(db_line, ['id', 'key'])
+            self.lock.release()
+            for (_, db_line), cs_text in zip(todo, translations):
+                if self.results.get(db_line['key']):
+                    self.results[db_line['key']] = db_line['text'], cs_text
+                logger.info('SERVER: translated line {}'.format(compress_key(db_line['key'])))
+        self.translation_done(items)
+
+    def translate_scene(self, item):
+        """Translate the prompt and outline of the given scene, if missing."""
+        self.lock.acquire()
+        scene = self.db['scenes'].find_one(key=item[1])
+        self.lock.release()
+        if scene is not None:
+            fields = [field for field in ('prompt', 'outline')
+                      if scene[field] and not scene.get('cs_' + field)]
+            if fields:
+                try:
+                    translations = urutranslate.translate_many_with_roles_separately(
+                            [scene[field] for field in fields])
+                except urutranslate.TranslationError as e:
+                    self.translation_failed([item], e)
+                    return
+                for field, translation in zip(fields, translations):
+                    scene['cs_' + field] = translation
+                self.lock.acquire()
+                self.db['scenes'].update(scene, ['id', 'key'])
+                self.lock.release()
+                logger.info(f'SERVER: translated scene {item[1]}')
+        self.translation_done([item])
 
+    def process_translations(self):
+        """Background thread translating queued lines and scenes."""
+        while self.queue_thread_should_run:
+            try:
+                items = [self.translation_queue.get(True, 5)]
+            except queue.Empty:
+                continue
+            # take everything that is waiting, up to the batch size
+            while len(items) < TRANSLATION_BATCH:
+                try:
+                    items.append(self.translation_queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                line_items = [item for item in items if item[0] == 'line']
+                if line_items:
+                    self.translate_lines(line_items)
+                for item in items:
+                    if item[0] == 'scene':
+                        self.translate_scene(item)
+            except Exception as e:
+                logger.exception(f'SERVER: translation error: {e}')
+                self.translation_failed(items, e)
+
+    def get_translations(self, keys):
+        """Get translations of the given lines; None for pending ones. Keys
+        ending with '-' stand for scenes, their translation is a dict with
+        the prompt and outline."""
+        translations = dict()
+        self.lock.acquire()
+        for key in keys:
+            if key.endswith('-'):
+                scene = self.db['scenes'].find_one(key=key[:-1])
+                if scene and scene.get('cs_prompt') and (not scene['outline'] or scene.get('cs_outline')):
+                    translations[key] = {'prompt': scene['cs_prompt'], 'outline': scene.get('cs_outline') or ''}
+                else:
+                    translations[key] = None
             else:
-                time.sleep(1)
-                # TODO wait somehow in a clever way -- wait on some object for
-                # max 10s, and whoever adds something to the queues notifies
-                # this object
+                db_line = self.db['lines'].find_one(key=key)
+                translations[key] = db_line.get('cs_text') or None if db_line else None
+        self.lock.release()
+        for key, translation in translations.items():
+            if translation is None:
+                # make sure it has not been lost e.g. by a restart
+                self.queue_translation('scene' if key.endswith('-') else 'line',
+                                       key[:-1] if key.endswith('-') else key)
+        return {'translations': translations}
 
     def store_new_scene(self, scene_key, scene_prompt, username='',
             scene_outline=None, char1=None, char2=None):
@@ -614,13 +2023,9 @@ class Server:
                     scene['outline'] = urutranslate.translate_with_roles_separately(
                             scene_outline, 'cs', 'en')
         else:
+            # translated to Czech in the background
             assert source_language == 'en'
-            if self.translate:
-                scene['cs_prompt'] = urutranslate.translate_with_roles_separately(
-                        prompt)
-                if scene_outline:
-                    scene['cs_outline'] = urutranslate.translate_with_roles_separately(
-                            scene_outline)
+        scene.update(self.ids_columns(scene['prompt']))
         self.lock.acquire()
         self.db.begin()
         # store & add a number at the end if the scene exists
@@ -634,6 +2039,8 @@ class Server:
         self.lock.release()
         if not result:
             raise Exception('Too many entries with the same name')
+        if source_language == 'en':
+            self.queue_translation('scene', scene['key'])
         return {'key': scene['key']}
 
     def store_human_input(self, key, human_input, input_type='human'):
@@ -646,6 +2053,7 @@ class Server:
                 'git_version': self.git_version,
                 'git_branch': self.git_branch,
                 'timestamp': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+        data.update(self.ids_columns(human_input))
         self.lock.acquire()
         self.db.begin()
         letters = string.ascii_uppercase
@@ -661,18 +2069,31 @@ class Server:
         logger.info(f'SERVER: key = {data["key"]}')
         return {'key': data['key']}
 
-    def join_prompt_and_lines(self, prompt, lines, char1=None, char2=None):
-        """Prepare input prompt for GPT2 by joining together the scene prompt
-        and the already generated lines.
-
-        Joined by newlines by default, except
-        for empty lines (which are cut lines and are skipped)
-        and partial lines containing only character name and colon (e.g.
-        'Man:'), which are joined with the subsequent line directly so as to
-        form one input line instead of two; because the input for generation
-        ends with the colon, the expectation is that the next line starts with
-        a space, so no space is explicitly added here."""
-
+    def encode_parts(self, text):
+        """Token ids of the parts of the text split by newlines."""
+        return [self.tokenizer.encode(part) for part in text.split('\n')]
+
+    def ids_columns(self, text, ids=None):
+        """The DB columns with the token ids of the parts of the text split
+        by newlines (encoded if not given) and the tokenizer they belong to;
+        empty if there is no tokenizer."""
+        if self.tokenizer is None:
+            return {}
+        if ids is None:
+            ids = self.encode_parts(text)
+        return {'ids': pack_ids(ids), 'ids_tokenizer': self.tokenizer_name}
+
+    def ids_from_db(self, row):
+        """The token ids stored with the DB row (see ids_columns()), None if
+        missing or stored for another tokenizer."""
+        if not row or not row.get('ids') or row.get('ids_tokenizer') != self.tokenizer_name:
+            return None
+        return unpack_ids(row['ids'])
+
+    def get_prepend_char(self, prompt, lines, char1=None, char2=None):
+        """The character name to be added to the input for generation, if the
+        characters of the scene are forced (char1 starts, then char1 and
+        char2 take turns); empty string if not forced."""
         prepend_char = ''
         if len(lines) == 0 and char1:
             # force char1
@@ -692,68 +2113,53 @@ class Server:
             else:
                 # force char2
                 prepend_char = f'\n{char2}:'
+        return prepend_char
 
-        lines = [prompt] + lines
-        lines_and_whitespace = []
-        for line in lines[:-1]:
-            if line:
-                lines_and_whitespace.append(line)
-                if not line.endswith(':'):
-                    lines_and_whitespace.append('\n')
-        # No whitespace at the end because the GPT2 tokenizer would eat it;
-        # a final newline is added to end of input in gen_lines() if needed.
-        if lines[-1]:
-            lines_and_whitespace.append(lines[-1])
-        return ''.join(lines_and_whitespace), prepend_char
+    def build_state(self, prompt, outline, lines, line_keys):
+        """The SceneState for the given lines, built from scratch."""
+        state = SceneState(prompt, outline)
+        for line, line_key in zip(lines, line_keys):
+            state = state.add(line, self.line_ids.get(line_key))
+        return state
 
     # generate a new line; return line, cs_line
-    def generate_line(self, cur_scene_key, cur_lines, forbidden_lines, outline_text, pregenerate, prepend=''):
+    # state = the SceneState of the lines before the new one
+    # num_lines > 1: also generate the following lines (cur_scene_key + 'a',
+    # + 'aa' etc.) in the same go; they are stored in the DB
+    # header = the scene prompt, kept at the start of the generator's context
+    # header_line_ids = token ids of the lines of the header, if known
+    def generate_line(self, cur_scene_key, state, forbidden_lines, pregenerate, prepend='', num_lines=1,
+                      header='', header_line_ids=None):
         pre = 'pre' if pregenerate else ''
 
         # Skip generation if endoftext already generated
-        if EOT in cur_lines:
+        if state.has_eot:
             self.store_empty_line(cur_scene_key)
             return '', ''
         else:
-            lines = [line.strip() for line in cur_lines.split('\n') if line.strip()]
-
             # Forbidden lines, i.e. lines that the generator is
             # forbidden to produce at this step.
             # We also forbid last FORBIDDEN_LINES_WINDOW lines
-            forbidden_lines = forbidden_lines.copy()
-            for prev_line in lines[-FORBIDDEN_LINES_WINDOW:]:
-                forbidden_lines.append(prev_line)
-
-            # TODO make this prettier
-            next_remark_string = None
-            lines_since_remark = 0
-
-            if outline_text and self.outlines:
-                logger.debug('Outline is "{}"'.format(outline_text))
-                outline = ['[' + o.strip() + ']' for o in outline_text.split('\n')]
-                logger.debug('Outline is "{}"'.format(outline))
-                i = 0
-                j = 0
-                # We don't need to count lines_since_remark if there are no more remarks to add
-                while j < len(lines) and i < len(outline):
-                    if outline[i] == lines[j].strip():
-                        # The i-th line from outline was inserted here
-                        i += 1
-                        lines_since_remark = 0
-                    elif looks_scenic(lines[j]):
-                        # A scenic remark was generated here by GPT2
-                        lines_since_remark = 0
-                    else:
-                        # A standard line was generated here by GPT2
-                        lines_since_remark += 1
-                    j += 1
-
-                if i < len(outline):
-                    next_remark_string = outline[i]
+            forbidden_lines = forbidden_lines + state.recent_lines()
+
+            next_remark_string, lines_since_remark = state.next_remark()
+            if next_remark_string:
+                logger.debug('Next remark from outline is "{}"'.format(next_remark_string))
+                # whether to insert the remark is decided line by line
+                num_lines = 1
+
+            # token ids of the last lines, not known for the forced character
+            line_ids = state.line_ids()
+            if prepend:
+                prepend_parts = prepend.split('\n')
+                if prepend_parts[0]:
+                    line_ids[-1] = None
+                line_ids += [None] * (len(prepend_parts) - 1)
 
             logger.info('SERVER: queueing to {}generate {}'.format(pre, compress_key(cur_scene_key)))
             event = threading.Event()
-            queue_item = (cur_scene_key, cur_lines, prepend, event, forbidden_lines, (next_remark_string, lines_since_remark))
+            queue_item = (cur_scene_key, state.text, prepend, event, forbidden_lines, (next_remark_string, lines_since_remark),
+                          num_lines, header, line_ids, header_line_ids)
             if pregenerate:
                 self.pregenerate_queue.put(queue_item)
             else:
@@ -761,7 +2167,8 @@ class Server:
 
             # synchronous wait
             event.wait()
-            assert cur_scene_key in self.results, cur_scene_key
+            if cur_scene_key not in self.results:
+                raise Exception('Generation failed')
             # wait for the values to be filled
             while not self.results[cur_scene_key]:
                 time.sleep(1)
@@ -787,20 +2194,17 @@ class Server:
             self.lock.release()
         return forbidden_lines
 
-    # Get line for the key; return None if missing; generate translation if translation missing
+    # Get line for the key; return None if missing; schedule translation if translation missing
     def get_line_from_db(self, scene_key):
         self.lock.acquire()
         db_line = self.db['lines'].find_one(key=scene_key)
         self.lock.release()
         if db_line is not None and self.translate and not db_line.get('cs_text'):
-            db_line['cs_text'] = urutranslate.translate_with_roles_separately(db_line['text'])
-            self.lock.acquire()
-            self.db['lines'].update(db_line, ['id', 'key'])
-            self.lock.release()
+            self.queue_translation('line', scene_key)
         return db_line
 
 
-    # Get prompt and outline for the key; throw exception if missing; generate translation if translation missing
+    # Get prompt and outline for the key; throw exception if missing; schedule translation if translation missing
     def get_prompt_and_outline_from_db(self, prompt_key):
 
         # Get the prompt (and outline)
@@ -812,22 +2216,15 @@ class Server:
 
         # Fill in missing translations
         if self.translate:
-            update = False
-            if not prompt.get('cs_prompt'):
-                prompt['cs_prompt'] = urutranslate.translate_with_roles_separately(prompt['prompt'])
-                update = True
-            if prompt['outline'] and not prompt.get('cs_outline'):
-                prompt['cs_outline'] = urutranslate.translate_with_roles_separately(prompt['outline'])
-                update = True
-            if update:
-                self.lock.acquire()
-                self.db['scenes'].update(prompt, ['id', 'key'])
-                self.lock.release()
+            if not prompt.get('cs_prompt') or (prompt['outline'] and not prompt.get('cs_outline')):
+                self.queue_translation('scene', prompt_key)
 
         return prompt
 
-    def get_text(self, scene_key, pregenerate=False, username=''):
-        """Getting scene text (from DB or generating new)."""
+    def get_text(self, scene_key, pregenerate=False, username='', progress=None):
+        """Getting scene text (from DB or generating new).
+        progress = called with the result for the lines known so far before
+        waiting for a line to be generated"""
         pre = 'pre' if pregenerate else ''
         logger.info(f'SERVER: {pre}getting text {compress_key(scene_key)}...')
 
@@ -836,13 +2233,13 @@ class Server:
         cont_key = key[1:]
 
         # Get the scene prompt and outline
-        db_line = self.get_prompt_and_outline_from_db(prompt_key)
-        prompt = db_line['prompt']
-        cs_prompt = db_line.get('cs_prompt')
-        outline_text = db_line['outline']
-        cs_outline = db_line.get('cs_outline')
-        char1 = db_line.get('char1')
-        char2 = db_line.get('char2')
+        db_scene = self.get_prompt_and_outline_from_db(prompt_key)
+        prompt = db_scene['prompt']
+        cs_prompt = db_scene.get('cs_prompt')
+        outline_text = db_scene['outline']
+        cs_outline = db_scene.get('cs_outline')
+        char1 = db_scene.get('char1')
+        char2 = db_scene.get('char2')
 
         # Find the continuing lines
         # current scene key
@@ -854,8 +2251,19 @@ class Server:
         cs_lines = []
         # for each line, its forbidden lines in case we want to regenerate it
         forbidden_lines = []
-
-        for cont_part in cont_key:
+        # for each line, its key
+        line_keys = []
+        # remarks from the outline to be inserted
+        outline = ['[' + o.strip() + ']' for o in outline_text.split('\n')] if outline_text and self.outlines else []
+        # the SceneState of the current lines, None if not known (after
+        # commands other than standard insertion)
+        state = self.states.get(cur_scene_key)
+        if state is None:
+            state = SceneState(prompt, outline)
+            self.states.put(cur_scene_key, state)
+
+        for cont_index, cont_part in enumerate(cont_key):
+            prev_key = cur_scene_key
             cur_scene_key += cont_part
             if len(cont_part) == 1:
                 # standard insertion
@@ -877,6 +2285,7 @@ class Server:
                 lines[position] = ''
                 cs_lines[position] = ''
                 # And no need to generate or do anything more
+                state = None
             else:
                 # Set/update forbidden lines, prepare position for the line
                 if command == ADD:
@@ -887,6 +2296,7 @@ class Server:
                         forbidden_lines[position].extend(forbidden_lines[position-1])
                     lines.insert(position, None)
                     cs_lines.insert(position, None)
+                    line_keys.insert(position, None)
                 elif command == REG:
                     # The position already exists
                     # Current value of the line is forbidden
@@ -899,6 +2309,8 @@ class Server:
                     forbidden_lines.append(self.get_previous_line_values(cur_scene_key))
                     lines.append(None)
                     cs_lines.append(None)
+                    line_keys.append(None)
+                line_keys[position] = cur_scene_key
 
                 # Look for the line in DB
                 db_line = self.get_line_from_db(cur_scene_key)
@@ -907,16 +2319,52 @@ class Server:
                     # Found in DB -- no need to generate
                     lines[position] = db_line['text']
                     cs_lines[position] = db_line.get('cs_text')
+                    # stored token ids, so that the line need not be encoded
+                    ids = self.ids_from_db(db_line)
+                    if ids is not None and self.line_ids.get(cur_scene_key) is None:
+                        self.line_ids.put(cur_scene_key, ids)
                 else:
                     # Not found -- need to generate
-                    input_lines, prepend_char = self.join_prompt_and_lines(prompt, lines[:position], char1, char2)
+                    if command is None:
+                        # derived from the state of the previous key, if known
+                        if state is None:
+                            state = self.states.get(prev_key) or self.build_state(
+                                    prompt, outline, lines[:position], line_keys[:position])
+                            self.states.put(prev_key, state)
+                        input_state = state
+                    else:
+                        input_state = self.build_state(prompt, outline, lines[:position], line_keys[:position])
+                    prepend_char = self.get_prepend_char(prompt, lines[:position], char1, char2)
+                    if progress:
+                        progress(self.text_result(prev_key, prompt, cs_prompt, outline_text, cs_outline,
+                                                  lines[:position], cs_lines[:position], line_keys[:position]))
+                    # Plain continuations ('a') following a line appended at
+                    # the end are generated together with it; not if the
+                    # characters are forced, which is done line by line
+                    num_lines = 1
+                    if command is None and not (char1 or char2):
+                        for next_part in cont_key[cont_index + 1:]:
+                            if next_part != 'a' or num_lines >= CHAIN_MAX_LINES:
+                                break
+                            num_lines += 1
                     lines[position], cs_lines[position] = self.generate_line(
                             cur_scene_key,
-                            input_lines,
+                            input_state,
                             forbidden_lines[position],
-                            outline_text,
                             pregenerate,
-                            prepend_char)
+                            prepend_char,
+                            num_lines,
+                            prompt,
+                            self.ids_from_db(db_scene))
+
+                if command is None and state is not None:
+                    next_state = self.states.get(cur_scene_key)
+                    if next_state is None:
+                        next_state = state.add(lines[position], self.line_ids.get(cur_scene_key))
+                        self.states.put(cur_scene_key, next_state)
+                    state = next_state
+                else:
+                    state = None
 
         if not pregenerate:
 
@@ -936,12 +2384,27 @@ class Server:
             self.lock.release()
             # return the result
             rating = rating['rating'] if rating is not None else None
-            value = {'key': scene_key, 'prompt': prompt, 'lines': lines, 'outline': outline_text, 'rating': rating}
-            if self.translate:
-                value['cs_prompt'] = cs_prompt
-                value['cs_lines'] = cs_lines
-                value['cs_outline'] = cs_outline
-            return value
+            return self.text_result(scene_key, prompt, cs_prompt, outline_text, cs_outline,
+                                    lines, cs_lines, line_keys, rating)
+
+    def text_result(self, scene_key, prompt, cs_prompt, outline_text, cs_outline, lines, cs_lines, line_keys,
+                    rating=None):
+        """The result of get_text() for the given lines."""
+        value = {'key': scene_key, 'prompt': prompt, 'lines': lines, 'outline': outline_text, 'rating': rating}
+        if self.translate:
+            value['cs_prompt'] = cs_prompt or ''
+            value['cs_lines'] = [cs_line or '' for cs_line in cs_lines]
+            value['cs_outline'] = cs_outline or ''
+            value['line_keys'] = line_keys
+            # lines (and the scene, by its key ending with '-') whose
+            # translation is not ready yet, to be fetched later by the
+            # 'translations' command
+            value['pending_translations'] = [
+                    line_key for line, cs_line, line_key in zip(lines, cs_lines, line_keys)
+                    if line and not cs_line]
+            if not cs_prompt or (outline_text and not cs_outline):
+                value['pending_translations'].insert(0, split_into_parts(scene_key)[0] + '-')
+        return value
 
     # event: a threading.Event on which a thread is waiting for the result
     def store_result(self, scene_key, result, prepend='', event=None):
@@ -950,13 +2413,17 @@ class Server:
                     len(result['lines']), compress_key(scene_key)))
         # Managing the results
         lines = result['lines']
-        cs_lines = []
         ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
+        # token ids of the parts of each line split by newlines
+        line_ids = result.get('ids') or [None] * len(lines)
+        if result['model'] != self.tokenizer_name:
+            line_ids = [None] * len(lines)
         if lines and prepend:
             lines[0] = prepend + lines[0]
+            line_ids[0] = None
 
-        for line in lines:
+        for line, ids in zip(lines, line_ids):
             db_line = {'key': f"{scene_key}",
                        'text': line,
                        'model': result['model'],
@@ -964,18 +2431,26 @@ class Server:
                        'git_version': self.git_version,
                        'git_branch': self.git_branch,
                        'timestamp': ts}
+            if ids is None and self.tokenizer is not None:
+                ids = self.encode_parts(line)
+            db_line.update(self.ids_columns(line, ids))
             cs_text = ''
-            if self.translate:
-                cs_text = urutranslate.translate_with_roles_separately(line)
+            if self.translate and not line.strip():
+                # nothing to translate
+                cs_text = line
                 db_line['cs_text'] = cs_text
-                cs_lines.append(cs_text)
 
             logger.info('SERVER: storing line {}: {}'.format(
                 compress_key(scene_key), repr(line)))
             self.lock.acquire()
             self.db['lines'].insert_ignore(db_line, ['key'])
             self.lock.release()
+            if ids is not None:
+                self.line_ids.put(scene_key, ids)
             self.results[scene_key] = line, cs_text
+            self.publish('line', scene_key, line)
+            if self.translate and line.strip():
+                self.queue_translation('line', scene_key)
 
             scene_key += 'a'
 
@@ -1011,7 +2486,9 @@ class Server:
             scenes = self.db['scenes']
         self.lock.release()
         for scene in scenes:
-            res[scene['key']] = {'prompt': scene['prompt'], 'cs_prompt': scene['cs_prompt'], 'username': scene.get('username')}
+            res[scene['key']] = {'prompt': scene['prompt'], 'cs_prompt': scene.get('cs_prompt') or '', 'username': scene.get('username')}
+            if self.translate and not scene.get('cs_prompt'):
+                self.queue_translation('scene', scene['key'])
         res = {'scenes': res}
         if username_limit:
             res['username'] = username_limit
@@ -1043,7 +2520,8 @@ class Server:
         self.lock.acquire()
         res = self.db.query(f"SELECT * FROM {table} WHERE {field} LIKE :query_str", query_str='%' + query + '%')
         self.lock.release()
-        res = {'results': [dict(r) for r in res], 'search': field, 'query': query}
+        res = {'results': [{k: v for k, v in r.items() if k not in ('ids', 'ids_tokenizer')} for r in res],
+               'search': field, 'query': query}
         return res
 
     def store_rating(self, key, rating, username):
@@ -1060,6 +2538,10 @@ class Server:
         """Shutdown the underlying Flask server. Needs to get into internals."""
         self.queue_thread_should_run = False
         self.queue_thread.join()
+        self.results_thread.join()
+        self.token_buffer.close(unlink=True)
+        if self.translation_thread:
+            self.translation_thread.join()
         if not self.as_console:
             shutdown_hook = flask.request.environ.get('werkzeug.server.shutdown')
             shutdown_hook()
@@ -1089,9 +2571,23 @@ class Server:
             return self.store_rating(data['key'], data['rating'], username=data.get('username', ''))
         elif 'key' in data:
             # get/generate scene continuation
+            if data.get('nowait'):
+                return self.get_text_nowait(data['key'], username=data.get('username', ''),
+                                            wait=float(data.get('wait', 0)))
             return self.get_text(data['key'], username=data.get('username', ''))
+        elif 'ticket' in data:
+            # long-poll for a text requested with nowait
+            return self.poll_ticket(data['ticket'], int(data.get('version', 0)),
+                                    float(data.get('wait', LONG_POLL_TIMEOUT)))
         elif 'search' in data:
             return self.search_db(data['search'], data['query'])
+        elif 'translations' in data:
+            # get translations of lines that were pending
+            keys = data['translations']
+            for key in keys:
+                if not validate_key(key):
+                    raise Exception(f"Invalid key: {key}")
+            return self.get_translations([expand_key(key) for key in keys])
         elif 'pregenerate' in data:
             # pregenerate scene continuation
             x = threading.Thread(target=self.get_text,
@@ -1118,6 +2614,16 @@ class Server:
                 print()
         logger.info('END OF COMMANDS')
 
+    def handle_stream_request(self):
+        """Flask requests for the text of a scene streamed as it is
+        generated (see stream_text())."""
+        data = flask.request.json
+        if not validate_key(data.get('key', '')):
+            return f"Invalid key: {data.get('key')}", 500
+        return flask.Response(self.stream_text(expand_key(data['key']), data.get('username', '')),
+                              mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
     def handle_server_request(self):
         """Main method to use for Flask requests."""
         # get parameters
@@ -1148,6 +2654,18 @@ if __name__ == '__main__':
                     help='Database file to be used')
     ap.add_argument('-t', '--translate', action='store_true',
                     help='Translate outputs to Czech on display?')
+    ap.add_argument('-T', '--translation-cache', default=urutranslate.CACHE_FILE,
+                    help='Persistent translation cache file (shared by all instances using it); empty = no cache')
+    ap.add_argument('-G', '--generation-cache', default=generation_cache.CACHE_FILE,
+                    help='Persistent cache of generated lines (shared by all instances using it); empty = no cache')
+    ap.add_argument('--generation-cache-size', type=int, default=generation_cache.MAX_ENTRIES,
+                    help='Maximum number of results in the generation cache')
+    ap.add_argument('--translation-backend', choices=sorted(urutranslate.BACKENDS.keys()), default='remote',
+                    help='Translate by the remote LINDAT service or by a local model on CPU')
+    ap.add_argument('--translation-model', default='Helsinki-NLP/opus-mt-{source}-{target}',
+                    help='HuggingFace model for the local translation backend ({source}, {target} are replaced by language codes)')
+    ap.add_argument('--translation-workers', type=int, default=2,
+                    help='Number of threads of the local translation backend')
     ap.add_argument('-s', '--summarize', default=True,
                     help="Whether to summarize instead of just clipping prompt")
     ap.add_argument('-r', '--no-ban-remarks', default=True, dest='ban_remarks', action='store_false',
@@ -1156,6 +2674,14 @@ if __name__ == '__main__':
                     help="Is the text generated by this instance prose (summaries) or drama?")
     ap.add_argument('-N', '--nli', default=False, action='store_true',
                     help="Should NLI filtering be used?")
+    ap.add_argument('--nli-backend', choices=sorted(NLI_BACKENDS.keys()), default='large',
+                    help="NLI model to use: large (roberta-large-mnli), distilled, or quantized (int8, CPU)")
+    ap.add_argument('--nli-threshold', type=float, default=None,
+                    help="NLI rejection threshold; required for backends without a calibrated one (see nli_benchmark.py)")
+    ap.add_argument('--retry-candidates', type=int, default=RETRY_CANDIDATES,
+                    help="Number of candidates sampled in one batch when a line is rejected (1 = retry one by one)")
+    ap.add_argument('--limit-characters', action='store_true',
+                    help="Only let the characters found in the prompt speak")
     ap.add_argument('-o', '--outlines', action='store_true',
                     help="Auto insert lines from outline?")
     ap.add_argument('-l', '--log-level', choices=['debug', 'info', 'warning', 'error'], default='debug',
@@ -1166,23 +2692,47 @@ if __name__ == '__main__':
     log_level = getattr(logging, args.log_level.upper())
     loglevel(log_level)
 
+    urutranslate.set_cache_file(args.translation_cache or None)
+    if args.translation_backend == 'local':
+        urutranslate.set_backend('local', model=args.translation_model, workers=args.translation_workers)
+
     server_conn, gen_conn = multiprocessing.Pipe()
+    nli_worker = None
+    nli_conn = None
+    nli_threshold = None
+    if args.nli:
+        try:
+            nli_threshold = backend_threshold(args.nli_backend, args.nli_threshold)
+        except ValueError as e:
+            ap.error(str(e))
+        # NLI runs in its own process so that it does not block generation
+        nli_conn, nli_worker_conn = multiprocessing.Pipe()
+        nli_worker = NLIWorker(nli_worker_conn, args.nli_backend, log_level=log_level)
+        nli_worker.start()
     # start the child generator process (pass over the logging level)
     generator = Generator(gen_conn, args.model, args.num_alternatives, summarize=args.summarize, log_level=log_level,
-            ban_remarks=args.ban_remarks, prose=args.prose, use_nli=args.nli)
+            ban_remarks=args.ban_remarks, prose=args.prose, nli_conn=nli_conn, nli_backend=args.nli_backend,
+            nli_threshold=nli_threshold,
+            retry_candidates=args.retry_candidates, limit_characters=args.limit_characters,
+            cache_file=args.generation_cache or None, cache_size=args.generation_cache_size)
     generator.start()
     # parent process: start Flask server
     server = Server(server_conn, args.database, args.num_alternatives,
-            args.translate, as_console=args.console, outlines=args.outlines)
+            args.translate, as_console=args.console, outlines=args.outlines, model=args.model)
     if args.console:
         server.handle_console_requests()
         server.shutdown()
     else:
         app = flask.Flask(__name__)
         app.add_url_rule('/', 'handle_server_request', server.handle_server_request, methods=['POST'])
+        app.add_url_rule('/stream', 'handle_stream_request', server.handle_stream_request, methods=['POST'])
         app.run(host=args.host, port=args.port, threaded=True)
     logger.warning('Main server thread (and queue thread) stopped. Killing generator...')
     server_conn.close()
     generator.terminate()
     generator.join()
     logger.warning('SERVER: Generator terminated')
+    if nli_worker:
+        nli_worker.terminate()
+        nli_worker.join()
+        logger.warning('SERVER: NLI worker terminated')
@@ -12,7 +12,7 @@ import string
 from keyops import compress_key, expand_key, split_into_parts
 from cgi_common import *
 
-SERVER_ADDR, API_ADDR = load_config('syn_config.json')
+SERVER_ADDR, SERVER_NO, API_ADDR = load_config('syn_config.json')
 DOWN = False
 
 
@@ -32,7 +32,7 @@ def batch_backlink(key):
     if new in string.ascii_letters:
         newkey = compress_key(prefix + new + batch_start)
         # NOTE: back link does not work well with cuts; but keeping it anyway
-        return f'<a href="?id={newkey}" class="{css_class}" onclick="typing();">&lt; </a>'
+        return f'<a href="?id={newkey}" class="{css_class}" onclick="return typing(this);">&lt; </a>'
         # return '<span class="backlink">&lt; </span>'
     else:
         # already at first option
@@ -46,7 +46,7 @@ def batch_newlink(key, preceding_cuts):
     new = chr(ord(current) + 1)
     if new in string.ascii_lowercase:
         newkey = compress_key(prefix + preceding_cuts + new + batch_start)
-        return '<a href="?id=' + newkey + '" class="newlink" onclick="typing();" title="Throw away from this line and regenerate">X </a>'
+        return '<a href="?id=' + newkey + '" class="newlink" onclick="return typing(this);" title="Throw away from this line and regenerate">X </a>'
     else:
         # already at 26th option or at human input (use backlink only)
         return '<span class="newlink"></span>'
@@ -58,7 +58,7 @@ def batch_cutlink(fullkey, position):
 
     E.g. aaaaa, 2 -> aaaaa2_'''
     newkey = compress_key(fullkey + str(position) + CUT)
-    return '<a href="?id=' + newkey + '" class="cutlink" onclick="typing();" title="Cut this line, keep following lines">✂ </a>'
+    return '<a href="?id=' + newkey + '" class="cutlink" onclick="return typing(this);" title="Cut this line, keep following lines">✂ </a>'
 
 def load_cookie_username():
     username = ''
@@ -114,7 +114,7 @@ def print_cut_line(lineindex, key):
         # remove the cut of lineindex
         if part != f'{lineindex}_':
             newkey += part
-    print('<div class="left"><a href="?id=' + compress_key(newkey) + '" class="cutbacklink" onclick="typing();" title="Return back the cut line">--- ✂ ---</a></div>')
+    print('<div class="left"><a href="?id=' + compress_key(newkey) + '" class="cutbacklink" onclick="return typing(this);" title="Return back the cut line">--- ✂ ---</a></div>')
 
 def print_tr_line(line, is_eot=False):
     is_eot = EOT in line
@@ -161,12 +161,12 @@ def process_query(args):
             # add the synopsis into DB
             if 'outline' not in args:
                 args['outline'] = None
-            req = requests.post(SERVER_ADDR, json={'key': args['id'], 'scene': args['prompt'], 'username': username, 'outline': args['outline']})
+            req = requests.post(SERVER_ADDR, json={'key': args['id'], 'scene': args['prompt'], 'username': username, 'outline': args['outline']}, timeout=REQUEST_TIMEOUT)
             if req.status_code != 200 or not req.json():
                 raise Exception(f'Could not save synopsis, code: {req.status_code}, text: {req.text}')
             key = req.json()['key']  # get the key under which it was saved
             key = key + ('-' if '-' not in key else '')
-            req = requests.post(SERVER_ADDR, json={'key': key + batch_start, 'username': username})  # try to display the synopsis
+            req = requests.post(SERVER_ADDR, json={'key': key + batch_start, 'username': username, 'nowait': 1, 'wait': NOWAIT_WAIT}, timeout=REQUEST_TIMEOUT)  # try to display the synopsis
 
         # user just wants to add a new synopsis, nothing filled-in yet -> display the form
         else:
@@ -181,18 +181,18 @@ def process_query(args):
         if args.get('use_pre_space'):
             human_input = args.get('pre_space', '') + human_input
         # store the input
-        req = requests.post(SERVER_ADDR, json={'human_input': human_input, 'key': key, 'username': username})
+        req = requests.post(SERVER_ADDR, json={'human_input': human_input, 'key': key, 'username': username}, timeout=REQUEST_TIMEOUT)
         if req.status_code != 200 or not req.json():
             raise Exception(f'Could not add human input, code: {req.status_code}, text: {req.text}')
         key = req.json()['key']  # get the key under which the input was stored
-        req = requests.post(SERVER_ADDR, json={'key': key + batch_start, 'username': username})  # generate continuation
-        requests.post(SERVER_ADDR, json={'pregenerate': key + 2 * batch_start})  # and pregenerate even more
+        req = requests.post(SERVER_ADDR, json={'key': key + batch_start, 'username': username, 'nowait': 1, 'wait': NOWAIT_WAIT}, timeout=REQUEST_TIMEOUT)  # generate continuation
+        requests.post(SERVER_ADDR, json={'pregenerate': key + 2 * batch_start}, timeout=REQUEST_TIMEOUT)  # and pregenerate even more
 
     # DB search
     elif 'search' in args:
         # we have the search query
         if 'query' in args:
-            req = requests.post(SERVER_ADDR, json={'search': args['search'], 'query': args['query']})
+            req = requests.post(SERVER_ADDR, json={'search': args['search'], 'query': args['query']}, timeout=REQUEST_TIMEOUT)
         # user just want to search, display the search form
         else:
             return {'search': True}, username
@@ -201,24 +201,24 @@ def process_query(args):
     elif 'id' in args or 'key' in args:
         key = args.get('id', args.get('key'))
         key = key + ('-' if '-' not in key else '')
-        req = requests.post(SERVER_ADDR, json={'key': key, 'username': username})
-        requests.post(SERVER_ADDR, json={'pregenerate': key + batch_start})
+        req = requests.post(SERVER_ADDR, json={'key': key, 'username': username, 'nowait': 1, 'wait': NOWAIT_WAIT}, timeout=REQUEST_TIMEOUT)
+        requests.post(SERVER_ADDR, json={'pregenerate': key + batch_start}, timeout=REQUEST_TIMEOUT)
 
     # get a listing of recently generated IDs by the current user
     elif 'my_recent' in args:
-        req = requests.post(SERVER_ADDR, json={'recent': int(args['my_recent']), 'username_limit': username})
+        req = requests.post(SERVER_ADDR, json={'recent': int(args['my_recent']), 'username_limit': username}, timeout=REQUEST_TIMEOUT)
 
     # get a listing of all recently generated IDs
     elif 'recent' in args:
-        req = requests.post(SERVER_ADDR, json={'recent': int(args['recent'])})
+        req = requests.post(SERVER_ADDR, json={'recent': int(args['recent'])}, timeout=REQUEST_TIMEOUT)
 
     # get a listing of synopses by the current user
     elif 'my_scenes' in args:
-        req = requests.post(SERVER_ADDR, json={'list_scenes': 1, 'username_limit': username})
+        req = requests.post(SERVER_ADDR, json={'list_scenes': 1, 'username_limit': username}, timeout=REQUEST_TIMEOUT)
 
     # get a listing of all synopses
     else:
-        req = requests.post(SERVER_ADDR, json={'list_scenes': 1})
+        req = requests.post(SERVER_ADDR, json={'list_scenes': 1}, timeout=REQUEST_TIMEOUT)
 
     # try to return the result, fail gracefully
     try:
@@ -226,9 +226,13 @@ def process_query(args):
         ret = req.json()
     except:
         return {'error': f'Request error -- code: {req.status_code}, text: {req.text}'}, username
+    # the server did not know any lines of the text in time
+    ret = wait_for_lines(SERVER_ADDR, ret)
     # user requested plaintext download instead of normal listing -- just add this info to the results
     if 'key' in ret and 'download' in args:
         ret['download'] = 1
+    # translations not ready when the text was generated
+    fill_translations(SERVER_ADDR, ret)
     return ret, username
 
 
@@ -311,7 +315,7 @@ print(c.output())
 print()
 
 # print HTML header
-print_html_head(page_title, username, data, API_ADDR)
+print_html_head(page_title, username, data, API_ADDR, server='synopsis')
 
 
 print('<body onunload="notyping()">')
@@ -322,6 +326,7 @@ print('''
 <div id="typingdiv">
 <div id="horizontaldiv">
 <img id="typingimg" src="robot.gif">
+<pre id="streamdiv"></pre>
 </div>
 </div>
 ''')
@@ -402,8 +407,9 @@ if 'key' in data:
     lines = '\n'.join(lines)
 
     if not is_eot:
-        print('<p class="clear"><a href="?id=' + compress_key(data['key'] + batch_start) + '" onclick="typing();">Continue this synopsis</a>\n</p>')
+        print('<p class="clear"><a href="?id=' + compress_key(data['key'] + batch_start) + '" onclick="return typing(this);">Continue this synopsis</a>\n</p>')
 
+    print_pending(data, SERVER_NO)
     print_rating_links(data['key'], data['rating'])
 
     print(f'''<form method="post" action="synopsis2script.py" class="synopsis2script">
@@ -446,7 +452,7 @@ elif 'scenes' in data:
             print(" (added by " + data['scenes'][scene_key]['username'] + ")")
         print("\n<br>\n")
         print("<pre id='prompt'>" + html.escape(data['scenes'][scene_key]['prompt']) + "</pre>")
-        print('<a href="?id=' + scene_key + '-' + compress_key(batch_start) + '"  onclick="typing();">Explore this synopsis</a>')
+        print('<a href="?id=' + scene_key + '-' + compress_key(batch_start) + '"  onclick="return typing(this);">Explore this synopsis</a>')
 
 # showing errors
 elif 'error' in data:
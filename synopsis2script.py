@@ -11,13 +11,14 @@ import json
 import string
 from keyops import compress_key, expand_key, split_into_parts
 from cgi_common import *
+from sentence_split import sentence_split
 from collections import defaultdict
 
-SERVER_ADDR, API_ADDR = load_config('config.json')
+SERVER_ADDR, SERVER_NO, API_ADDR = load_config('config.json')
 DOWN = False
 
 def batch_discardlink(key):
-    return '<a href="?id=' + key + '" class="discardlink" onclick="typing();" title="Discard and stop">X </a>'
+    return '<a href="?id=' + key + '" class="discardlink" onclick="return typing(this);" title="Discard and stop">X </a>'
 
 # character to mark a regenerated line
 REG = '~'
@@ -26,7 +27,7 @@ def batch_reglink(key, position):
 
     E.g. aaaaa, 2 -> aaaaa2~'''
     command = str(position) + REG
-    return '<a href="?id=' + key + command + '" class="newlink" onclick="typing();" title="Regenerate this line, keep following lines">↻ </a>'
+    return '<a href="?id=' + key + command + '" class="newlink" onclick="return typing(this);" title="Regenerate this line, keep following lines">↻ </a>'
 
 # character to mark a cut line
 CUT='_'
@@ -38,7 +39,7 @@ def batch_cutlink(key, position, is_continuation_line):
     if is_continuation_line:
         # also discard the prev line
         command = str(position-1) + CUT + command
-    return '<a href="?id=' + key + command + '" class="cutlink" onclick="typing();" title="Cut this line, keep following lines">✂ </a>'
+    return '<a href="?id=' + key + command + '" class="cutlink" onclick="return typing(this);" title="Cut this line, keep following lines">✂ </a>'
 
 # character to mark an added line
 ADD='.'
@@ -47,7 +48,7 @@ def batch_addlink(key, position):
 
     E.g. aaaaa, 2 -> aaaaa2.'''
     command = str(position + 1) + ADD
-    return '<a href="?id=' + key + command + '" class="addlink" onclick="typing();" title="Generate a new line after this line, keep following lines">+ </a>'
+    return '<a href="?id=' + key + command + '" class="addlink" onclick="return typing(this);" title="Generate a new line after this line, keep following lines">+ </a>'
 
 def load_cookie_username():
     username = ''
@@ -131,23 +132,6 @@ def cgi_to_dict(field_storage):
             params[key] = field_storage[key].value
     return params
 
-def sentence_split(text):
-    """Split text into a list of sentences."""
-
-    # curl --data 'tokenizer=&output=plaintext=normalized_spaces&data=Děti pojedou k babičce. Už se těší.'
-
-    url = 'http://lindat.mff.cuni.cz/services/udpipe/api/process'
-    params = { 'tokenizer': 1,
-            'output': 'plaintext=normalized_spaces',
-            'data': text}
-    response = requests.post(url, data = params)
-    if response.ok:
-        response.encoding='utf8'
-        return [s for s in response.json()['result'].split('\n') if s]
-    else:
-        # Simple backup in case it fals; TODO log error somehow
-        return [s.strip()+'.' for s in text.split('.') if s.strip()]
-
 def process_query(args):
     """Main working method for querying the server"""
 
@@ -169,12 +153,12 @@ def process_query(args):
             outline = '\n'.join(sentence_split(args['outline']))
         if args['add'] == '2':
             # processing a fully completed form (user added a new synopsis)
-            req = requests.post(SERVER_ADDR, json={'key': args['id'], 'scene': args['prompt'], 'username': username, 'outline': outline})
+            req = requests.post(SERVER_ADDR, json={'key': args['id'], 'scene': args['prompt'], 'username': username, 'outline': outline}, timeout=REQUEST_TIMEOUT)
             if req.status_code != 200 or not req.json():
                 raise Exception(f'Could not save synopsis, code: {req.status_code}, text: {req.text}')
             key = req.json()['key']  # get the key under which it was saved
             key = key + ('-' if '-' not in key else '')
-            req = requests.post(SERVER_ADDR, json={'key': key, 'username': username})  # try to display the scene
+            req = requests.post(SERVER_ADDR, json={'key': key, 'username': username, 'nowait': 1, 'wait': NOWAIT_WAIT}, timeout=REQUEST_TIMEOUT)  # try to display the scene
         else:
             # user just wants to add a new synopsis, nothing filled-in yet -> display the form
             return {'add': '1',
@@ -197,18 +181,18 @@ def process_query(args):
         if args.get('use_pre_space'):
             human_input = args.get('pre_space', '') + human_input
         # store the input
-        req = requests.post(SERVER_ADDR, json={'human_input': human_input, 'key': key, 'username': username, 'input_type': input_type})
+        req = requests.post(SERVER_ADDR, json={'human_input': human_input, 'key': key, 'username': username, 'input_type': input_type}, timeout=REQUEST_TIMEOUT)
         if req.status_code != 200 or not req.json():
             raise Exception(f'Could not add human input, code: {req.status_code}, text: {req.text}')
         key = req.json()['key']  # get the key under which the input was stored
-        req = requests.post(SERVER_ADDR, json={'key': key + cont_key, 'username': username})  # generate continuation
-        requests.post(SERVER_ADDR, json={'pregenerate': key + cont_key + 'a'})  # and pregenerate even more
+        req = requests.post(SERVER_ADDR, json={'key': key + cont_key, 'username': username, 'nowait': 1, 'wait': NOWAIT_WAIT}, timeout=REQUEST_TIMEOUT)  # generate continuation
+        requests.post(SERVER_ADDR, json={'pregenerate': key + cont_key + 'a'}, timeout=REQUEST_TIMEOUT)  # and pregenerate even more
 
     # DB search
     elif 'search' in args:
         # we have the search query
         if 'query' in args:
-            req = requests.post(SERVER_ADDR, json={'search': args['search'], 'query': args['query']})
+            req = requests.post(SERVER_ADDR, json={'search': args['search'], 'query': args['query']}, timeout=REQUEST_TIMEOUT)
         # user just want to search, display the search form
         else:
             return {'search': True}, username
@@ -217,24 +201,24 @@ def process_query(args):
     elif 'id' in args or 'key' in args:
         key = args.get('id', args.get('key'))
         key = key + ('-' if '-' not in key else '')
-        req = requests.post(SERVER_ADDR, json={'key': key, 'username': username})
-        requests.post(SERVER_ADDR, json={'pregenerate': key + 'a'})
+        req = requests.post(SERVER_ADDR, json={'key': key, 'username': username, 'nowait': 1, 'wait': NOWAIT_WAIT}, timeout=REQUEST_TIMEOUT)
+        requests.post(SERVER_ADDR, json={'pregenerate': key + 'a'}, timeout=REQUEST_TIMEOUT)
 
     # get a listing of recently generated IDs by the current user
     elif 'my_recent' in args:
-        req = requests.post(SERVER_ADDR, json={'recent': int(args['my_recent']), 'username_limit': username})
+        req = requests.post(SERVER_ADDR, json={'recent': int(args['my_recent']), 'username_limit': username}, timeout=REQUEST_TIMEOUT)
 
     # get a listing of all recently generated IDs
     elif 'recent' in args:
-        req = requests.post(SERVER_ADDR, json={'recent': int(args['recent'])})
+        req = requests.post(SERVER_ADDR, json={'recent': int(args['recent'])}, timeout=REQUEST_TIMEOUT)
 
     # get a listing of scenes by the current user which have a non-empty outline
     elif 'my_scenes' in args:
-        req = requests.post(SERVER_ADDR, json={'list_scenes': 1, 'username_limit': username, 'outline_limit': 1})
+        req = requests.post(SERVER_ADDR, json={'list_scenes': 1, 'username_limit': username, 'outline_limit': 1}, timeout=REQUEST_TIMEOUT)
 
     # get a listing of all scenes which have a non-empty outline
     else:
-        req = requests.post(SERVER_ADDR, json={'list_scenes': 1, 'outline_limit': 1})
+        req = requests.post(SERVER_ADDR, json={'list_scenes': 1, 'outline_limit': 1}, timeout=REQUEST_TIMEOUT)
 
     # try to return the result, fail gracefully
     try:
@@ -242,9 +226,13 @@ def process_query(args):
         ret = req.json()
     except:
         return {'error': f'Request error -- code: {req.status_code}, text: {req.text}'}, username
+    # the server did not know any lines of the text in time
+    ret = wait_for_lines(SERVER_ADDR, ret)
     # user requested plaintext download instead of normal listing -- just add this info to the results
     if 'key' in ret and 'download' in args:
         ret['download'] = 1
+    # translations not ready when the text was generated
+    fill_translations(SERVER_ADDR, ret)
     return ret, username
 
 
@@ -341,6 +329,7 @@ print('''
 <div id="typingdiv">
 <div id="horizontaldiv">
 <img id="typingimg" src="robot.gif">
+<pre id="streamdiv"></pre>
 </div>
 </div>
 ''')
@@ -512,6 +501,7 @@ if 'key' in data:
     assert buffer_en == ''
 
     # Rating
+    print_pending(data, SERVER_NO)
     print_rating_links(data['key'], data['rating'])
 
     # Commands
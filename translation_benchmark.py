@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Throughput benchmark of the translation backends: translates a script (one
+line per line, as stored by story_server.py) in chunks of lines, the same
+way the background translation of story_server.py does, with the persistent
+cache switched off.
+"""
+
+import sys
+import time
+from argparse import ArgumentParser
+
+import urutranslate
+
+
+def benchmark(lines, chunk_size):
+    """Translate the lines in chunks; return seconds, number of failed chunks."""
+    start = time.perf_counter()
+    failed = 0
+    for i in range(0, len(lines), chunk_size):
+        try:
+            urutranslate.translate_many_with_roles_separately(lines[i:i + chunk_size])
+        except urutranslate.TranslationError:
+            failed += 1
+    return time.perf_counter() - start, failed
+
+
+if __name__ == '__main__':
+    ap = ArgumentParser(description='Compare throughput of translation backends')
+    ap.add_argument('script', nargs='?', default=None,
+                    help='File with script lines (Name: text / [remark]); default: STDIN')
+    ap.add_argument('-b', '--backends', nargs='+', default=sorted(urutranslate.BACKENDS.keys()),
+                    choices=sorted(urutranslate.BACKENDS.keys()),
+                    help='Backends to benchmark')
+    ap.add_argument('-u', '--url', default=None,
+                    help='Base URL of the remote service (e.g. a local stub); default: LINDAT')
+    ap.add_argument('-m', '--model', default='Helsinki-NLP/opus-mt-{source}-{target}',
+                    help='Model of the local backend')
+    ap.add_argument('-w', '--workers', type=int, default=2,
+                    help='Number of threads of the local backend')
+    ap.add_argument('-c', '--chunk-size', type=int, default=20,
+                    help='Number of lines translated together')
+    args = ap.parse_args()
+
+    if args.script:
+        with open(args.script) as infile:
+            lines = [line.rstrip('\n') for line in infile if line.strip()]
+    else:
+        lines = [line.rstrip('\n') for line in sys.stdin if line.strip()]
+    if not lines:
+        sys.exit('Nothing to translate!')
+    chars = sum(len(line) for line in lines)
+
+    if args.url:
+        urutranslate.set_base_url(args.url)
+    urutranslate.set_cache_file(None)
+
+    print('Backend\tLines\tSeconds\tLines/s\tChars/s\tFailedChunks')
+    for name in args.backends:
+        if name == 'local':
+            urutranslate.set_backend(name, model=args.model, workers=args.workers)
+            # load the model before measuring
+            urutranslate.translate_batch([lines[0]])
+        else:
+            urutranslate.set_backend(name)
+        seconds, failed = benchmark(lines, args.chunk_size)
+        print(f'{name}\t{len(lines)}\t{seconds:.2f}\t{len(lines) / seconds:.1f}\t{chars / seconds:.0f}\t{failed}')
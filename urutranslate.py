@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
 #coding: utf-8
 
+import os
 import requests
+import sqlite3
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
+from hashlib import sha1
 
 import logging
 logging.basicConfig(
@@ -13,6 +18,28 @@ logging.basicConfig(
 
 _headers = {"accept": "text/plain"}
 
+# (connect, read) timeout of translation requests in seconds
+TIMEOUT = (5, 60)
+
+# Base URL of the translation service; can be pointed to a local stand-in
+# server (see run_stub_server()) for tests and benchmarks
+BASE_URL = os.environ.get('URUTRANSLATE_URL',
+        'http://lindat.mff.cuni.cz/services/translation/api/v2')
+
+# Persistent translation cache file, None = no persistent cache
+CACHE_FILE = os.environ.get('URUTRANSLATE_CACHE', 'translations.db')
+
+# Limits for packing multiple segments into one request
+BATCH_MAX_SEGMENTS = 50
+BATCH_MAX_CHARS = 4000
+# Maximum number of batch requests running concurrently
+BATCH_WORKERS = 4
+
+# Keep-alive connections to the translation service, shared by all threads
+_session = requests.Session()
+_session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+_session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
 # from story_server import looks_scenic
 def looks_scenic(line):
     """Does this line look like a scenic remark?"""
@@ -25,26 +52,116 @@ def _trim(text):
     else:
         return text
 
+class TranslationCache:
+    """Persistent translation cache in an SQLite file, keyed by translation
+    backend, source language, target language and hash of the text. All
+    processes using the same file share the cache."""
+
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        with self.lock:
+            # other processes may be opening the file at the same time
+            self.conn.execute('BEGIN IMMEDIATE')
+            columns = [row[1] for row in self.conn.execute('PRAGMA table_info(translations)')]
+            if columns and 'backend' not in columns:
+                # cache from before the backends were added: all its
+                # translations come from the remote service
+                logging.info('Adding translation backends to the cache in {}'.format(filename))
+                self.conn.execute('ALTER TABLE translations RENAME TO translations_old')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS translations ('
+                    'backend TEXT, source TEXT, target TEXT, hash TEXT, translation TEXT, '
+                    'PRIMARY KEY (backend, source, target, hash))')
+            if columns and 'backend' not in columns:
+                self.conn.execute("INSERT OR IGNORE INTO translations "
+                        "SELECT 'remote', source, target, hash, translation FROM translations_old")
+                self.conn.execute('DROP TABLE translations_old')
+            self.conn.commit()
+
+    @staticmethod
+    def text_hash(text):
+        return sha1(text.encode('utf-8')).hexdigest()
+
+    def get(self, text, source, target, backend='remote'):
+        with self.lock:
+            row = self.conn.execute(
+                    'SELECT translation FROM translations WHERE backend=? AND source=? AND target=? AND hash=?',
+                    (backend, source, target, self.text_hash(text))).fetchone()
+        return row[0] if row else None
+
+    def put(self, text, source, target, translation, backend='remote'):
+        with self.lock:
+            self.conn.execute(
+                    'INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?, ?)',
+                    (backend, source, target, self.text_hash(text), translation))
+            self.conn.commit()
+
+_cache = None
+
+def get_cache():
+    """The persistent cache, opened on first use; None if switched off."""
+    global _cache
+    if _cache is None and CACHE_FILE:
+        _cache = TranslationCache(CACHE_FILE)
+    return _cache
+
+def set_cache_file(filename):
+    """Use the given persistent cache file (None = no persistent cache)."""
+    global CACHE_FILE, _cache
+    CACHE_FILE = filename
+    _cache = None
+
+def set_base_url(url):
+    """Use a different translation service (e.g. the stub server)."""
+    global BASE_URL
+    BASE_URL = url.rstrip('/')
+    get_url.cache_clear()
+
+def set_backend(name, **kwargs):
+    """Select the translation backend ('remote' or 'local'); kwargs are
+    passed to the backend constructor."""
+    global _backend
+    _backend = BACKENDS[name](**kwargs)
+
 @lru_cache(maxsize=4)
 def get_url(source='en', target='cs'):
-    return f'http://lindat.mff.cuni.cz/services/translation/api/v2/models/{source}-{target}'
+    return f'{BASE_URL}/models/{source}-{target}'
 
-@lru_cache(maxsize=32)
 def translate(text, source='en', target='cs'):
-    """Simply translate the text"""
+    """Simply translate the text; None on failure (failures are not cached,
+    so the text is sent again next time)"""
 
     if text.strip() == '':
         # translating empty text is trivial
         return text
 
+    cache = get_cache()
+    if cache:
+        translation = cache.get(text, source, target, _backend.name)
+        if translation is not None:
+            return translation
+
+    translation = _backend.translate_text(text, source, target)
+    if cache and translation is not None:
+        cache.put(text, source, target, translation, _backend.name)
+    return translation
+
+def _translate_remote(text, source='en', target='cs'):
+    """Translate the text by the translation service"""
+
     data = {"input_text": text}
     
     logging.debug('Sending request: {} characters ({})'.format(
         len(text), _trim(text)))
-    response = requests.post(
-            get_url(source, target),
-            data = data,
-            headers = _headers)
+    try:
+        response = _session.post(
+                get_url(source, target),
+                data = data,
+                headers = _headers,
+                timeout = TIMEOUT)
+    except requests.RequestException as e:
+        logging.error('Translation error: {}'.format(e))
+        return None
     logging.debug('Got response: {} {}'.format(
         response.status_code, response.reason))
     response.encoding='utf8'
@@ -79,9 +196,11 @@ def translate(text, source='en', target='cs'):
             response.status_code, response.reason))
         return None
 
-@lru_cache(maxsize=8)
-def translate_role(role, source='en', target='cs'):
-    """Translate character name"""
+class TranslationError(Exception):
+    pass
+
+def _role_to_translate(role, source='en'):
+    """Prepare character name for translation"""
 
     # It seems roles are best translated in titlecase...
     # (to favour interpretation as character name/role)
@@ -93,7 +212,10 @@ def translate_role(role, source='en', target='cs'):
         if not text_to_translate.lower().startswith('the '):
             text_to_translate = 'the ' + text_to_translate
 
-    translation = translate(text_to_translate, source, target)
+    return text_to_translate
+
+def _role_translated(role, translation):
+    """Restore the case of the original character name in its translation"""
 
     if role.istitle():
         translation = translation.title()
@@ -104,50 +226,299 @@ def translate_role(role, source='en', target='cs'):
 
     return translation
 
-def translate_scenic(text, source='en', target='cs'):
-    """Translate scenic remark"""
-
-    text_to_translate = text
-    prepend = ''
-    append = ''
+def _split_scenic(text):
+    """Split scenic remark into text to translate and the brackets to put
+    back after translation"""
 
     # If remark in square brackets, remove the brackets for translation.
     # TODO: Might also be other brackets etc.
-    if text_to_translate.startswith('[') and text_to_translate.endswith(']'):
-        text_to_translate = text[1:-1].strip()
-        prepend = '['
-        append = ']'
+    if text.startswith('[') and text.endswith(']'):
+        return text[1:-1].strip(), '[', ']'
+    return text, '', ''
+
+def translate_role(role, source='en', target='cs'):
+    """Translate character name.
+    Raises TranslationError if the name cannot be translated."""
+
+    translation = translate(_role_to_translate(role, source), source, target)
+    if translation is None:
+        raise TranslationError('Cannot translate "{}"'.format(role))
+    return _role_translated(role, translation)
+
+def translate_scenic(text, source='en', target='cs'):
+    """Translate scenic remark.
+    Raises TranslationError if the remark cannot be translated."""
+
+    text_to_translate, prepend, append = _split_scenic(text)
 
     translation = translate(text_to_translate, source, target)
+    if translation is None:
+        raise TranslationError('Cannot translate "{}"'.format(text))
 
     # Put back what was removed
     translation = prepend + translation + append
 
     return translation
 
+_executor = None
 
-def translate_with_roles_separately(text, source='en', target='cs'):
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS)
+    return _executor
+
+def _pack_segments(segments):
+    """Pack the segments into batches respecting the batch limits"""
+
+    batches = []
+    batch = []
+    batch_chars = 0
+    for segment in segments:
+        if batch and (len(batch) >= BATCH_MAX_SEGMENTS or batch_chars + len(segment) > BATCH_MAX_CHARS):
+            batches.append(batch)
+            batch = []
+            batch_chars = 0
+        batch.append(segment)
+        batch_chars += len(segment) + 1
+    if batch:
+        batches.append(batch)
+    return batches
+
+def _translate_segment_batch(batch, source, target):
+    """Translate a list of one-line segments in one request, one segment
+    per line. If the lines do not match the segments, translate them one by
+    one instead."""
+
+    if len(batch) > 1:
+        translation = _translate_remote('\n'.join(batch), source, target)
+        if translation is not None:
+            translations = translation.split('\n')
+            if len(translations) == len(batch):
+                return [t.strip() for t in translations]
+        logging.warning('Batch translation of {} segments failed, translating them one by one'.format(
+            len(batch)))
+    return [_translate_remote(segment, source, target) for segment in batch]
+
+class RemoteBackend:
+    """Translation by the LINDAT translation service (see BASE_URL).
+    Segments are packed into newline-delimited batches which are sent
+    concurrently."""
+
+    name = 'remote'
+
+    def translate_text(self, text, source='en', target='cs'):
+        return _translate_remote(text, source, target)
+
+    def translate_segments(self, segments, source='en', target='cs'):
+        batches = _pack_segments(segments)
+        results = _get_executor().map(
+                lambda batch: _translate_segment_batch(batch, source, target), batches)
+        return [translation for batch_translations in results for translation in batch_translations]
+
+class LocalBackend:
+    """Translation by a local seq2seq model (MarianMT by default) running
+    on CPU in this process, so there is no network round trip. Segments are
+    translated in batches of batch_size, by at most workers threads at a
+    time. Models are loaded on first use of each language pair."""
+
+    name = 'local'
+
+    def __init__(self, model='Helsinki-NLP/opus-mt-{source}-{target}', batch_size=16, workers=2, num_beams=4):
+        self.model_template = model
+        self.batch_size = batch_size
+        self.num_beams = num_beams
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.models = {}
+        self.models_lock = threading.Lock()
+
+    def get_model(self, source, target):
+        with self.models_lock:
+            if (source, target) not in self.models:
+                from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
+                model_name = self.model_template.format(source=source, target=target)
+                logging.info('Loading translation model {}'.format(model_name))
+                tokenizer = AutoTokenizer.from_pretrained(model_name)
+                model = AutoModelForSeq2SeqLM.from_pretrained(model_name)
+                model.eval()
+                self.models[(source, target)] = tokenizer, model
+        return self.models[(source, target)]
+
+    def _translate_batch(self, batch, source, target):
+        import torch
+        try:
+            tokenizer, model = self.get_model(source, target)
+            inputs = tokenizer(batch, return_tensors='pt', padding=True, truncation=True)
+            with torch.inference_mode():
+                outputs = model.generate(**inputs, num_beams=self.num_beams, max_length=512)
+            return [t.strip() for t in tokenizer.batch_decode(outputs, skip_special_tokens=True)]
+        except Exception as e:
+            logging.error('Translation error: {}'.format(e))
+            return [None] * len(batch)
+
+    def translate_segments(self, segments, source='en', target='cs'):
+        # similar lengths in one batch need less padding
+        order = sorted(range(len(segments)), key=lambda i: len(segments[i]))
+        batches = [[segments[i] for i in order[start:start + self.batch_size]]
+                   for start in range(0, len(order), self.batch_size)]
+        results = self.executor.map(
+                lambda batch: self._translate_batch(batch, source, target), batches)
+        sorted_translations = [translation for batch_translations in results for translation in batch_translations]
+        translations = [None] * len(segments)
+        for i, translation in zip(order, sorted_translations):
+            translations[i] = translation
+        return translations
+
+    def translate_text(self, text, source='en', target='cs'):
+        """Translate line by line, keeping empty lines"""
+        lines = text.split('\n')
+        translations = iter(self.translate_segments(
+            [line.strip() for line in lines if line.strip()], source, target))
+        lines_translation = [next(translations) if line.strip() else line for line in lines]
+        if None in lines_translation:
+            return None
+        return '\n'.join(lines_translation)
+
+BACKENDS = {
+        'remote': RemoteBackend,
+        'local': LocalBackend,
+        }
+
+_backend = RemoteBackend()
+
+def translate_batch(segments, source='en', target='cs'):
+    """Translate a list of one-line segments with as few requests as
+    possible: duplicates are translated once, cached segments are not sent
+    at all, the rest is translated in batches by the backend.
+    Returns the list of translations (None for failures)."""
+
+    cache = get_cache()
+    translations = {}
+    missing = []
+    missing_set = set()
+    for segment in segments:
+        if segment in translations or segment in missing_set:
+            continue
+        if segment.strip() == '':
+            translations[segment] = segment
+            continue
+        cached = cache.get(segment, source, target, _backend.name) if cache else None
+        if cached is not None:
+            translations[segment] = cached
+        else:
+            missing.append(segment)
+            missing_set.add(segment)
+
+    if missing:
+        logging.debug('Translating {} segments'.format(len(missing)))
+        for segment, translation in zip(missing, _backend.translate_segments(missing, source, target)):
+            translations[segment] = translation
+            if cache and translation is not None:
+                cache.put(segment, source, target, translation, _backend.name)
+
+    return [translations[segment] for segment in segments]
+
+
+def _translate_lines_with_roles_separately(lines_original, source='en', target='cs'):
     """Split up the lines into character names and character lines and
-    translate these separately"""
+    translate these separately; all the parts are translated in one batch.
+    Returns the list of translated lines.
+    Raises TranslationError if some of the parts cannot be translated."""
+
+    segments = []
+    for line_full in lines_original:
+        if looks_scenic(line_full):
+            segments.append(_split_scenic(line_full)[0])
+        else:
+            character, line = line_full.split(':', 1)
+            segments.append(_role_to_translate(character, source))
+            segments.append(line.lstrip())
+    translations = iter(translate_batch(segments, source, target))
 
-    lines_original = text.split('\n')
     lines_translation = []
     for line_full in lines_original:
         if looks_scenic(line_full):
             logging.debug('Translating scenic line: "{}"'.format(line_full))
-            translation_full = translate_scenic(line_full, source, target)
-            lines_translation.append(translation_full)
+            _, prepend, append = _split_scenic(line_full)
+            line_translation = next(translations)
+            if line_translation is None:
+                raise TranslationError('Cannot translate "{}"'.format(line_full))
+            lines_translation.append(prepend + line_translation + append)
         else:
             character, line = line_full.split(':', 1)
             logging.debug('Splitting line for translation: "{}" : "{}"'.format(
                 character, line.lstrip()))
-            character_translation = translate_role(character, source, target)
-            line_translation = translate(line.lstrip(), source, target)
+            character_translation = next(translations)
+            line_translation = next(translations)
+            if character_translation is None or line_translation is None:
+                raise TranslationError('Cannot translate "{}"'.format(line_full))
             translation_full = '{}: {}'.format(
-                    character_translation, line_translation)
+                    _role_translated(character, character_translation), line_translation)
             lines_translation.append(translation_full)
 
-    return '\n'.join(lines_translation)
+    return lines_translation
+
+def translate_with_roles_separately(text, source='en', target='cs'):
+    """Split up the lines into character names and character lines and
+    translate these separately.
+    Raises TranslationError if some of the parts cannot be translated."""
+
+    return '\n'.join(_translate_lines_with_roles_separately(
+        text.split('\n'), source, target))
+
+def translate_many_with_roles_separately(texts, source='en', target='cs'):
+    """Translate a list of texts as translate_with_roles_separately() does,
+    with the parts of all the texts translated in one batch.
+    Raises TranslationError if some of the parts cannot be translated."""
+
+    lines = [line for text in texts for line in text.split('\n')]
+    lines_translation = _translate_lines_with_roles_separately(lines, source, target)
+    translations = []
+    position = 0
+    for text in texts:
+        num_lines = text.count('\n') + 1
+        translations.append('\n'.join(lines_translation[position:position + num_lines]))
+        position += num_lines
+    return translations
+
+def run_stub_server(host='127.0.0.1', port=8458, delay=0.0):
+    """Local stand-in for the translation service, for tests and benchmarks.
+    Answers like the LINDAT API (no initial newlines, trailing empty line);
+    the "translation" is the input with each line marked by the target
+    language. delay = seconds to wait before each answer, to simulate the
+    network round trip."""
+    import re
+    import time
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            match = re.match(r'.*/models/([a-z]+)-([a-z]+)$', self.path)
+            if not match:
+                self.send_error(404)
+                return
+            length = int(self.headers.get('Content-Length', 0))
+            form = parse_qs(self.rfile.read(length).decode('utf-8'))
+            text = form.get('input_text', [''])[0]
+            target = match.group(2)
+            translation = '\n'.join(f'{line} <{target}>' if line.strip() else line
+                                    for line in text.lstrip('\n').split('\n')) + '\n'
+            time.sleep(delay)
+            body = translation.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.serve_forever()
 
 if __name__=="__main__":
     import sys
@@ -157,7 +528,25 @@ if __name__=="__main__":
             help='Source language; default: en')
     ap.add_argument('-t', '--target', default='cs',
             help='Target language; default: cs')
+    ap.add_argument('-u', '--url', default=None,
+            help='Base URL of the translation service; default: LINDAT')
+    ap.add_argument('-b', '--backend', choices=sorted(BACKENDS.keys()), default='remote',
+            help='Translation backend: remote service or local model')
+    ap.add_argument('-c', '--cache', default=CACHE_FILE,
+            help='Persistent translation cache file; empty = no cache')
+    ap.add_argument('--stub', type=int, default=None, metavar='PORT',
+            help='Run a local stand-in translation server on the given port instead')
+    ap.add_argument('--stub-delay', type=float, default=0.0,
+            help='Seconds of simulated latency of the stand-in server')
     args = ap.parse_args()
+
+    if args.stub:
+        run_stub_server(port=args.stub, delay=args.stub_delay)
+        sys.exit()
+    if args.url:
+        set_base_url(args.url)
+    set_backend(args.backend)
+    set_cache_file(args.cache or None)
     
     for line in sys.stdin:
         print(translate(line.rstrip(), source=args.source, target=args.target))